@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+import time
+import asyncio
+import logging
+import threading
+
+from client import ConnectionState, configureSocket
+from protocol import BinProtocol
+from profiling import RECV, SEND, emitSent
+from timers import Backoff, getTimerWheel
+from utils import LogSummary
+
+
+logging.getLogger()
+
+
+class _UmirsStreamProtocol(asyncio.Protocol):
+    """
+    Протокол asyncio, который передаёт события транспорта клиенту AsyncClient
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def connection_made(self, transport):
+        self.client._connectionMade(transport)
+
+    def data_received(self, data):
+        self.client._dataReceived(data)
+
+    def connection_lost(self, exc):
+        self.client._connectionLost(exc)
+
+
+class AsyncClient:
+    """
+    Клиент для подключения к серверу API Umirs на asyncio. В отличие от Client не опрашивает сокет в цикле: полученные
+    данные сразу передаются в декодер BinProtocol, а пакеты команд отправляются в сокет сразу после их формирования.
+    Клиент сам выступает менеджером пакетов для своего BinProtocol, поэтому команды отправляются через
+    client.protocol, например client.protocol.setPTZ(params). Команды можно вызывать из любого потока.
+    Каждый клиент хранит собственные Id сервера, счётчик пакетов, пакет приветствия и состояние соединения, поэтому в
+    одном процессе может работать несколько клиентов (см. servers.ServersManager)
+    """
+    dropCallbacks = True  # признак для BinProtocol, что addOutcomingPacket принимает параметр onDrop
+
+    def __init__(self, host='', port=0, eventsManager=None, serverId=1, pingInterval=3.0, reconnectDelay=1.0,
+                 maxReconnectDelay=15.0, livenessTimeout=10.0, keepAlive=(5, 1, 3), metrics=None, hooks=None,
+                 userTimeout=None, **protocolParams):
+        """
+        :param eventsManager: ссылка на менеджер событий
+        :param serverId: Id сервера API Umirs
+        :param pingInterval: таймаут между пингами сервера API в секундах. Пинг выполняется колесом таймеров
+        BinProtocol (параметр timers), общим для всех клиентов процесса
+        :param reconnectDelay: таймаут перед первой попыткой нового подключения в методе serve в секундах. Таймаут
+        каждой следующей неудачной попытки удваивается до maxReconnectDelay со случайным разбросом (см. timers.Backoff)
+        :param maxReconnectDelay: максимальный таймаут перед новым подключением в секундах
+        :param livenessTimeout: если от сервера API столько секунд не было ни одного корректного пакета, соединение
+        закрывается (и в методе serve открывается заново). Проверяется таймером каждую четверть таймаута
+        :param keepAlive: параметры TCP keepalive сокета (см. client.configureSocket)
+        :param metrics: метрики (см. metrics.UmirsMetrics) клиента и его BinProtocol
+        :param hooks: функции профилирования этапов (см. profiling.StageHooks) клиента и его BinProtocol. Этап RECV
+        в asyncio измеряется от получения данных транспортом до окончания их декодирования
+        :param userTimeout: TCP_USER_TIMEOUT сокета в секундах (см. client.configureSocket). None - по умолчанию ОС
+        :param protocolParams: дополнительные параметры для BinProtocol
+        """
+        self.host = host
+        self.port = port
+        self.pingInterval = pingInterval
+        self.reconnectDelay = reconnectDelay
+        self.maxReconnectDelay = maxReconnectDelay
+        self.livenessTimeout = livenessTimeout
+        self.keepAlive = keepAlive
+        self.userTimeout = userTimeout
+        self.connection = ConnectionState()
+        self.metrics = metrics
+        self.hooks = hooks
+        self.protocol = BinProtocol(packetsManager=self, eventsManager=eventsManager, serverId=serverId,
+                                    connection=self.connection, metrics=metrics, hooks=hooks,
+                                    pingInterval=pingInterval, **protocolParams)
+        self.__helloPacket = None
+        self.__loop = None
+        self.__loopThreadId = None
+        self.__transport = None
+        self.__closed = None  # future, которая завершается при закрытии соединения
+        self.__stopped = False
+        self.__watchdog = None  # таймер проверки таймаута получения пакетов от сервера
+        self.__logSummary = LogSummary('Umirs async client')  # сводка пакетов, отброшенных без соединения
+
+    async def connect(self):
+        """
+        Метод подключения к серверу API Umirs. После подключения отправляет пакет приветствия и запускает пинг сервера
+        :return:
+        """
+        self.__loop = asyncio.get_running_loop()
+        self.__loopThreadId = threading.get_ident()
+        self.__closed = self.__loop.create_future()
+        self.__stopped = False
+        logging.info(f'Try connect to Server API Umirs: {self.host}:{self.port}')
+        try:
+            await self.__loop.create_connection(lambda: _UmirsStreamProtocol(self), self.host, self.port)
+        except BaseException:
+            self.__closed.set_result(None)
+            raise
+        # пакет приветствия уже отправлен при установке соединения
+        self.protocol.startPing(hello=False)
+        timers = self.protocol.timers if self.protocol.timers is not None else getTimerWheel()
+        self.__watchdog = timers.callEvery(self.livenessTimeout / 4, self.__checkLiveness)
+
+    async def close(self):
+        """
+        Метод закрытия соединения с сервером API Umirs. Также останавливает цикл переподключения serve
+        :return:
+        """
+        self.__stopped = True
+        if self.__transport is not None:
+            self.__transport.close()
+        await self.waitClosed()
+
+    async def waitClosed(self):
+        """
+        Метод ожидания закрытия текущего соединения
+        :return:
+        """
+        if self.__closed is not None:
+            await asyncio.shield(self.__closed)
+
+    async def serve(self):
+        """
+        Метод поддержания соединения с сервером API Umirs: подключается и после разрыва соединения переподключается
+        с растущим таймаутом от reconnectDelay до maxReconnectDelay секунд, пока не будет вызван close. Завершается
+        также при отмене задачи
+        :return:
+        """
+        backoff = Backoff(self.reconnectDelay, self.maxReconnectDelay)
+        while not self.__stopped:
+            try:
+                await self.connect()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # любая ошибка подключения (не только OSError, но и, например, ошибка в hooks или metrics) не должна
+                # завершать цикл переподключения
+                logging.error('Connection to Server API Umirs is lost')
+                logging.exception(f'Exception: {str(e)}')
+                if self.__transport is not None:
+                    # ошибка после установки соединения: закроем его, чтобы не оставлять сокет открытым
+                    self.__abort()
+                    await self.waitClosed()
+            else:
+                backoff.reset()
+                await self.waitClosed()
+            if self.__stopped:
+                break
+            delay = backoff.next()
+            logging.info(f'Before start new connection WAIT {delay:.1f} seconds...')
+            await asyncio.sleep(delay)
+
+    async def request(self, name, params, timeout=None):
+        """
+        Метод отправки команды и ожидания ответа сервера (см. BinProtocol.request). Несколько команд можно ожидать
+        одновременно, например через asyncio.gather
+        :param name: имя метода команды
+        :param params: параметры команды
+        :param timeout: таймаут ответа в секундах
+        :return: reply | dict - результат парсинга ответа
+        """
+        return await asyncio.wrap_future(self.protocol.request(name, params, timeout))
+
+    def isConnected(self):
+        """
+        Метод проверяет открыт ли сокет с сервером API Umirs
+        :return:
+        """
+        return self.__transport is not None
+
+    def addOutcomingPacket(self, packet, onDrop=None):
+        """
+        Метод отправки пакета в сервер API Umirs. Если метод вызван не из потока цикла событий, то отправка
+        выполняется в цикле событий через call_soon_threadsafe
+        :param packet:
+        :param onDrop: функция без параметров, которая вызывается, если пакет не отправлен из-за отсутствия соединения
+        :return:
+        """
+        if packet is None:
+            return
+        if self.__transport is None:
+            self.__logSummary.count('packets dropped without connection')
+            if onDrop is not None:
+                onDrop()
+            return
+        if threading.get_ident() == self.__loopThreadId:
+            self.__write(packet, onDrop)
+        else:
+            self.__loop.call_soon_threadsafe(self.__write, packet, onDrop)
+
+    def setHelloPacket(self, packet):
+        self.__helloPacket = packet
+
+    def getHelloPacket(self):
+        return self.__helloPacket
+
+    def __write(self, packet, onDrop=None):
+        # за время ожидания в очереди цикла событий соединение могло быть закрыто
+        if self.__transport is None or self.__transport.is_closing():
+            if onDrop is not None:
+                onDrop()
+            return
+        hooks = self.hooks
+        if hooks is not None and hooks.sample(SEND):
+            start = time.perf_counter_ns()
+            self.__transport.write(packet)
+            emitSent(hooks, (packet,), start, time.perf_counter_ns())
+        else:
+            self.__transport.write(packet)
+        if self.metrics is not None:
+            self.metrics.packetsSent((packet,))
+
+    def __checkLiveness(self):
+        """
+        Метод проверки таймаута получения пакетов от сервера. Вызывается в потоке колеса таймеров, поэтому соединение
+        закрывается в цикле событий
+        :return:
+        """
+        if time.monotonic() - self.connection.getLastSeen() <= self.livenessTimeout:
+            return
+        logging.info(f'No valid packets from Server API Umirs {self.host}:{self.port} for {self.livenessTimeout} '
+                     f'seconds! Connection will be closed')
+        self.__cancelWatchdog()
+        self.__loop.call_soon_threadsafe(self.__abort)
+
+    def __abort(self):
+        if self.__transport is not None:
+            self.__transport.abort()
+
+    def __cancelWatchdog(self):
+        if self.__watchdog is not None:
+            self.__watchdog.cancel()
+            self.__watchdog = None
+
+    def _connectionMade(self, transport):
+        logging.info('Connected to Server API Umirs')
+        self.__transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            configureSocket(sock, self.keepAlive, self.userTimeout)
+        # таймаут ответа сервера отсчитывается от подключения
+        self.connection.touch()
+        if self.metrics is not None:
+            self.metrics.connected()
+        self.protocol.resetFramesBuffer()
+        # первым в новом соединении должен быть отправлен пакет приветствия
+        self.setHelloPacket(self.protocol.sayHello(ping=True))
+
+    def _dataReceived(self, data):
+        hooks = self.hooks
+        start = time.perf_counter_ns() if hooks is not None else 0
+        try:
+            self.protocol.decodeChunk(data)
+        except Exception:
+            logging.exception('Failed to decode packet from Umirs')
+        if hooks is not None and hooks.sample(RECV):
+            hooks.emit(RECV, None, None, start, time.perf_counter_ns())
+
+    def _connectionLost(self, exc):
+        logging.info('Connection to Server API Umirs is closed')
+        self.__transport = None
+        if self.metrics is not None:
+            self.metrics.disconnected()
+        self.protocol.stopPing()
+        self.__cancelWatchdog()
+        self.connection.closeConnection()
+        self.protocol.notifyConnectionLost()
+        if not self.__closed.done():
+            self.__closed.set_result(None)
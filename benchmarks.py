@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Модуль воспроизводимых бенчмарков BinProtocol. Состоит из четырёх частей:
+- decode - скорость декодирования синтетического потока пакетов 0x0A (пакетов/с и МБ/с) для разного кол-ва
+траекторий и разного разбиения потока на части;
+- encode - время формирования пакета каждой команды;
+- allocations - кол-во и объём выделений памяти на пакет при декодировании по данным tracemalloc;
+- latency - перцентили задержки от отправки пакета симулятором сервера до вызова события менеджера событий.
+Результаты записываются в JSON. Файл предыдущего запуска можно передать в --baseline, тогда при ухудшении
+результатов больше допустимого процент возвращается ненулевой код завершения.
+Запуск: python benchmarks.py --output benchmarks.json [--baseline previous.json --tolerance 10]
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import tracemalloc
+
+import codec
+
+from protocol import BinProtocol
+from simulator import MAX_TRACKS, UmirsSimulator, _SimulatedTrack
+
+
+logging.getLogger()
+
+TRACKS_COUNTS = (1, 4, 8, 16, MAX_TRACKS)  # 32 траектории не помещаются в пакет, максимум MAX_TRACKS
+# разбиение потока на части: имя -> размер части в байтах. frame - каждая часть ровно один пакет
+FRAGMENTATIONS = {'frame': None, 'tiny': 7, 'segment': 1460, 'bulk': 65536}
+# параметры команд для бенчмарка кодирования
+COMMAND_PARAMS = {
+    'sayHello': {},
+    'getServerStatus': {'formatStatus': 1},
+    'captureAndFollowTarget': {'trackId': 12, 'captureTarget': 1},
+    'setAutoCaptureTarget': {'setAutoCapture': 1},
+    'setArmRLS': {'setArmRLS': 1},
+    'setFiltersOfTargets': {'setFilters': 1},
+    'setMasksOfTargets': {'setMasks': 1},
+    'setPTZ': {'setPTZCommand': 1, 'setPTZSpeed': 10},
+    'setPTZPreset': {'presetId': 1, 'setPTZPreset': 1},
+}
+# метрики, по которым результат сравнивается с предыдущим запуском
+GATED_METRICS = ('framesPerSecond', 'microsecondsPerPacket', 'blocksPerFrame', 'peakBytesPerChunk', 'p50', 'p99')
+
+
+class _NullEventsManager:
+    """
+    Менеджер событий, который ничего не делает: в бенчмарке декодирования измеряется только декодер
+    """
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.__ignore
+
+    @staticmethod
+    def __ignore(*args, **kwargs):
+        pass
+
+
+class _HoldingEventsManager:
+    """
+    Менеджер событий, который сохраняет аргументы всех событий, чтобы объекты, созданные декодером, оставались в
+    памяти и учитывались tracemalloc при сравнении снимков
+    """
+    def __init__(self):
+        self.events = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.__hold
+
+    def __hold(self, *args, **kwargs):
+        self.events.append((args, kwargs))
+
+
+class _NullPacketsManager:
+    def addOutcomingPacket(self, packet):
+        pass
+
+    def setHelloPacket(self, packet):
+        pass
+
+
+def buildStream(tracks, frames, seed=0):
+    """
+    Функция построения синтетического потока пакетов 0x0A с движущимися траекториями
+    :param tracks: кол-во траекторий в пакете
+    :param frames: кол-во пакетов
+    :param seed: начальное значение генератора случайных чисел
+    :return: stream | bytes
+    """
+    rnd = random.Random(seed)
+    simulatedTracks = [_SimulatedTrack(trackId, rnd) for trackId in range(1, tracks + 1)]
+    stream = bytearray()
+    for countPacket in range(frames):
+        for track in simulatedTracks:
+            track.move()
+        records = [track.record(0) for track in simulatedTracks]
+        stream += codec.TRAJECTORIES.pack(countPacket % 255 + 1, 1, [len(records)], records)
+    return bytes(stream)
+
+
+def splitStream(stream, frameSize, chunkSize):
+    """
+    Функция разбиения потока на части так, как они могли бы быть получены из сокета
+    :param chunkSize: размер части. None - по одному пакету в части
+    :return: chunks | list
+    """
+    size = chunkSize or frameSize
+    return [stream[offset:offset + size] for offset in range(0, len(stream), size)]
+
+
+def benchmarkDecode(frames=2000, repeat=5):
+    """
+    Бенчмарк декодирования: лучший из repeat прогонов каждого потока через BinProtocol.decodeChunk - метод, которым
+    decodeIncomingPackets декодирует каждую полученную часть данных
+    :return: results | list
+    """
+    results = []
+    for tracks in TRACKS_COUNTS:
+        stream = buildStream(tracks, frames)
+        frameSize = len(stream) // frames
+        for fragmentation, chunkSize in FRAGMENTATIONS.items():
+            chunks = splitStream(stream, frameSize, chunkSize)
+            best = None
+            for _ in range(repeat):
+                protocol = BinProtocol(eventsManager=_NullEventsManager())
+                decodeChunk = protocol.decodeChunk
+                start = time.perf_counter()
+                for chunk in chunks:
+                    decodeChunk(chunk)
+                seconds = time.perf_counter() - start
+                best = seconds if best is None else min(best, seconds)
+            results.append({
+                'tracks': tracks,
+                'fragmentation': fragmentation,
+                'chunks': len(chunks),
+                'framesPerSecond': round(frames / best, 1),
+                'megabytesPerSecond': round(len(stream) / best / 1e6, 3),
+            })
+    return results
+
+
+def benchmarkEncode(number=20000, repeat=5):
+    """
+    Бенчмарк кодирования: время формирования одного пакета каждой команды без добавления в очередь
+    :return: results | list
+    """
+    protocol = BinProtocol(packetsManager=_NullPacketsManager(), eventsManager=_NullEventsManager())
+    results = []
+    for method, params in COMMAND_PARAMS.items():
+        spec = codec.COMMANDS_BY_METHOD[method]
+        encode = getattr(protocol, method)
+        buffer = bytearray(spec.size)
+        if method == 'sayHello':
+            # пакет приветствия формируется без добавления в очередь при ping=False
+            call = encode
+            encodeInto = None
+        else:
+            def call(encode=encode, params=params):
+                return encode(params, enqueue=False)
+
+            def encodeInto(encode=encode, params=params, buffer=buffer):
+                return encode(params, buffer=buffer, enqueue=False)
+        result = {'command': method, 'code': spec.code,
+                  'microsecondsPerPacket': round(_bestTime(call, number, repeat) / number * 1e6, 3)}
+        if encodeInto is not None:
+            result['microsecondsPerPacketIntoBuffer'] = round(_bestTime(encodeInto, number, repeat) / number * 1e6, 3)
+        results.append(result)
+    batch = [(method, params) for method, params in COMMAND_PARAMS.items()
+             if codec.COMMANDS_BY_METHOD[method].batch]
+    results.append({'command': 'encodeCommands', 'commands': len(batch),
+                    'microsecondsPerPacket': round(_bestTime(lambda: protocol.encodeCommands(batch), number // 10,
+                                                             repeat) / (number // 10) / len(batch) * 1e6, 3)})
+    return results
+
+
+def _bestTime(call, number, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            call()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def benchmarkAllocations(frames=500):
+    """
+    Бенчмарк выделений памяти при декодировании по данным tracemalloc. Менеджер событий сохраняет результаты
+    декодирования, поэтому блоки памяти результатов (словари и кортежи траекторий) не освобождаются до второго снимка и
+    учитываются в blocksPerFrame. Временные объекты, освобождаемые внутри декодирования (memoryview, кортежи
+    распаковки), учитываются в peakBytesPerChunk - среднем приросте пикового объёма памяти за один вызов decodeChunk
+    :return: results | list
+    """
+    results = []
+    for tracks in TRACKS_COUNTS:
+        stream = buildStream(tracks, frames)
+        frameSize = len(stream) // frames
+        for fragmentation in ('frame', 'segment'):
+            chunks = splitStream(stream, frameSize, FRAGMENTATIONS[fragmentation])
+            eventsManager = _HoldingEventsManager()
+            protocol = BinProtocol(eventsManager=eventsManager)
+            # прогрев: первые вызовы создают кэши интерпретатора, которые не относятся к декодированию
+            protocol.decodeChunk(chunks[0])
+            # список событий заранее увеличивается, чтобы его рост не попал в измерение
+            eventsManager.events.extend([None] * (frames * 2))
+            del eventsManager.events[:]
+            peakBytes = 0
+            tracemalloc.start()
+            try:
+                before = tracemalloc.take_snapshot()
+                for chunk in chunks[1:]:
+                    current, _ = tracemalloc.get_traced_memory()
+                    tracemalloc.reset_peak()
+                    protocol.decodeChunk(chunk)
+                    peakBytes += tracemalloc.get_traced_memory()[1] - current
+                after = tracemalloc.take_snapshot()
+            finally:
+                tracemalloc.stop()
+            decodedFrames = len(eventsManager.events)
+            # память самого бенчмарка (список событий) не относится к декодированию
+            ignore = (tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__))
+            statistics = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'filename')
+            blocks = sum(max(stat.count_diff, 0) for stat in statistics)
+            size = sum(max(stat.size_diff, 0) for stat in statistics)
+            results.append({
+                'tracks': tracks,
+                'fragmentation': fragmentation,
+                'blocksPerFrame': round(blocks / max(decodedFrames, 1), 3),
+                'bytesPerFrame': round(size / max(decodedFrames, 1), 1),
+                'peakBytesPerChunk': round(peakBytes / (len(chunks) - 1), 1),
+            })
+    return results
+
+
+class _LatencyEventsManager:
+    """
+    Менеджер событий, который запоминает время получения каждого события траекторий
+    """
+    def __init__(self):
+        self.receivedTimes = []
+
+    def discoveredTrajectories(self, trajectories):
+        self.receivedTimes.append(time.perf_counter_ns())
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: None
+
+
+def benchmarkLatency(tracks=MAX_TRACKS, frameRate=200.0, seconds=3.0, fragmentation=None):
+    """
+    Бенчмарк задержки от отправки пакета 0x0A симулятором сервера на localhost до вызова события
+    discoveredTrajectories в AsyncClient. Пакеты без ошибок приходят по TCP в порядке отправки, поэтому время
+    отправки и время события сопоставляются по порядковому номеру
+    :return: result | dict
+    """
+    from aioclient import AsyncClient
+
+    sentTimes = []
+    eventsManager = _LatencyEventsManager()
+
+    async def run():
+        simulator = UmirsSimulator(tracks=tracks, frameRate=frameRate, fragmentation=fragmentation, seed=0,
+                                   onFrameSent=sentTimes.append)
+        await simulator.start()
+        client = AsyncClient('127.0.0.1', simulator.port, eventsManager, pingInterval=seconds)
+        try:
+            await client.connect()
+            await asyncio.sleep(seconds)
+        finally:
+            await client.close()
+            await simulator.stop()
+
+    asyncio.run(run())
+    count = min(len(sentTimes), len(eventsManager.receivedTimes))
+    latencies = sorted((received - sent) / 1e3 for sent, received in zip(sentTimes, eventsManager.receivedTimes))
+    result = {'tracks': tracks, 'frameRate': frameRate, 'fragmentation': fragmentation, 'frames': count}
+    for name, percentile in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)):
+        result[name] = round(latencies[min(int(percentile * count), count - 1)], 1) if count else None
+    result['unit'] = 'us'
+    return result
+
+
+def compareWithBaseline(results, baseline, tolerance):
+    """
+    Функция сравнения результатов с предыдущим запуском
+    :param tolerance: допустимое ухудшение в процентах
+    :return: regressions | list - описания метрик, которые ухудшились больше допустимого
+    """
+    regressions = []
+    for part in ('decode', 'encode', 'allocations', 'latency'):
+        current = results.get(part)
+        previous = baseline.get(part)
+        if current is None or previous is None:
+            continue
+        if isinstance(current, dict):
+            current, previous = [current], [previous]
+        for new, old in zip(current, previous):
+            for metric in GATED_METRICS:
+                if new.get(metric) is None or old.get(metric) is None or not old[metric]:
+                    continue
+                # для пакетов в секунду больше - лучше, для времени, задержки и памяти - меньше
+                if metric == 'framesPerSecond':
+                    change = (old[metric] - new[metric]) / old[metric] * 100
+                else:
+                    change = (new[metric] - old[metric]) / old[metric] * 100
+                if change > tolerance:
+                    key = {name: value for name, value in new.items()
+                           if name in ('tracks', 'fragmentation', 'command')}
+                    regressions.append(f'{part} {key} {metric}: {old[metric]} -> {new[metric]} ({change:.1f}%)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BinProtocol benchmarks')
+    parser.add_argument('--output', default='-', help="JSON file for results, '-' - stdout")
+    parser.add_argument('--parts', default='decode,encode,allocations,latency', help='comma separated parts')
+    parser.add_argument('--frames', type=int, default=2000, help='frames per decode run')
+    parser.add_argument('--latency-seconds', type=float, default=3.0)
+    parser.add_argument('--baseline', default=None, help='JSON file of previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=10.0, help='allowed regression in percent')
+    args = parser.parse_args()
+
+    parts = set(args.parts.split(','))
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    if 'decode' in parts:
+        results['decode'] = benchmarkDecode(args.frames)
+    if 'encode' in parts:
+        results['encode'] = benchmarkEncode()
+    if 'allocations' in parts:
+        results['allocations'] = benchmarkAllocations()
+    if 'latency' in parts:
+        results['latency'] = benchmarkLatency(seconds=args.latency_seconds)
+
+    text = json.dumps(results, indent=2)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as file:
+            file.write(text)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compareWithBaseline(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
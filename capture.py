@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Модуль записи данных, полученных от сервера API Umirs, в файл и воспроизведения записанных данных через декодер.
+Формат файла: сигнатура FILE_SIGNATURE, затем записи подряд: заголовок RECORD_HEADER (время получения данных в
+наносекундах по монотонным часам и длина данных) и сами данные в том виде, в каком они были получены из сокета.
+Монотонные часы разных процессов не связаны между собой, поэтому при дописывании в существующий файл сначала
+записывается метка начала сеанса - заголовок с длиной SESSION_MARK без данных, от которой воспроизведение заново
+отсчитывает время записей. Каждый сеанс - отдельное подключение, поэтому на метке сбрасывается и буфер сборки пакетов
+декодера (параметр onSession метода StreamReplayer.replay)
+"""
+import mmap
+import time
+import struct
+import logging
+import argparse
+import threading
+
+
+logging.getLogger()
+
+FILE_SIGNATURE = b'UMIRSCAP'
+RECORD_HEADER = struct.Struct('<QI')
+SESSION_MARK = 0xFFFFFFFF  # длина в заголовке метки начала сеанса записи
+
+
+class StreamRecorder:
+    """
+    Класс записи полученных из сокета данных в файл. Записи только добавляются в конец файла, запись буферизуется,
+    поэтому объём памяти ограничен размером буфера, а системный вызов выполняется не на каждую часть данных
+    """
+    def __init__(self, path, bufferSize=1 << 16):
+        """
+        :param path: путь к файлу записи. Если файл уже существует, записи нового сеанса добавляются в его конец
+        после метки начала сеанса
+        :param bufferSize: размер буфера записи в байтах
+        """
+        self.path = path
+        self.__file = open(path, 'ab', buffering=bufferSize)
+        self.__lock = threading.Lock()
+        if self.__file.tell() == 0:
+            self.__file.write(FILE_SIGNATURE)
+        else:
+            self.__file.write(RECORD_HEADER.pack(time.monotonic_ns(), SESSION_MARK))
+
+    def write(self, chunk, timestamp=None):
+        """
+        Метод записи очередной части данных
+        :param chunk: данные из сокета
+        :param timestamp: время получения данных в наносекундах по time.monotonic_ns. По умолчанию текущее время
+        :return:
+        """
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        with self.__lock:
+            self.__file.write(RECORD_HEADER.pack(timestamp, len(chunk)))
+            self.__file.write(chunk)
+
+    def flush(self):
+        with self.__lock:
+            self.__file.flush()
+
+    def close(self):
+        with self.__lock:
+            if not self.__file.closed:
+                self.__file.close()
+
+
+class StreamReplayer:
+    """
+    Класс воспроизведения файла записи. Файл отображается в память через mmap, части данных передаются в декодер как
+    memoryview без копирования. Скорость воспроизведения задаётся относительно реальной: 1 - как при записи,
+    N - в N раз быстрее, None - без пауз, с максимальной скоростью
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def records(self):
+        """
+        Генератор записей файла. memoryview записи действителен только до следующей итерации генератора
+        :return: (timestamp, chunk) | tuple - время получения в наносекундах и данные. Для метки начала сеанса записи
+        chunk равен None: время следующих записей отсчитывается по другим монотонным часам
+        """
+        with open(self.path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(FILE_SIGNATURE)] != FILE_SIGNATURE:
+                raise ValueError(f'{self.path} is not a Umirs capture file')
+            with memoryview(data) as view:
+                offset = len(FILE_SIGNATURE)
+                while offset + RECORD_HEADER.size <= len(view):
+                    timestamp, length = RECORD_HEADER.unpack_from(view, offset)
+                    offset += RECORD_HEADER.size
+                    if length == SESSION_MARK:
+                        yield timestamp, None
+                        continue
+                    # последняя запись могла быть записана не полностью, если процесс был прерван
+                    if offset + length > len(view):
+                        logging.info(f'Capture file {self.path} is truncated')
+                        break
+                    with view[offset:offset + length] as chunk:
+                        yield timestamp, chunk
+                    offset += length
+
+    def replay(self, decode, speed=1.0, onSession=None):
+        """
+        Метод воспроизведения записанных данных
+        :param decode: функция декодирования части данных, например BinProtocol.decodeChunk
+        :param speed: скорость воспроизведения относительно реальной. None или 0 - максимальная скорость
+        :param onSession: функция без параметров, которая вызывается на метке начала сеанса, например
+        BinProtocol.resetFramesBuffer, чтобы незавершённый пакет предыдущего соединения не склеивался с данными нового
+        :return: statistics | dict - кол-во частей данных, байт и время воспроизведения в секундах
+        """
+        chunks = 0
+        size = 0
+        firstTimestamp = None
+        start = sessionStart = time.perf_counter()
+        for timestamp, chunk in self.records():
+            if chunk is None:
+                # новый сеанс записи: время отсчитывается от его первой записи
+                firstTimestamp = None
+                if onSession is not None:
+                    onSession()
+                continue
+            if speed:
+                if firstTimestamp is None:
+                    firstTimestamp = timestamp
+                    sessionStart = time.perf_counter()
+                delay = (timestamp - firstTimestamp) / 1e9 / speed - (time.perf_counter() - sessionStart)
+                if delay > 0:
+                    time.sleep(delay)
+            decode(chunk)
+            chunks += 1
+            size += len(chunk)
+        return {'chunks': chunks, 'bytes': size, 'seconds': time.perf_counter() - start}
+
+
+class _CountingEventsManager:
+    """
+    Менеджер событий для воспроизведения из командной строки: только считает события
+    """
+    def __init__(self):
+        self.events = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def count(*args):
+            self.events[name] = self.events.get(name, 0) + 1
+        return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay Umirs capture file through BinProtocol decoder')
+    parser.add_argument('path', help='capture file')
+    parser.add_argument('--speed', type=float, default=0, help='replay speed, 0 - maximum speed')
+    args = parser.parse_args()
+
+    from protocol import BinProtocol
+
+    eventsManager = _CountingEventsManager()
+    protocol = BinProtocol(eventsManager=eventsManager)
+    statistics = StreamReplayer(args.path).replay(protocol.decodeChunk, args.speed,
+                                                  onSession=protocol.resetFramesBuffer)
+    seconds = statistics['seconds'] or 1e-9
+    print(f"chunks={statistics['chunks']} bytes={statistics['bytes']} seconds={seconds:.3f} "
+          f"MB/s={statistics['bytes'] / seconds / 1e6:.2f} events={eventsManager.events}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,78 @@
 # -*- coding: utf-8 -*-
 import socket
 import time
+import warnings
 import threading
 import logging
 
 from settings import setting
+from capture import StreamRecorder
+from profiling import RECV, SEND, emitSent
+from timers import Backoff
+from utils import LogSummary, LogUtil
 
 
 logging.getLogger()
 
+SENDMSG_MAX_BUFFERS = 64  # максимальное кол-во пакетов, передаваемых в один вызов sendmsg
+
+
+def configureSocket(soc, keepAlive=(5, 1, 3), userTimeout=None):
+    """
+    Функция настройки сокета соединения с сервером API Umirs: отключает алгоритм Nagle (TCP_NODELAY), чтобы команды
+    уходили без задержки, и включает TCP keepalive, чтобы ядро обнаружило обрыв соединения без трафика. Параметры,
+    которые не поддерживает ОС, пропускаются
+    :param soc: сокет
+    :param keepAlive: (TCP_KEEPIDLE, TCP_KEEPINTVL, TCP_KEEPCNT) - через сколько секунд простоя отправлять пробы,
+    интервал между пробами в секундах и кол-во неотвеченных проб до разрыва. None - не включать keepalive
+    :param userTimeout: время в секундах, за которое отправленные данные должны быть подтверждены сервером, иначе
+    ядро разрывает соединение (TCP_USER_TIMEOUT, только Linux). None - по умолчанию ОС. Не связан с livenessTimeout
+    клиентов: livenessTimeout проверяет ответы приложения сервера, а userTimeout - только подтверждения TCP
+    :return:
+    """
+    soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    options = []
+    if keepAlive is not None:
+        soc.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        options.extend(zip(('TCP_KEEPIDLE', 'TCP_KEEPINTVL', 'TCP_KEEPCNT'), keepAlive))
+    if userTimeout is not None:
+        options.append(('TCP_USER_TIMEOUT', userTimeout * 1000))
+    for name, value in options:
+        option = getattr(socket, name, None)
+        if option is None:
+            continue
+        try:
+            soc.setsockopt(socket.IPPROTO_TCP, option, int(value))
+        except OSError as e:
+            logging.warning(f'Failed to set socket option {name}={value}: {e}')
+
 
 class Client(threading.Thread):
     """
     Класс реализующий клиент для подключения к серверу API Umirs
     """
-    def __init__(self, host='', port=0, packetsManager=None):
+    def __init__(self, host='', port=0, packetsManager=None, recvBufferSize=8192, recvBufferSlots=8,
+                 captureFile=None, metrics=None, hooks=None, reconnectDelay=1.0, maxReconnectDelay=15.0,
+                 connection=None, livenessTimeout=10.0, keepAlive=(5, 1, 3), userTimeout=None):
+        """
+        :param recvBufferSize: размер одного приёма данных из сокета в байтах
+        :param recvBufferSlots: кол-во частей кольцевого буфера приёма данных
+        :param captureFile: путь к файлу, в который записываются все полученные из сокета данные (см. capture.py).
+        Данные каждого подключения записываются отдельным сеансом. Если не задан, данные не записываются
+        :param metrics: метрики (см. metrics.UmirsMetrics), в которые записываются подключения, отправленные пакеты,
+        глубина очередей менеджера пакетов и кол-во сетевых ошибок. Обычно тот же объект передаётся в BinProtocol
+        :param hooks: функции профилирования этапов приёма и отправки данных (см. profiling.StageHooks)
+        :param reconnectDelay: таймаут перед первой попыткой нового подключения в секундах. Таймаут каждой следующей
+        неудачной попытки удваивается до maxReconnectDelay и случайно уменьшается до половины (см. timers.Backoff)
+        :param maxReconnectDelay: максимальный таймаут перед новым подключением в секундах
+        :param connection: объект состояния соединения, общий с BinProtocol (см. BinProtocol.connection). По
+        умолчанию - статический класс Connection
+        :param livenessTimeout: если от сервера API столько секунд не было ни одного корректного пакета (траекторий,
+        ответа на пинг и т.д.), соединение считается потерянным и открывается заново. Сервер отвечает на каждый пинг,
+        поэтому таймаут должен быть больше нескольких интервалов пинга
+        :param keepAlive: параметры TCP keepalive сокета (см. configureSocket)
+        :param userTimeout: TCP_USER_TIMEOUT сокета в секундах (см. configureSocket). None - по умолчанию ОС
+        """
         threading.Thread.__init__(self)
         self.port = port
         self.host = host
@@ -22,8 +80,26 @@ class Client(threading.Thread):
         # служебный флаг для мониторинга текущего соединения клиента драйвера. Необходим, чтобы корректно
         # переподключаться к серверу API, при изменении пар-в подключения.
         self.__clientCon = True
-        self.__errorCount = 0  # атрибут кол-ва сетевых ошибок
+        self.__errorCount = 0  # атрибут кол-ва сетевых ошибок, только для метрик
         self.__ping_time = 1.0  # временной атрибут для таймаута между пингами
+        self.__unsentData = b''  # часть исходящих данных, которую не удалось отправить в сокет за один вызов
+        self.__unsentPackets = []  # пакеты, данные которых (полностью или частично) остались в __unsentData
+        self.__recvRing = ReceiveRing(recvBufferSlots, recvBufferSize)  # буфер для приёма данных без выделения памяти
+        self.captureFile = captureFile
+        self.__recorder = None  # запись полученных данных в файл, открывается на время каждого подключения
+        self.metrics = metrics
+        self.hooks = hooks
+        # повторяющиеся события цикла приёма и отправки логируются сводкой, а не строкой на каждую итерацию
+        self.__logSummary = LogSummary('Umirs client')
+        self.__reconnectBackoff = Backoff(reconnectDelay, maxReconnectDelay)
+        self.connection = connection if connection is not None else Connection
+        self.livenessTimeout = livenessTimeout
+        self.keepAlive = keepAlive
+        self.userTimeout = userTimeout
+        if metrics is not None:
+            metrics.watchNetworkErrors(lambda: self.__errorCount)
+            if hasattr(packetsManager, 'getQueuesDepth'):
+                metrics.watchQueues(packetsManager.getQueuesDepth)
         self.__set_ping_time_from_setting()  # установим таймаут между пингами из settings.xml
 
     def configureClient(self, host=None, port=None):
@@ -73,46 +149,51 @@ class Client(threading.Thread):
             else:
                 # как только появилось соединение, установим параметр сокету, чтобы он был не блокирующим
                 soc.setblocking(False)
+                configureSocket(soc, self.keepAlive, self.userTimeout)
+                # таймаут ответа сервера отсчитывается от подключения
+                self.connection.touch()
+                if self.captureFile:
+                    # каждое подключение записывается отдельным сеансом (см. capture.StreamRecorder)
+                    self.__recorder = StreamRecorder(self.captureFile)
                 self.__clientCon = True
-                # счётчик пустых пакетов (имеется в виду пакеты пинга). Данный счётчик нужен для того, чтобы понять жив
-                # ли поток, который генерирует эти патеки
-                emptyPacketCounter = 0
+                # после успешного подключения следующее переподключение начнётся с минимального таймаута
+                self.__reconnectBackoff.reset()
                 # сбросим кол-во сетевых ошибок
                 self.resetErrorCount()
-                # запустим потоки для генерации пинг пакетов и декодирования входящих пакетов от Umirs
+                if self.metrics is not None:
+                    self.metrics.connected()
+                # запустим пинг сервера и поток декодирования входящих пакетов от Umirs
                 self.packetsManager.startThreads()
 
                 while self.__clientCon:
                     # если соединения устанавливается впервые, или произошло переподключение, необходимо отправить
                     # пакет приветствия сервера API
                     if newConnection:
-                        packet = self.packetsManager.getHelloPacket()
+                        helloPacket = self.packetsManager.getHelloPacket()
+                        packets = [helloPacket] if helloPacket else []
                         newConnection = False
                         # перед новым подключением очистим очереди пакетов
                         self.packetsManager.clearQueuesOfPackets()
-                    # если соединение в пределах одной сессии, то просто берем сообщения из очереди исх-х пакетов
+                        self.__unsentData = b''
+                        self.__unsentPackets = []
+                    # если соединение в пределах одной сессии, то забираем все сообщения из очереди исх-х пакетов
                     else:
-                        packet = self.packetsManager.getOutComingPacket()
+                        packets = self.__getAllOutComingPackets()
 
-                    if packet:
-                        # если пакет есть обнулим счётчик пустых пакетов
-                        emptyPacketCounter = 0
+                    if packets or self.__unsentData:
                         try:
-                            logging.info('try to send packet to Umirs')
-                            soc.send(packet)
-                            logging.info('packet sent successfully')
+                            if LogUtil.isHotPathDebugEnabled():
+                                logging.debug('try to send %d packets to Umirs', len(packets))
+                            self.__sendPackets(soc, packets)
                         except BlockingIOError:
-                            logging.info('Failed to sent packet to Umirs')
+                            self.__logSummary.count('send would-block')
                             # если возникли проблемы с отправкой пакета увеличим счётчик сетевых пакетов
                             self.increaseErrorCount()
                         try:
-                            logging.info('try 1 to receive response packet from Umirs')
-                            incomPacket = soc.recv(1024)
-                            # Если по какой-то причине входящий пакет None, залогируем другой вывод
-                            if incomPacket is None:
-                                logging.info(f'response packet received successfully. Length packet=None')
-                            else:
-                                logging.info(f'response packet received successfully. Length packet={len(incomPacket)}')
+                            incomPacket = self.__recv(soc)
+                            if LogUtil.isHotPathDebugEnabled():
+                                logging.debug('response packet received. Length packet=%s',
+                                              None if incomPacket is None else len(incomPacket))
                             if incomPacket is None or len(incomPacket) == 0:
                                 logging.info('Server API Umirs has sent zero length packet. It means'
                                              ' Server API Umirs turning off.')
@@ -120,7 +201,7 @@ class Client(threading.Thread):
                                 break
                         # except socket.timeout:
                         except BlockingIOError:
-                            logging.info('Failed to receive response packet from Umirs')
+                            self.__logSummary.count('recv would-block')
                             # если возникли проблемы с получением пакета увеличим счётчик сетевых пакетов
                             self.increaseErrorCount()
                         except Exception:
@@ -137,25 +218,19 @@ class Client(threading.Thread):
 
                     # если пакетов на отправку нет, послушаем сокет, может сервер прислал пакет
                     else:
-                        # если пакета нет - увеличим кол-во пустых пакетов
-                        emptyPacketCounter += 1
-
                         try:
-                            logging.info('try 2 to receive response packet from Umirs')
-                            incomPacket = soc.recv(1024)
-                            if incomPacket is None:
-                                logging.info(f'response packet received successfully. Length packet=None')
-                            else:
-                                logging.info(f'response packet received successfully. Length packet={len(incomPacket)}')
+                            incomPacket = self.__recv(soc)
+                            if LogUtil.isHotPathDebugEnabled():
+                                logging.debug('response packet received. Length packet=%s',
+                                              None if incomPacket is None else len(incomPacket))
                             if incomPacket is None or len(incomPacket) == 0:
                                 logging.info('Server API Umirs has sent zero length packet. It means'
                                              ' Server API Umirs turning off.')
                                 logging.info('Connection will be close and driver Umirs will be restart')
                                 break
                         except BlockingIOError:
-                            logging.info('Failed to receive response packet from Umirs')
+                            self.__logSummary.count('recv would-block')
                             self.increaseErrorCount()
-                            pass
                         else:
                             # пустые пакеты не добавляем в очередь входящих пакетов.
                             # (при откючении сервер АPI Umirs отправляет множество пустых пакетов)
@@ -165,30 +240,123 @@ class Client(threading.Thread):
                             else:
                                 self.increaseErrorCount()
 
-                        # если пустых пакетов набралось больше 20, значит поток отправляющий пакеты для пинга, аварийно
-                        # завершился. Нужно запустить этот поток ещё раз.
-                        if emptyPacketCounter > 100:
-                            emptyPacketCounter = 0
-                            logging.info('Max count empty packet. Counter is reset')
-                            self.packetsManager.startPingThread()
-
-                    # если кол-во сетевых ошибок превысило максимум, значит сервер ПО Umirsа не отвечает на наши
-                    # пинг пакеты, при этом сокет еще жив. Поэтому нужно выйти из цикла, тем самым закрыв прежний
-                    # сокет и инициировать новое подключение
-                    if self.isMaxErrorCount():
-                        logging.info('Max number off network errors is reached!')
+                    # если сервер долго не присылает пакетов, значит ПО Umirsа не отвечает на наши пинг пакеты, при
+                    # этом сокет еще жив. Поэтому нужно выйти из цикла, тем самым закрыв прежний сокет и инициировать
+                    # новое подключение
+                    if self.isPeerTimedOut():
+                        logging.info(f'No valid packets from Server API Umirs for {self.livenessTimeout} seconds!')
                         logging.info('Driver Umirs will be restart...')
                         break
 
                     time.sleep(self.__ping_time)
                 self.packetsManager.stopThreads()
+                self.__logSummary.flush()
+                self.__closeRecorder()
                 soc.close()  # при корректном выходе из цикла, закроем сокет
-                Connection.closeConnection()  # уст. флаг текущего соединения в False
-            logging.info('Before start new connection WAIT 15 seconds...')
-            time.sleep(15.0)
+                if self.metrics is not None:
+                    self.metrics.disconnected()
+                self.connection.closeConnection()  # уст. флаг текущего соединения в False
+            delay = self.__reconnectBackoff.next()
+            logging.info(f'Before start new connection WAIT {delay:.1f} seconds...')
+            time.sleep(delay)
+
+    def __closeRecorder(self):
+        if self.__recorder is not None:
+            self.__recorder.close()
+            self.__recorder = None
+
+    def __recv(self, soc):
+        """
+        Метод получения данных из сокета. Данные принимаются через recv_into в очередную часть кольцевого буфера и
+        передаются в очередь входящих пакетов как memoryview, без копирования. Часть буфера используется повторно,
+        только если менеджер пакетов сообщает глубину очереди входящих пакетов и по ней видно, что данные, ранее
+        принятые в эту часть, уже забрал декодер. Иначе данные принимаются в новый объект bytes
+        :param soc: неблокирующий сокет
+        :return: incomPacket | memoryview | bytes
+        """
+        hooks = self.hooks
+        if hooks is not None and hooks.sample(RECV):
+            start = time.perf_counter_ns()
+            incomPacket = self.__recvChunk(soc)
+            hooks.emit(RECV, None, None, start, time.perf_counter_ns())
+            return incomPacket
+        return self.__recvChunk(soc)
+
+    def __recvChunk(self, soc):
+        """
+        Метод приёма данных из сокета без измерения этапа RECV (см. __recv)
+        :param soc: неблокирующий сокет
+        :return: incomPacket | memoryview | bytes
+        """
+        getIncomingLength = getattr(self.packetsManager, 'getIncomingLength', None)
+        # в очереди находятся части, принятые после той, которая будет перезаписана. Если их меньше, чем частей
+        # буфера без одной (ещё одну может в этот момент копировать декодер), то перезаписываемая часть уже обработана
+        if getIncomingLength is not None and getIncomingLength() < self.__recvRing.slots - 1:
+            incomPacket = self.__recvRing.recvInto(soc)
+        else:
+            incomPacket = soc.recv(self.__recvRing.slotSize)
+        if self.__recorder is not None and incomPacket:
+            self.__recorder.write(incomPacket)
+        return incomPacket
+
+    def __getAllOutComingPackets(self):
+        """
+        Метод забирает из очереди все исходящие пакеты, чтобы отправить их одним вызовом
+        :return: packets | list
+        """
+        packets = []
+        packet = self.packetsManager.getOutComingPacket()
+        while packet:
+            packets.append(packet)
+            packet = self.packetsManager.getOutComingPacket()
+        return packets
+
+    def __sendPackets(self, soc, packets):
+        """
+        Метод отправки пакетов в сокет одним системным вызовом (sendmsg, если он доступен на платформе). Если сокет
+        принял данные не полностью, то неотправленный остаток сохраняется и отправляется первым на следующей итерации.
+        В метриках пакет учитывается только после отправки последнего его байта
+        :param soc: неблокирующий сокет
+        :param packets: список пакетов для отправки
+        :return:
+        """
+        buffers = [self.__unsentData] + packets if self.__unsentData else packets
+        total = sum(len(buffer) for buffer in buffers)
+        # кол-во буферов в одном вызове sendmsg ограничено системой (IOV_MAX), поэтому большие пачки склеиваются
+        if not hasattr(soc, 'sendmsg') or len(buffers) > SENDMSG_MAX_BUFFERS:
+            buffers = [b''.join(buffers)]
+        hooks = self.hooks
+        start = time.perf_counter_ns() if hooks is not None else 0
+        queued = self.__unsentPackets + packets
+        try:
+            sent = soc.sendmsg(buffers) if len(buffers) > 1 else soc.send(buffers[0])
+        except BlockingIOError:
+            self.__unsentData = b''.join(buffers)
+            self.__unsentPackets = queued
+            raise
+        if sent < total:
+            self.__logSummary.count('partial sends')
+            self.__unsentData = b''.join(buffers)[sent:]
+        else:
+            self.__unsentData = b''
+        # неотправленный остаток - это хвост очереди, поэтому пакеты, попавшие в него, остаются неучтёнными
+        remaining = total - sent
+        flushed = len(queued)
+        while remaining > 0:
+            flushed -= 1
+            remaining -= len(queued[flushed])
+        self.__unsentPackets = queued[flushed:]
+        if self.metrics is not None and flushed:
+            self.metrics.packetsSent(queued[:flushed])
+        if hooks is not None and hooks.sample(SEND):
+            emitSent(hooks, packets, start, time.perf_counter_ns())
 
     def run(self) -> None:
-        self.connect()
+        try:
+            self.connect()
+        finally:
+            # при аварийном завершении потока буфер записи должен попасть в файл
+            self.__closeRecorder()
 
     def increaseErrorCount(self):
         """
@@ -218,17 +386,20 @@ class Client(threading.Thread):
 
     def isMaxErrorCount(self):
         """
-        Метод для проверки достигнуто ли максимальное кол-во сетевых ошибок.
-        :return:
+        Устаревший метод проверки потери соединения. Раньше соединение считалось потерянным по кол-ву сетевых ошибок,
+        теперь - по времени без корректных пакетов от сервера (см. isPeerTimedOut)
+        :return: bool
         """
-        logging.debug(f'NETWORK ERROR COUNT: {self.__errorCount}')
-        # число 150, подобрано тоже из эксперементальных наблюдений. При отключении ПО Umirs отправляет порядка 100
-        # пустых сообщений в сокет, поэтому взято значение - 150, чтобы точно гарантировать своевременное отключение от
-        # Umirs. Т.к. в таком случае, точно ясно, что Umirs не отвечает на наши пакеты
-        if self.__errorCount > 150:
-            return True
-        else:
-            return False
+        warnings.warn('Client.isMaxErrorCount is deprecated, use Client.isPeerTimedOut', DeprecationWarning,
+                      stacklevel=2)
+        return self.isPeerTimedOut()
+
+    def isPeerTimedOut(self):
+        """
+        Метод проверки, истёк ли таймаут получения корректного пакета от сервера API Umirs
+        :return: bool
+        """
+        return time.monotonic() - self.connection.getLastSeen() > self.livenessTimeout
 
     def resetErrorCount(self):
         """
@@ -238,12 +409,43 @@ class Client(threading.Thread):
         self.__errorCount = 0
 
 
+class ReceiveRing:
+    """
+    Кольцевой буфер для приёма данных из сокета. Память выделяется один раз, каждый приём записывается в следующую
+    по кругу часть буфера и возвращается как memoryview на неё. Данные части действительны, пока буфер не сделает
+    полный круг, поэтому потребитель должен обработать (или скопировать) их до этого момента
+    """
+    def __init__(self, slots=8, slotSize=8192):
+        """
+        :param slots: кол-во частей буфера
+        :param slotSize: размер одной части в байтах (максимальный размер одного приёма данных)
+        """
+        self.slots = slots
+        self.slotSize = slotSize
+        self.__view = memoryview(bytearray(slots * slotSize))
+        self.__slot = 0  # номер части буфера для следующего приёма данных
+
+    def recvInto(self, soc):
+        """
+        Метод приёма данных из сокета в очередную часть буфера
+        :param soc:
+        :return: data | memoryview - принятые данные. Пустой memoryview, если сервер закрыл соединение
+        """
+        start = self.__slot * self.slotSize
+        slot = self.__view[start:start + self.slotSize]
+        received = soc.recv_into(slot)
+        self.__slot = (self.__slot + 1) % self.slots
+        return slot[:received]
+
+
 class Connection:
     """
     Статический класс представляющий объект соединения клиента драйвера с сервером API Umirs. Применяется для
-    синхронизации состояния текущего соединения в разных потоках (менеджер команд, клиент драйвера)
+    синхронизации состояния текущего соединения в разных потоках (менеджер команд, клиент драйвера). Также хранит
+    время получения последнего корректного пакета от сервера, по которому клиент определяет, что сервер не отвечает
     """
     _con = False  # соединение по умолчанию отключено
+    _lastSeen = 0.0  # время получения последнего корректного пакета по time.monotonic
 
     @staticmethod
     def closeConnection():
@@ -268,3 +470,65 @@ class Connection:
         :return:
         """
         return Connection._con is True
+
+    @staticmethod
+    def touch():
+        """
+        Метод для отметки получения корректного пакета от сервера API Umirs
+        :return:
+        """
+        Connection._lastSeen = time.monotonic()
+
+    @staticmethod
+    def getLastSeen():
+        """
+        Метод для получения времени последнего корректного пакета от сервера API Umirs по time.monotonic
+        :return: lastSeen | float
+        """
+        return Connection._lastSeen
+
+
+class ConnectionState:
+    """
+    Объект соединения клиента с одним сервером API Umirs. Имеет тот же интерфейс, что и статический класс Connection,
+    но хранит флаг соединения в экземпляре. Применяется, когда в одном процессе открыто несколько соединений с разными
+    серверами API Umirs
+    """
+    def __init__(self):
+        self._con = False  # соединение по умолчанию отключено
+        self._lastSeen = 0.0  # время получения последнего корректного пакета по time.monotonic
+
+    def closeConnection(self):
+        """
+        Метод для фиктивного закрытия соединения. Значение текущего соединения обнуляется
+        :return:
+        """
+        self._con = False
+
+    def startConnection(self):
+        """
+        Метод для установления флага текущего соединения
+        :return:
+        """
+        self._con = True
+
+    def isAlive(self):
+        """
+        Метод проверяет есть ли текущее соединение с сервером API Umirs
+        :return:
+        """
+        return self._con is True
+
+    def touch(self):
+        """
+        Метод для отметки получения корректного пакета от сервера API Umirs
+        :return:
+        """
+        self._lastSeen = time.monotonic()
+
+    def getLastSeen(self):
+        """
+        Метод для получения времени последнего корректного пакета от сервера API Umirs по time.monotonic
+        :return: lastSeen | float
+        """
+        return self._lastSeen
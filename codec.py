@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Модуль описания команд бинарного протокола Umirs. Каждая команда объявляется один раз списком полей, а раскладки
+struct для кодирования и декодирования пакетов, таблица диспетчеризации по номеру команды и таблицы частот РЛС
+строятся из этих описаний при импорте модуля
+"""
+import struct
+
+from collections import namedtuple
+
+
+FOR_SERVER = 0x00
+FOR_CLIENT = 0x01
+PROTOCOL_VERSION = 0x01  # версия протокола
+CLIENT_ID = 0x01  # согласно протоколу пока все 0x01
+
+# заголовок пакета: кому, длина пакета, номер пакета, Id клиента, Id сервера, команда, длина команды
+HEADER_FORMAT = '>BHBBBBH'
+HEADER_LENGTH = struct.calcsize(HEADER_FORMAT)
+MAX_PACKET_LENGTH = 416  # максимальная длина пакета согласно протоколу
+
+# классы приоритета исходящих команд в очереди PacketsManager, от самого срочного
+PRIORITY_CONTROL = 0  # управление PTZ и захватом целей
+PRIORITY_CONFIG = 1  # настройка РЛС, фильтров и масок
+PRIORITY_KEEPALIVE = 2  # пинг и приветствие
+PRIORITIES = (PRIORITY_CONTROL, PRIORITY_CONFIG, PRIORITY_KEEPALIVE)
+
+# поле команды: имя (совпадает с ключом словаря params методов BinProtocol и ключом результата декодирования),
+# код формата struct и значение по умолчанию. Поле без значения по умолчанию обязательно
+Field = namedtuple('Field', ('name', 'format', 'default'), defaults=(None,))
+
+
+class CommandSpec:
+    """
+    Описание команды протокола. По списку полей строится раскладка пакета, с помощью которой пакет кодируется
+    одним вызовом pack_into и декодируется одним вызовом unpack_from
+    """
+    def __init__(self, code, name, recipient, fields=(), method=None, batch=False, recordLayout=None, reply=None,
+                 replyKey=None, priority=PRIORITY_CONFIG, coalesce=None):
+        """
+        :param code: номер команды
+        :param name: название команды
+        :param recipient: получатель пакета: FOR_SERVER или FOR_CLIENT
+        :param fields: поля данных команды
+        :param method: имя метода BinProtocol, который формирует команду
+        :param batch: признак того, что команду можно формировать пачкой методом BinProtocol.encodeCommands
+        :param recordLayout: раскладка повторяющихся записей после полей команды (траектории пакета 0x0A)
+        :param reply: номер команды, которой сервер отвечает на команду (см. BinProtocol.request)
+        :param replyKey: имя поля, значение которого совпадает в команде и ответе. Без ключа ответы сопоставляются с
+        командами по порядку отправки
+        :param priority: класс приоритета команды в очереди исходящих пакетов (PRIORITY_*)
+        :param coalesce: имена полей, по которым команда заменяет ещё не отправленную команду того же типа в очереди
+        исходящих пакетов (отправляется только последняя). () - заменяет любую команду того же типа, None - команды
+        не заменяются
+        """
+        self.code = code
+        self.name = name
+        self.recipient = recipient
+        self.fields = tuple(fields)
+        self.fieldNames = tuple(field.name for field in self.fields)
+        self.method = method
+        self.batch = batch
+        self.recordLayout = recordLayout
+        self.reply = reply
+        self.replyKey = replyKey
+        self.priority = priority
+        self.coalesce = tuple(coalesce) if coalesce is not None else None
+        self.layout = struct.Struct(HEADER_FORMAT + ''.join(field.format for field in self.fields))
+        self.size = self.layout.size  # длина пакета без повторяющихся записей
+
+    def getValues(self, params):
+        """
+        Метод для получения значений полей команды из словаря параметров
+        :param params:
+        :return: values | list | None, если не задано обязательное поле
+        """
+        values = []
+        for field in self.fields:
+            value = params.get(field.name, field.default)
+            if value is None:
+                return None
+            values.append(value)
+        return values
+
+    def pack(self, countPacket, serverId, values, records=(), buffer=None, offset=0):
+        """
+        Метод кодирования пакета команды
+        :param countPacket: порядковый номер пакета
+        :param serverId: Id сервера API Umirs
+        :param values: значения полей команды
+        :param records: значения повторяющихся записей (только для команд с recordLayout)
+        :param buffer: буфер, в который нужно записать пакет. Если не передан, то создаётся новый bytearray
+        :param offset: смещение в буфере, с которого записывается пакет
+        :return: packet | bytearray | memoryview - memoryview на записанную часть, если передан buffer
+        """
+        size = self.size + (self.recordLayout.size * len(records) if records else 0)
+        if buffer is None:
+            packet = buffer = bytearray(size)
+        else:
+            packet = memoryview(buffer)[offset:offset + size]
+        self.layout.pack_into(buffer, offset, self.recipient, size, countPacket, CLIENT_ID, serverId, self.code,
+                              size - HEADER_LENGTH, *values)
+        recordOffset = offset + self.size
+        for record in records:
+            self.recordLayout.pack_into(buffer, recordOffset, *record)
+            recordOffset += self.recordLayout.size
+        return packet
+
+    def unpack(self, packet):
+        """
+        Метод декодирования полей команды из пакета
+        :param packet:
+        :return: values | dict - {имя поля: значение}
+        """
+        return dict(zip(self.fieldNames, self.layout.unpack_from(packet)[7:]))
+
+    def iterRecords(self, packet, count):
+        """
+        Метод для получения повторяющихся записей пакета
+        :param packet:
+        :param count: кол-во записей
+        :return: records | iterator - кортежи значений записей
+        """
+        return self.recordLayout.iter_unpack(packet[self.size:self.size + self.recordLayout.size * count])
+
+
+COMMANDS = {}  # номер команды -> CommandSpec
+COMMANDS_BY_METHOD = {}  # имя метода BinProtocol -> CommandSpec
+
+
+def register(spec):
+    """
+    Функция регистрации команды протокола
+    :param spec:
+    :return: spec | CommandSpec
+    """
+    COMMANDS[spec.code] = spec
+    if spec.method is not None:
+        COMMANDS_BY_METHOD[spec.method] = spec
+    return spec
+
+
+# пакет 3.2, 0x00 - приветствие сервера
+HELLO = register(CommandSpec(0x00, 'hello', FOR_SERVER, [
+    Field('protocolVersion', 'B', PROTOCOL_VERSION),
+], method='sayHello', reply=0x01, priority=PRIORITY_KEEPALIVE))
+# пакет 3.3, 0x01 - ответ сервера на приветствие. Значение больше нуля - протоколы совместимы
+HELLO_CLIENT = register(CommandSpec(0x01, 'helloClient', FOR_CLIENT, [
+    Field('compatible', 'B'),
+]))
+# 0x09 - запрос статуса сервера
+SERVER_STATUS_REQUEST = register(CommandSpec(0x09, 'serverStatusRequest', FOR_SERVER, [
+    Field('formatStatus', 'B', 0),
+], method='getServerStatus', batch=True, reply=0x14, priority=PRIORITY_KEEPALIVE))
+# пакет 3.5, 0x0A - передача траекторий: кол-во траекторий и по 13 байт на траекторию (номер трека, признак захвата,
+# целая и дробная части ЭПР, дальность, азимут, радиальная и тангенциальная скорости, сектор)
+TRAJECTORIES = register(CommandSpec(0x0A, 'trajectories', FOR_CLIENT, [
+    Field('count', 'B'),
+], recordLayout=struct.Struct('>HBBBHbhhB')))
+# 0x0B - принудительный захват и сопровождение траектории
+CAPTURE_TARGET = register(CommandSpec(0x0B, 'captureTarget', FOR_SERVER, [
+    Field('trackId', 'H'),
+    Field('captureTarget', 'B'),
+], method='captureAndFollowTarget', batch=True, reply=0x0D, replyKey='trackId', priority=PRIORITY_CONTROL,
+    coalesce=('trackId',)))
+# 0x0C - режим автозахвата траекторий
+AUTO_CAPTURE = register(CommandSpec(0x0C, 'autoCapture', FOR_SERVER, [
+    Field('setAutoCapture', 'B'),
+], method='setAutoCaptureTarget', batch=True, priority=PRIORITY_CONTROL, coalesce=()))
+# пакет 3.8, 0x0D - статус захвата трека
+CAPTURE_STATE = register(CommandSpec(0x0D, 'captureState', FOR_CLIENT, [
+    Field('trackId', 'H'),
+    Field('setCapture', 'B'),
+]))
+# 0x0E - постановка/снятие РЛС на охрану
+ARM_RLS = register(CommandSpec(0x0E, 'armRLS', FOR_SERVER, [
+    Field('setArmRLS', 'B'),
+], method='setArmRLS', batch=True))
+# 0x0F - фильтры траекторий
+FILTERS = register(CommandSpec(0x0F, 'filters', FOR_SERVER, [
+    Field('setFilters', 'B'),
+], method='setFiltersOfTargets', batch=True))
+# 0x10 - маски траекторий
+MASKS = register(CommandSpec(0x10, 'masks', FOR_SERVER, [
+    Field('setMasks', 'B'),
+], method='setMasksOfTargets', batch=True))
+# 0x11 - управление положением PTZ
+PTZ = register(CommandSpec(0x11, 'ptz', FOR_SERVER, [
+    Field('setPTZCommand', 'B'),
+    Field('setPTZSpeed', 'B'),
+], method='setPTZ', batch=True, priority=PRIORITY_CONTROL, coalesce=()))
+# 0x12 - вызов или установка пресета PTZ. Номер предустановки от 1 до 25
+PTZ_PRESET = register(CommandSpec(0x12, 'ptzPreset', FOR_SERVER, [
+    Field('presetId', 'B'),
+    Field('setPTZPreset', 'B'),
+], method='setPTZPreset', batch=True, priority=PRIORITY_CONTROL))
+# пакет 3.14, 0x14 - статус сервера
+SERVER_STATE = register(CommandSpec(0x14, 'serverState', FOR_CLIENT, [
+    Field('connectionCORT', 'B'),
+    Field('connectionRLS', 'B'),
+    Field('connectionPTZ', 'B'),
+    Field('eradiationFrequencyCode', 'B'),
+    Field('activeInterference', 'B'),
+    Field('eradiationRLS', 'B'),
+    Field('filters', 'B'),
+    Field('masks', 'B'),
+    Field('panPTZ', 'H'),
+    Field('tiltPTZ', 'H'),
+    Field('controlInterceptedPTZ', 'B'),
+    Field('trajectoryCaptured', 'B'),
+    Field('autoCapture', 'B'),
+    Field('rlsCode', 'B'),
+]))
+# пакет 3.15, 0x15 - расширенный статус сервера
+SERVER_EXTENDED_STATE = register(CommandSpec(0x15, 'serverExtendedState', FOR_CLIENT, [
+    Field('transmitterRLSState', 'B'),
+    Field('digitalReceiverRLSState', 'B'),
+    Field('analogReceiverRLSState', 'B'),
+    Field('clientCount', 'B'),
+    Field('firstZonePassiveInterference', 'B'),
+    Field('secondZonePassiveInterference', 'B'),
+    Field('thirdZonePassiveInterference', 'B'),
+    Field('fourthZonePassiveInterference', 'B'),
+    Field('sensivityReceiverRLS', 'B'),
+    Field('txRDS1', 'B'),
+    Field('rxRDS1', 'B'),
+    Field('errorsRDS1', 'B'),
+]))
+
+
+def _frequencies(first, last, step):
+    """
+    Функция построения списка частот РЛС от first до last включительно с шагом step
+    :return: frequencies | tuple
+    """
+    frequencies = []
+    frequency = first - step
+    while frequency < last:
+        frequency += step
+        frequencies.append(frequency)
+    return tuple(frequencies)
+
+
+RLS_TYPES = {0: 'RLS2.4', 1: 'RLS2.4M', 2: 'RLSX'}  # код типа РЛС -> тип РЛС
+# тип РЛС -> частоты излучения в МГц по коду частоты
+RLS_FREQUENCIES = {
+    'RLS2.4': _frequencies(2325, 2475, 50),
+    'RLS2.4M': _frequencies(2312.5, 2487.5, 12.5),
+    'RLSX': _frequencies(9235, 9760, 35),
+}
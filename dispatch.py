@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import time
+import asyncio
+import logging
+import threading
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import LogSummary
+
+
+logging.getLogger()
+
+DROP_OLDEST = 'dropOldest'  # при переполнении очереди события отбрасывается самое старое событие
+BLOCK = 'block'  # при переполнении очереди события поток декодирования ждёт освобождения места
+
+
+class _EventQueue:
+    """
+    Очередь событий одного типа. События одного типа обрабатываются строго по порядку: в каждый момент очередь
+    обрабатывает не больше одной задачи пула потоков (или цикла событий asyncio)
+    """
+    BATCH = 64  # кол-во событий, после обработки которых задача уступает пул другим очередям
+
+    def __init__(self, name, submit, maxSize, overflowPolicy, latency=None, logSummary=None, isWorkerThread=None):
+        """
+        :param latency: гистограмма (см. metrics.Histogram), в которую записывается время ожидания события в очереди
+        :param logSummary: сводка, в которой учитываются отброшенные при переполнении события
+        :param isWorkerThread: функция без параметров, которая возвращает True, если текущий поток сам обрабатывает
+        события (поток пула или цикла событий). Ожидание места в очереди в таком потоке может никогда не закончиться,
+        поэтому в нём политика BLOCK заменяется на DROP_OLDEST
+        """
+        self.name = name
+        self.latency = latency
+        self.__logSummary = logSummary
+        self.dropped = 0  # кол-во отброшенных при переполнении событий
+        self.__submit = submit
+        self.__events = deque()
+        self.__maxSize = maxSize
+        self.__overflowPolicy = overflowPolicy
+        self.__isWorkerThread = isWorkerThread
+        self.__ready = threading.Condition()
+        self.__scheduled = False  # признак того, что задача обработки очереди уже передана в пул
+
+    def __len__(self):
+        return len(self.__events)
+
+    def put(self, event):
+        with self.__ready:
+            if len(self.__events) >= self.__maxSize:
+                if self.__overflowPolicy == BLOCK and not self.__inWorkerThread():
+                    self.__ready.wait_for(lambda: len(self.__events) < self.__maxSize)
+                else:
+                    self.__events.popleft()
+                    self.dropped += 1
+                    if self.__logSummary is not None:
+                        self.__logSummary.count(f'{self.name} events dropped on full queue')
+            self.__events.append(event)
+            if not self.__scheduled:
+                self.__scheduled = True
+                self.__submit(self.drain)
+
+    def __inWorkerThread(self):
+        return self.__isWorkerThread is not None and self.__isWorkerThread()
+
+    def drain(self):
+        """
+        Метод обработки накопленных событий. Выполняется в пуле потоков или в цикле событий asyncio
+        :return:
+        """
+        for _ in range(self.BATCH):
+            with self.__ready:
+                if not self.__events:
+                    self.__scheduled = False
+                    return
+                handler, args, kwargs, enqueued = self.__events.popleft()
+                self.__ready.notify()
+            if enqueued:
+                self.latency.observe(time.perf_counter() - enqueued)
+            try:
+                handler(*args, **kwargs)
+            except Exception:
+                logging.exception(f'Failed to handle {self.name} event')
+        # очередь не пуста, продолжим её обработку отдельной задачей, чтобы не задерживать события других типов
+        self.__submit(self.drain)
+
+
+class EventsDispatcher:
+    """
+    Обёртка над менеджером событий, которая передаёт события в пул потоков или цикл событий asyncio, не блокируя поток
+    декодирования. Передаётся в BinProtocol вместо менеджера событий: BinProtocol(eventsManager=EventsDispatcher(em)).
+    Для каждого типа события (метода менеджера событий) ведётся своя ограниченная очередь, события одного типа
+    обрабатываются в порядке получения, а медленный обработчик одного типа не задерживает события других типов
+    """
+    def __init__(self, eventsManager, workers=4, maxQueueSize=1024, overflowPolicy=DROP_OLDEST, loop=None,
+                 metrics=None):
+        """
+        :param eventsManager: менеджер событий, методы которого вызываются для обработки событий
+        :param workers: кол-во потоков пула
+        :param maxQueueSize: максимальное кол-во событий в очереди одного типа
+        :param overflowPolicy: поведение при переполнении очереди: DROP_OLDEST или BLOCK. Вместе с loop политика BLOCK
+        работает, только если события создаются в другом потоке (например в потоке декодирования Client). События,
+        созданные в потоке самого цикла (например AsyncClient в том же цикле) или обработчиком события в потоке пула,
+        при переполнении отбрасываются, как при DROP_OLDEST, так как ожидание места в очереди остановило бы поток,
+        который должен это место освободить
+        :param loop: цикл событий asyncio. Если задан, то события обрабатываются в нём, а пул потоков не создаётся
+        :param metrics: метрики (см. metrics.UmirsMetrics), в которые записывается задержка от постановки события в
+        очередь до начала его обработки
+        """
+        if overflowPolicy not in (DROP_OLDEST, BLOCK):
+            raise ValueError(f'Unknown overflow policy {overflowPolicy}')
+        self.eventsManager = eventsManager
+        self.maxQueueSize = maxQueueSize
+        self.overflowPolicy = overflowPolicy
+        self.metrics = metrics
+        self.__workerThread = threading.local()  # признак потока пула этого диспетчера
+        if loop is None:
+            self.__executor = ThreadPoolExecutor(workers, thread_name_prefix='UmirsEvents',
+                                                 initializer=self.__markWorkerThread)
+            self.__submit = self.__executor.submit
+        else:
+            self.__executor = None
+            self.__submit = loop.call_soon_threadsafe
+        self.__loop = loop
+        self.__queues = {}
+        self.__lock = threading.Lock()
+        self.__logSummary = LogSummary('Umirs events dispatcher')
+
+    def __getattr__(self, name):
+        # служебные атрибуты не проксируются, иначе до завершения __init__ возможна бесконечная рекурсия
+        if name.startswith('_') or name == 'eventsManager':
+            raise AttributeError(name)
+        handler = getattr(self.eventsManager, name)
+        if not callable(handler):
+            return handler
+        with self.__lock:
+            queue = self.__queues.get(name)
+            if queue is None:
+                queue = self.__queues[name] = _EventQueue(
+                    name, self.__submit, self.maxQueueSize, self.overflowPolicy,
+                    self.metrics.dispatchLatency if self.metrics is not None else None, self.__logSummary,
+                    self.__isWorkerThread)
+
+        if queue.latency is None:
+            def dispatch(*args, **kwargs):
+                queue.put((handler, args, kwargs, 0))
+        else:
+            def dispatch(*args, **kwargs):
+                queue.put((handler, args, kwargs, time.perf_counter()))
+        # запомним метод, чтобы следующие вызовы не проходили через __getattr__
+        setattr(self, name, dispatch)
+        return dispatch
+
+    def __markWorkerThread(self):
+        self.__workerThread.active = True
+
+    def __isWorkerThread(self):
+        """
+        Метод проверки, что текущий поток обрабатывает события диспетчера: поток пула или поток цикла событий
+        :return: bool
+        """
+        if self.__loop is None:
+            return getattr(self.__workerThread, 'active', False)
+        try:
+            return asyncio.get_running_loop() is self.__loop
+        except RuntimeError:
+            return False
+
+    def getQueuesDepth(self):
+        """
+        Метод для получения текущего кол-ва событий в очередях и кол-ва отброшенных событий по типам
+        :return: depth | dict - {тип события: {'queued': int, 'dropped': int}}
+        """
+        return {name: {'queued': len(queue), 'dropped': queue.dropped} for name, queue in self.__queues.items()}
+
+    def shutdown(self, wait=True):
+        """
+        Метод остановки пула потоков
+        :param wait: дождаться обработки уже переданных в пул событий
+        :return:
+        """
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=wait)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Модуль истории обнаруженных траекторий
+"""
+import threading
+
+from array import array
+from collections import OrderedDict
+
+from utils import TimeUtil
+
+
+class TrackHistory:
+    """
+    Кольцевой буфер истории одной траектории фиксированного размера. Точки хранятся в массивах array по полям, поэтому
+    память на траекторию выделяется один раз. Временные метки точек не убывают, что позволяет искать точки по
+    интервалу времени двоичным поиском
+    """
+    # поле точки -> код типа array
+    FIELDS = (
+        ('timestamp', 'd'),
+        ('range', 'H'),
+        ('azimuth', 'd'),
+        ('radSpeed', 'h'),
+        ('tanSpeed', 'h'),
+        ('square', 'd'),
+        ('status', 'B'),
+    )
+
+    def __init__(self, capacity=256):
+        """
+        :param capacity: максимальное кол-во хранимых точек. При заполнении новая точка заменяет самую старую
+        """
+        self.capacity = capacity
+        self.__columns = {field: array(typeCode, [0]) * capacity for field, typeCode in self.FIELDS}
+        self.__timestamps = self.__columns['timestamp']
+        self.__start = 0  # индекс самой старой точки в массивах
+        self.__count = 0  # кол-во точек в буфере
+
+    def __len__(self):
+        return self.__count
+
+    def append(self, timestamp, track):
+        """
+        Метод добавления точки траектории
+        :param timestamp: время получения точки в секундах
+        :param track: траектория из пакета 0x0A
+        :return:
+        """
+        # время не должно убывать, иначе нарушится порядок для двоичного поиска (например, при переводе часов)
+        if self.__count and timestamp < self.__timestamps[self.__index(self.__count - 1)]:
+            timestamp = self.__timestamps[self.__index(self.__count - 1)]
+        if self.__count < self.capacity:
+            index = self.__index(self.__count)
+            self.__count += 1
+        else:
+            index = self.__start
+            self.__start = (self.__start + 1) % self.capacity
+        for field, column in self.__columns.items():
+            column[index] = timestamp if field == 'timestamp' else track[field]
+
+    def last(self, count):
+        """
+        Метод для получения последних точек траектории
+        :param count: кол-во точек
+        :return: points | list - точки от старой к новой
+        """
+        count = min(count, self.__count)
+        return self.__points(self.__count - count, self.__count)
+
+    def between(self, startTime, endTime):
+        """
+        Метод для получения точек траектории, полученных в интервале времени [startTime, endTime]
+        :param startTime: начало интервала в секундах
+        :param endTime: конец интервала в секундах
+        :return: points | list - точки от старой к новой
+        """
+        return self.__points(self.__bisect(startTime, False), self.__bisect(endTime, True))
+
+    def __index(self, position):
+        return (self.__start + position) % self.capacity
+
+    def __bisect(self, timestamp, right):
+        """
+        Двоичный поиск позиции временной метки среди точек буфера (аналог bisect_left/bisect_right)
+        :return: position | int
+        """
+        low, high = 0, self.__count
+        while low < high:
+            middle = (low + high) // 2
+            value = self.__timestamps[self.__index(middle)]
+            if value < timestamp or (right and value == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __points(self, begin, end):
+        points = []
+        for position in range(begin, end):
+            index = self.__index(position)
+            points.append({field: column[index] for field, column in self.__columns.items()})
+        return points
+
+
+class TracksHistory:
+    """
+    История траекторий, обнаруженных сервером API Umirs. Для каждой траектории хранится TrackHistory, общее кол-во
+    траекторий ограничено: при превышении удаляется история траектории, которая дольше всех не обновлялась
+    """
+    def __init__(self, capacityPerTrack=256, maxTracks=256):
+        """
+        :param capacityPerTrack: кол-во хранимых точек одной траектории
+        :param maxTracks: максимальное кол-во траекторий в истории
+        """
+        self.capacityPerTrack = capacityPerTrack
+        self.maxTracks = maxTracks
+        self.__tracks = OrderedDict()  # trackId -> TrackHistory, в порядке последнего обновления
+        self.__lock = threading.Lock()
+
+    def add(self, tracks, timestamp=None):
+        """
+        Метод добавления в историю траекторий очередного пакета 0x0A
+        :param tracks: траектории пакета - словари с ключами как у BinProtocol (trackId, range, azimuth, ...)
+        :param timestamp: время получения пакета в секундах. По умолчанию текущее время
+        :return:
+        """
+        if timestamp is None:
+            timestamp = TimeUtil.get_current_time()
+        with self.__lock:
+            for track in tracks:
+                trackId = track['trackId']
+                history = self.__tracks.get(trackId)
+                if history is None:
+                    history = self.__tracks[trackId] = TrackHistory(self.capacityPerTrack)
+                    if len(self.__tracks) > self.maxTracks:
+                        self.__tracks.popitem(last=False)
+                else:
+                    self.__tracks.move_to_end(trackId)
+                history.append(timestamp, track)
+
+    def last(self, trackId, count):
+        """
+        Метод для получения последних точек траектории
+        :param trackId: номер траектории
+        :param count: кол-во точек
+        :return: points | list - точки от старой к новой, пустой список для неизвестной траектории
+        """
+        with self.__lock:
+            history = self.__tracks.get(trackId)
+            return history.last(count) if history is not None else []
+
+    def between(self, trackId, startTime, endTime):
+        """
+        Метод для получения точек траектории, полученных в интервале времени [startTime, endTime]
+        :param trackId: номер траектории
+        :param startTime: начало интервала в секундах
+        :param endTime: конец интервала в секундах
+        :return: points | list - точки от старой к новой, пустой список для неизвестной траектории
+        """
+        with self.__lock:
+            history = self.__tracks.get(trackId)
+            return history.between(startTime, endTime) if history is not None else []
+
+    def getTrackIds(self):
+        """
+        Метод для получения номеров траекторий, для которых есть история
+        :return: trackIds | list
+        """
+        with self.__lock:
+            return list(self.__tracks)
+
+    def clear(self):
+        with self.__lock:
+            self.__tracks.clear()
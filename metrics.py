@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+"""
+Модуль метрик клиента API Umirs: счётчики, гистограммы и измерители текущих значений. Метрики доступны снимком
+(MetricsRegistry.snapshot) и в текстовом формате Prometheus по HTTP на локальном порту (startHttpServer).
+Набор метрик клиента собран в UmirsMetrics, экземпляр которого передаётся в BinProtocol, Client, AsyncClient и
+EventsDispatcher параметром metrics. Если параметр не задан, метрики не собираются
+"""
+import time
+import logging
+import threading
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import codec
+
+
+logging.getLogger()
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# границы корзин гистограмм времени в секундах: от 5 мкс до 1 с
+TIME_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Counter:
+    """
+    Счётчик, значение которого только увеличивается. Значение может вычисляться функцией при каждом чтении, если
+    счётчик ведётся другим объектом (например кол-во отброшенных пакетов менеджера пакетов)
+    """
+    def __init__(self):
+        self.__value = 0
+        self.__function = None
+        self.__lock = threading.Lock()
+
+    @property
+    def value(self):
+        if self.__function is not None:
+            return self.__function()
+        return self.__value
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.__value += amount
+
+    def setFunction(self, function):
+        """
+        :param function: функция без параметров, которая возвращает текущее значение счётчика
+        :return:
+        """
+        self.__function = function
+
+
+class Gauge:
+    """
+    Измеритель текущего значения. Значение задаётся методом set или вычисляется функцией при каждом чтении
+    """
+    def __init__(self):
+        self.__value = 0
+        self.__function = None
+
+    @property
+    def value(self):
+        if self.__function is not None:
+            return self.__function()
+        return self.__value
+
+    def set(self, value):
+        self.__value = value
+
+    def setFunction(self, function):
+        """
+        :param function: функция без параметров, которая возвращает текущее значение
+        :return:
+        """
+        self.__function = function
+
+
+class Histogram:
+    """
+    Гистограмма значений с фиксированными границами корзин. Кол-во значений хранится по корзинам без накопления,
+    накопленные значения (как в формате Prometheus) считаются только при чтении
+    """
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # последняя корзина - значения больше последней границы
+        self.sum = 0.0
+        self.count = 0
+        self.__lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.__lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @property
+    def value(self):
+        """
+        :return: value | dict - кол-во значений, сумма и накопленное кол-во значений по верхним границам корзин
+        """
+        with self.__lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = {}
+        accumulated = 0
+        for bound, bucketCount in zip(self.buckets + (float('inf'),), counts):
+            accumulated += bucketCount
+            cumulative[_formatValue(bound)] = accumulated
+        return {'count': count, 'sum': total, 'buckets': cumulative}
+
+
+_METRIC_CLASSES = {COUNTER: Counter, GAUGE: Gauge, HISTOGRAM: Histogram}
+
+
+class MetricFamily:
+    """
+    Метрика с набором меток. Для каждого набора значений меток создаётся своё значение (Counter, Gauge или Histogram)
+    """
+    def __init__(self, name, documentation, metricType, labelNames=(), **params):
+        self.name = name
+        self.documentation = documentation
+        self.type = metricType
+        self.labelNames = tuple(labelNames)
+        self.__params = params
+        self.__children = {}
+        self.__lock = threading.Lock()
+
+    def labels(self, *labelValues):
+        """
+        Метод получения значения метрики для набора значений меток. Значение стоит сохранить и использовать повторно,
+        чтобы не искать его на каждом обновлении
+        :param labelValues: значения меток в порядке labelNames
+        :return: metric | Counter | Gauge | Histogram
+        """
+        labelValues = tuple(str(value) for value in labelValues)
+        if len(labelValues) != len(self.labelNames):
+            raise ValueError(f'Metric {self.name} expects labels {self.labelNames}')
+        child = self.__children.get(labelValues)
+        if child is None:
+            with self.__lock:
+                child = self.__children.get(labelValues)
+                if child is None:
+                    child = self.__children[labelValues] = _METRIC_CLASSES[self.type](**self.__params)
+        return child
+
+    def remove(self, *labelValues):
+        with self.__lock:
+            self.__children.pop(tuple(str(value) for value in labelValues), None)
+
+    def collect(self):
+        """
+        :return: samples | list - пары (метки, значение)
+        """
+        with self.__lock:
+            children = list(self.__children.items())
+        return [(dict(zip(self.labelNames, labelValues)), child.value) for labelValues, child in children]
+
+
+class MetricsRegistry:
+    """
+    Реестр метрик. Метрика с одним именем создаётся один раз, повторный запрос возвращает уже созданную метрику,
+    поэтому несколько клиентов могут использовать один реестр, различаясь значениями меток
+    """
+    def __init__(self):
+        self.__families = {}
+        self.__collectCallbacks = []
+        self.__lock = threading.Lock()
+
+    def onCollect(self, callback):
+        """
+        Метод регистрации функции, которая вызывается перед каждым чтением метрик, например чтобы зарегистрировать
+        значения меток, появившиеся после создания метрики
+        :param callback: функция без параметров
+        :return:
+        """
+        with self.__lock:
+            self.__collectCallbacks.append(callback)
+
+    def __getCollected(self):
+        with self.__lock:
+            callbacks = list(self.__collectCallbacks)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logging.exception('Failed to update metrics before collection')
+        with self.__lock:
+            return list(self.__families.values())
+
+    def counter(self, name, documentation, labelNames=()):
+        return self.__getFamily(name, documentation, COUNTER, labelNames)
+
+    def gauge(self, name, documentation, labelNames=()):
+        return self.__getFamily(name, documentation, GAUGE, labelNames)
+
+    def histogram(self, name, documentation, labelNames=(), buckets=TIME_BUCKETS):
+        return self.__getFamily(name, documentation, HISTOGRAM, labelNames, buckets=buckets)
+
+    def __getFamily(self, name, documentation, metricType, labelNames, **params):
+        with self.__lock:
+            family = self.__families.get(name)
+            if family is None:
+                family = self.__families[name] = MetricFamily(name, documentation, metricType, labelNames, **params)
+            elif family.type != metricType or family.labelNames != tuple(labelNames):
+                raise ValueError(f'Metric {name} is already registered with other type or labels')
+            return family
+
+    def snapshot(self):
+        """
+        Метод получения текущих значений всех метрик
+        :return: snapshot | dict - {имя метрики: {'метка=значение,...': значение}}
+        """
+        families = self.__getCollected()
+        return {family.name: {','.join(f'{name}={value}' for name, value in labels.items()): sample
+                              for labels, sample in family.collect()}
+                for family in families}
+
+    def exposition(self):
+        """
+        Метод формирования текста всех метрик в формате Prometheus
+        :return: text | str
+        """
+        families = self.__getCollected()
+        lines = []
+        for family in families:
+            lines.append(f'# HELP {family.name} {family.documentation}')
+            lines.append(f'# TYPE {family.name} {family.type}')
+            for labels, sample in family.collect():
+                if family.type != HISTOGRAM:
+                    lines.append(f'{family.name}{_formatLabels(labels)} {_formatValue(sample)}')
+                    continue
+                for bound, count in sample['buckets'].items():
+                    lines.append(f'{family.name}_bucket{_formatLabels(dict(labels, le=bound))} {count}')
+                lines.append(f'{family.name}_sum{_formatLabels(labels)} {_formatValue(sample["sum"])}')
+                lines.append(f'{family.name}_count{_formatLabels(labels)} {sample["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _formatLabels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def _formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = MetricsRegistry()  # реестр метрик процесса по умолчанию
+
+_QUEUE_COUNTERS = ('dropped', 'coalesced')  # префиксы накопительных значений словаря getQueuesDepth
+
+
+def _queueSeries(depths):
+    """
+    Функция разбора словаря getQueuesDepth на значения метрик очередей
+    :param depths: словарь {имя очереди: кол-во} или {тип события: {'queued': int, 'dropped': int}}
+    :return: series | list - тройки (вид значения 'depth', 'dropped' или 'coalesced', имя очереди, путь к значению)
+    """
+    series = []
+    for key, depth in depths.items():
+        if isinstance(depth, dict):
+            series.extend(('depth' if field == 'queued' else field, key, (key, field)) for field in depth)
+            continue
+        for prefix in _QUEUE_COUNTERS:
+            if key.startswith(prefix) and len(key) > len(prefix):
+                series.append((prefix, key[len(prefix)].lower() + key[len(prefix) + 1:], (key,)))
+                break
+        else:
+            series.append(('depth', key, (key,)))
+    return series
+
+
+def _queueValue(getQueuesDepth, path):
+    """
+    Функция создания функции чтения одного значения словаря getQueuesDepth при каждом чтении метрики
+    :return: function
+    """
+    def value():
+        depth = getQueuesDepth()
+        for key in path:
+            depth = depth[key]
+        return depth
+    return value
+
+
+class UmirsMetrics:
+    """
+    Набор метрик одного подключения к серверу API Umirs. Все метрики имеют метку server, поэтому метрики нескольких
+    подключений можно хранить в одном реестре
+    """
+    def __init__(self, registry=REGISTRY, server=''):
+        """
+        :param registry: реестр метрик
+        :param server: значение метки server, например 'host:port' или Id сервера
+        """
+        self.registry = registry
+        self.server = str(server)
+        self.__framesReceived = registry.counter('umirs_frames_received_total', 'Frames received by command',
+                                                 ('server', 'command'))
+        self.__bytesReceived = registry.counter('umirs_bytes_received_total', 'Bytes of frames received by command',
+                                                ('server', 'command'))
+        self.__received = {}  # номер команды -> (счётчик пакетов, счётчик байт), чтобы не искать их на каждом пакете
+        self.framesSent = registry.counter('umirs_frames_sent_total', 'Packets or batches of packets sent to server',
+                                           ('server',)).labels(self.server)
+        self.bytesSent = registry.counter('umirs_bytes_sent_total', 'Bytes sent to server',
+                                          ('server',)).labels(self.server)
+        self.decodeErrors = registry.counter('umirs_decode_errors_total', 'Frames which failed to decode',
+                                             ('server',)).labels(self.server)
+        self.resyncs = registry.counter('umirs_resyncs_total', 'Invalid frame lengths which dropped buffered data',
+                                        ('server',)).labels(self.server)
+        self.resyncBytes = registry.counter('umirs_resync_bytes_total', 'Bytes dropped on resync',
+                                            ('server',)).labels(self.server)
+        self.decodeTime = registry.histogram('umirs_frame_decode_seconds', 'Time to parse one frame',
+                                             ('server',)).labels(self.server)
+        self.dispatchLatency = registry.histogram('umirs_event_dispatch_seconds',
+                                                  'Time from event enqueue to handler start',
+                                                  ('server',)).labels(self.server)
+        self.connects = registry.counter('umirs_connects_total', 'Successful connections to server',
+                                         ('server',)).labels(self.server)
+        self.disconnects = registry.counter('umirs_disconnects_total', 'Closed connections to server',
+                                            ('server',)).labels(self.server)
+        self.connectionUp = registry.gauge('umirs_connection_up_seconds', 'Duration of current connection',
+                                           ('server',)).labels(self.server)
+        self.connectionUp.setFunction(self.getConnectionUpTime)
+        self.__queueDepth = registry.gauge('umirs_queue_depth', 'Packets in queue', ('server', 'queue'))
+        self.__queueCounters = {
+            'dropped': registry.counter('umirs_queue_dropped_total', 'Packets dropped on full queue',
+                                        ('server', 'queue')),
+            'coalesced': registry.counter('umirs_queue_coalesced_total', 'Queued packets replaced by newer ones',
+                                          ('server', 'queue')),
+        }
+        self.__networkErrors = registry.gauge('umirs_network_errors',
+                                              'Failed or empty socket operations, decreased by received data',
+                                              ('server',))
+        self.__connectedSince = None
+
+    def frameReceived(self, code, size):
+        counters = self.__received.get(code)
+        if counters is None:
+            spec = codec.COMMANDS.get(code)
+            command = spec.name if spec is not None else f'0x{code:02x}'
+            counters = self.__received[code] = (self.__framesReceived.labels(self.server, command),
+                                                self.__bytesReceived.labels(self.server, command))
+        framesCounter, bytesCounter = counters
+        framesCounter.inc()
+        bytesCounter.inc(size)
+
+    def packetsSent(self, packets):
+        self.framesSent.inc(len(packets))
+        self.bytesSent.inc(sum(len(packet) for packet in packets))
+
+    def resync(self, droppedBytes):
+        self.resyncs.inc()
+        self.resyncBytes.inc(droppedBytes)
+
+    def connected(self):
+        self.connects.inc()
+        self.__connectedSince = time.monotonic()
+
+    def disconnected(self):
+        if self.__connectedSince is not None:
+            self.disconnects.inc()
+        self.__connectedSince = None
+
+    def getConnectionUpTime(self):
+        if self.__connectedSince is None:
+            return 0.0
+        return time.monotonic() - self.__connectedSince
+
+    def watchQueues(self, getQueuesDepth):
+        """
+        Метод регистрации глубины очередей менеджера пакетов или EventsDispatcher. Накопительные значения словаря
+        менеджера пакетов (ключи вида droppedIncoming, coalescedOutcoming) регистрируются счётчиками
+        umirs_queue_dropped_total и umirs_queue_coalesced_total с меткой очереди, остальные - глубиной очереди
+        umirs_queue_depth. Вложенные словари EventsDispatcher {тип события: {'queued': int, 'dropped': int}}
+        регистрируются глубиной и счётчиком отброшенных событий с типом события в метке очереди. Очереди, которые
+        появились позже (например события нового типа), регистрируются при очередном чтении метрик
+        :param getQueuesDepth: метод getQueuesDepth, который возвращает словарь {имя очереди: кол-во}
+        :return:
+        """
+        registered = set()
+
+        def register():
+            for kind, queue, path in _queueSeries(getQueuesDepth()):
+                family = self.__queueDepth if kind == 'depth' else self.__queueCounters.get(kind)
+                if family is None or path in registered:
+                    continue
+                family.labels(self.server, queue).setFunction(_queueValue(getQueuesDepth, path))
+                registered.add(path)
+
+        register()
+        self.registry.onCollect(register)
+
+    def watchNetworkErrors(self, getErrorCount):
+        self.__networkErrors.labels(self.server).setFunction(getErrorCount)
+
+    def snapshot(self):
+        return self.registry.snapshot()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f'Metrics request: {format % args}')
+
+
+def startHttpServer(port, host='127.0.0.1', registry=REGISTRY):
+    """
+    Функция запуска HTTP сервера метрик в формате Prometheus в отдельном потоке. Метрики доступны по пути /metrics
+    :param port: порт. 0 - выбрать свободный порт (см. server.server_address)
+    :param host: адрес. По умолчанию только локальный
+    :return: server | ThreadingHTTPServer - для остановки вызвать server.shutdown()
+    """
+    handler = type('MetricsRequestHandler', (_MetricsRequestHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='UmirsMetricsHttp', daemon=True).start()
+    logging.info(f'Metrics are available on http://{host}:{server.server_address[1]}/metrics')
+    return server
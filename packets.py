@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+
+from collections import deque
+
+import codec
+
+from utils import LogSummary
+
+
+logging.getLogger()
+
+# метка в очереди входящих пакетов: перед следующей частью данных потеряна часть потока, буфер неполных пакетов
+# протокола нужно очистить
+_RESYNC = object()
+
+
+class OutcomingQueue:
+    """
+    Очередь исходящих пакетов с классами приоритета. Пакеты выдаются по классам приоритета команд
+    (CommandSpec.priority): сначала управление PTZ и захватом, затем настройки, затем пинг, а внутри класса - в порядке
+    добавления. Команда, для которой в описании задан признак coalesce, заменяет ещё не отправленную команду того же
+    типа и с теми же значениями полей coalesce на её месте в очереди, поэтому из серии команд PTZ отправляется только
+    последняя. Пачки из нескольких пакетов (BinProtocol.encodeCommands) не заменяются и получают приоритет самой
+    срочной команды пачки. Для пакета можно задать функцию onDrop, которая будет вызвана, если пакет удалён из очереди
+    без отправки (переполнение, замена более новой командой, очистка очереди). Функции не вызываются внутри очереди, а
+    накапливаются до вызова takeDropped, чтобы их можно было вызвать без блокировки менеджера. Интерфейс совпадает с
+    deque, который использовался раньше. Не потокобезопасна
+    """
+    def __init__(self, maxSize=256):
+        """
+        :param maxSize: максимальное кол-во пакетов. При переполнении отбрасывается самый старый пакет самого
+        низкого приоритета
+        """
+        self.maxSize = maxSize
+        self.coalesced = 0  # кол-во пакетов, заменённых более новыми
+        self.__queues = tuple(deque() for _ in codec.PRIORITIES)
+        self.__pending = {}  # ключ замены -> запись очереди [пакет, ключ, onDrop]
+        self.__dropped = []  # функции onDrop удалённых без отправки пакетов
+        self.__size = 0
+
+    def __len__(self):
+        return self.__size
+
+    def append(self, packet, coalesce=True, onDrop=None):
+        """
+        Метод добавления пакета
+        :param packet:
+        :param coalesce: разрешить замену ещё не отправленной команды того же типа
+        :param onDrop: функция без параметров, которая вызывается, если пакет удалён из очереди без отправки
+        :return: dropped | bool - был ли отброшен старый пакет из-за переполнения
+        """
+        priority, key = self.__classify(packet, coalesce)
+        if key is not None:
+            entry = self.__pending.get(key)
+            if entry is not None:
+                if entry[2] is not None:
+                    self.__dropped.append(entry[2])
+                entry[0] = packet
+                entry[2] = onDrop
+                self.coalesced += 1
+                return False
+        dropped = self.__size >= self.maxSize
+        if dropped:
+            self.__dropOldest()
+        entry = [packet, key, onDrop]
+        self.__queues[priority].append(entry)
+        self.__size += 1
+        if key is not None:
+            self.__pending[key] = entry
+        return dropped
+
+    def popleft(self):
+        """
+        Метод получения самого срочного пакета
+        :return: packet
+        """
+        for queue in self.__queues:
+            if queue:
+                return self.__remove(queue)
+        raise IndexError('pop from an empty queue')
+
+    def clear(self):
+        for queue in self.__queues:
+            self.__dropped.extend(entry[2] for entry in queue if entry[2] is not None)
+            queue.clear()
+        self.__pending.clear()
+        self.__size = 0
+
+    def takeDropped(self):
+        """
+        Метод получения функций onDrop пакетов, удалённых без отправки после предыдущего вызова
+        :return: callbacks | list
+        """
+        dropped, self.__dropped = self.__dropped, []
+        return dropped
+
+    def __dropOldest(self):
+        for queue in reversed(self.__queues):
+            if queue:
+                onDrop = queue[0][2]
+                self.__remove(queue)
+                if onDrop is not None:
+                    self.__dropped.append(onDrop)
+                return
+
+    def __remove(self, queue):
+        packet, key, _ = queue.popleft()
+        if key is not None:
+            del self.__pending[key]
+        self.__size -= 1
+        return packet
+
+    @staticmethod
+    def __classify(packet, coalesce):
+        """
+        Метод определения класса приоритета и ключа замены пакета
+        :return: (priority, key | tuple | None)
+        """
+        if len(packet) < codec.HEADER_LENGTH:
+            return codec.PRIORITY_CONFIG, None
+        if (packet[1] << 8 | packet[2]) != len(packet):
+            # пачка пакетов: приоритет самой срочной команды
+            priority = codec.PRIORITY_KEEPALIVE
+            offset = 0
+            while offset + codec.HEADER_LENGTH <= len(packet):
+                spec = codec.COMMANDS.get(packet[offset + 6])
+                priority = min(priority, spec.priority if spec is not None else codec.PRIORITY_CONFIG)
+                size = packet[offset + 1] << 8 | packet[offset + 2]
+                if not size:
+                    break
+                offset += size
+            return priority, None
+        spec = codec.COMMANDS.get(packet[6])
+        if spec is None:
+            return codec.PRIORITY_CONFIG, None
+        if not coalesce or spec.coalesce is None:
+            return spec.priority, None
+        if not spec.coalesce:
+            return spec.priority, (spec.code,)
+        values = spec.unpack(packet)
+        return spec.priority, (spec.code,) + tuple(values[name] for name in spec.coalesce)
+
+
+class PacketsManager:
+    """
+    Менеджер входящих и исходящих пакетов для Client и BinProtocol. Очереди ограничены по размеру, поэтому память не
+    растёт, если потребитель не успевает обрабатывать пакеты. Входящие пакеты - части потока данных из сокета, а не
+    целые пакеты протокола, поэтому при переполнении отбрасывается новая часть, а перед следующей частью протокол
+    очищает буфер неполных пакетов (BinProtocol.resetFramesBuffer), чтобы не склеить данные по разные стороны разрыва.
+    Исходящие пакеты выдаются по приоритету команд, а устаревшие команды PTZ и захвата заменяются новыми (см.
+    OutcomingQueue). Получение пакета может блокироваться до его появления в очереди (параметр timeout), что
+    позволяет потоку декодирования просыпаться сразу после получения данных из сокета
+    """
+    blockingGet = True  # признак для BinProtocol, что getIncomingPacket поддерживает ожидание с timeout
+    coalescing = True  # признак для BinProtocol, что addOutcomingPacket принимает параметр coalesce
+    dropCallbacks = True  # признак для BinProtocol, что addOutcomingPacket принимает параметр onDrop
+
+    def __init__(self, protocol=None, maxIncoming=1024, maxOutcoming=256):
+        """
+        :param protocol: ссылка на бинарный протокол, потоками которого управляет менеджер
+        :type protocol: BinProtocol
+        :param maxIncoming: максимальное кол-во пакетов в очереди входящих пакетов
+        :param maxOutcoming: максимальное кол-во пакетов в очереди исходящих пакетов
+        """
+        self.protocol = protocol
+        self.maxIncoming = maxIncoming
+        self.__incoming = deque()
+        self.__incomingGap = False  # признак того, что после последней части в очереди часть потока отброшена
+        self.__outcoming = OutcomingQueue(maxOutcoming)
+        self.__incomingReady = threading.Condition()
+        self.__outcomingReady = threading.Condition()
+        self.__helloPacket = None
+        self.__droppedIncoming = 0  # кол-во отброшенных из-за переполнения входящих пакетов
+        self.__droppedOutcoming = 0  # кол-во отброшенных из-за переполнения исходящих пакетов
+        self.__interrupted = False  # флаг для прерывания ожидания пакетов при остановке потоков
+        self.__logSummary = LogSummary('Umirs packets manager')  # сводка отброшенных при переполнении пакетов
+
+    def setProtocol(self, protocol):
+        self.protocol = protocol
+
+    def addIncomingPacket(self, packet):
+        """
+        Метод добавления пакета, полученного из сокета, в очередь входящих пакетов
+        :param packet:
+        :return:
+        """
+        with self.__incomingReady:
+            if len(self.__incoming) >= self.maxIncoming:
+                # часть из середины потока удалять нельзя, поэтому отбрасывается новая часть
+                self.__droppedIncoming += 1
+                self.__logSummary.count('incoming packets dropped on full queue')
+                self.__incomingGap = True
+                return
+            if self.__incomingGap:
+                self.__incomingGap = False
+                self.__incoming.append(_RESYNC)
+            self.__incoming.append(packet)
+            self.__incomingReady.notify()
+
+    def getIncomingPacket(self, timeout=0):
+        """
+        Метод получения пакета из очереди входящих пакетов. Если перед пакетом часть потока была отброшена, то перед
+        возвратом пакета очищается буфер неполных пакетов протокола
+        :param timeout: время ожидания пакета в секундах. 0 - не ждать, None - ждать без ограничения
+        :return: packet | None, если за время ожидания пакет не появился
+        """
+        with self.__incomingReady:
+            packet = self.__get(self.__incoming, self.__incomingReady, timeout)
+            resync = packet is _RESYNC
+            if resync:
+                # метка добавляется в очередь только вместе со следующей частью данных
+                packet = self.__incoming.popleft()
+        if resync and self.protocol is not None:
+            logging.warning('Incoming data was dropped on full queue, frames buffer is reset')
+            self.protocol.resetFramesBuffer()
+        return packet
+
+    def addOutcomingPacket(self, packet, coalesce=True, onDrop=None):
+        """
+        Метод добавления пакета в очередь исходящих пакетов
+        :param packet:
+        :param coalesce: разрешить замену ещё не отправленной команды того же типа этим пакетом. BinProtocol.request
+        запрещает замену, так как каждая команда ожидает собственного ответа
+        :param onDrop: функция без параметров, которая вызывается, если пакет удалён из очереди без отправки
+        :return:
+        """
+        if packet is None:
+            return
+        with self.__outcomingReady:
+            if self.__outcoming.append(packet, coalesce, onDrop):
+                self.__droppedOutcoming += 1
+                self.__logSummary.count('outcoming packets dropped on full queue')
+            dropped = self.__outcoming.takeDropped()
+            self.__outcomingReady.notify()
+        self.__notifyDropped(dropped)
+
+    def getOutComingPacket(self, timeout=0):
+        """
+        Метод получения пакета из очереди исходящих пакетов
+        :param timeout: время ожидания пакета в секундах. 0 - не ждать, None - ждать без ограничения
+        :return: packet | None, если за время ожидания пакет не появился
+        """
+        return self.__get(self.__outcoming, self.__outcomingReady, timeout)
+
+    def setHelloPacket(self, packet):
+        self.__helloPacket = packet
+
+    def getHelloPacket(self):
+        return self.__helloPacket
+
+    def clearQueuesOfPackets(self):
+        """
+        Метод очистки очередей входящих и исходящих пакетов
+        :return:
+        """
+        with self.__incomingReady:
+            self.__incoming.clear()
+            self.__incomingGap = False
+        with self.__outcomingReady:
+            self.__outcoming.clear()
+            dropped = self.__outcoming.takeDropped()
+        self.__notifyDropped(dropped)
+
+    def getIncomingLength(self):
+        """
+        Метод для получения кол-ва частей данных в очереди входящих пакетов. Вызывается Client на каждый приём данных,
+        поэтому, в отличие от getQueuesDepth, не создаёт словарь
+        :return: length | int
+        """
+        return len(self.__incoming)
+
+    def getQueuesDepth(self):
+        """
+        Метод для получения текущего кол-ва пакетов в очередях, кол-ва отброшенных при переполнении пакетов и кол-ва
+        исходящих пакетов, заменённых более новыми
+        :return: depth | dict
+        """
+        return {
+            'incoming': len(self.__incoming),
+            'outcoming': len(self.__outcoming),
+            'droppedIncoming': self.__droppedIncoming,
+            'droppedOutcoming': self.__droppedOutcoming,
+            'coalescedOutcoming': self.__outcoming.coalesced,
+        }
+
+    def startThreads(self):
+        """
+        Метод запуска пинга сервера и потока декодирования входящих пакетов протокола
+        :return:
+        """
+        self.__interrupted = False
+        self.protocol.turnOnFlagForThreads()
+        self.protocol.startPing()
+        self.protocol.startDecodePacketsThread()
+
+    @staticmethod
+    def __notifyDropped(dropped):
+        for onDrop in dropped:
+            try:
+                onDrop()
+            except Exception:
+                logging.exception('Failed to notify about dropped outcoming packet')
+
+    def stopThreads(self):
+        """
+        Метод остановки пинга сервера и потока декодирования протокола
+        :return:
+        """
+        self.protocol.stopPing()
+        self.protocol.failPendingReplies()
+        self.protocol.turnOffFlagForThreads()
+        # разбудим потоки, которые ожидают пакеты, чтобы они проверили флаг и завершились
+        self.__interrupted = True
+        with self.__incomingReady:
+            self.__incomingReady.notify_all()
+        with self.__outcomingReady:
+            self.__outcomingReady.notify_all()
+
+    def startPingThread(self):
+        """
+        Метод перезапуска пинга сервера
+        :return:
+        """
+        self.protocol.startPing()
+
+    def __get(self, queue, ready, timeout):
+        with ready:
+            if not queue and timeout != 0:
+                ready.wait_for(lambda: queue or self.__interrupted, timeout)
+            if queue:
+                return queue.popleft()
+            return None
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+Модуль параллельного декодирования пакетов траекторий 0x0A в пуле процессов. Предназначен для случая, когда один
+процесс принимает данные от многих серверов API Umirs и декодирование траекторий под одним GIL загружает одно ядро.
+Целые пакеты копируются в кольцевой буфер в разделяемой памяти (multiprocessing.shared_memory), а процессам по
+каналу (pipe) передаются только номера частей буфера и длины пакетов. Результат декодирования процесс записывает в
+такую же часть выходного буфера. Результаты каждого подключения (канала) возвращаются в порядке отправки пакетов.
+Процессы запускаются при создании первого канала (или явно методом start либо в блоке with).
+Пример: decoder = ParallelDecoder(workers=4); BinProtocol(..., parallelDecoder=decoder); ...; decoder.close()
+"""
+import pickle
+import logging
+import threading
+import multiprocessing
+
+from array import array
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+import codec
+
+from protocol import decodeTrajectoriesDict, decodeTrajectoriesArray, np
+
+if np is not None:
+    from protocol import TRAJECTORY_DTYPE
+
+
+logging.getLogger()
+
+# состояние результата пакета: в часть выходного буфера записан результат или текст ошибки
+_DECODED = 0
+_FAILED = 1
+
+
+def _decodeWorker(inputName, outputName, slotSize, resultSlotSize, trajectoriesAsArray, tasks, results):
+    """
+    Функция процесса декодирования. Получает пачки пар (часть буфера, длина пакета), декодирует пакеты и возвращает
+    пачку троек (часть буфера, длина результата, состояние). Пачки передаются байтами array('I'). Массив траекторий
+    записывается байтами массива, словарь - pickle. Пустая пачка - команда завершения процесса
+    """
+    # процессы пула используют resource_tracker родительского процесса, поэтому повторная регистрация памяти при
+    # подключении ничего не меняет, а удаляет память родительский процесс в close
+    inputMemory = shared_memory.SharedMemory(inputName)
+    outputMemory = shared_memory.SharedMemory(outputName)
+    try:
+        with memoryview(inputMemory.buf) as inputView, memoryview(outputMemory.buf) as outputView:
+            while True:
+                batch = array('I', tasks.recv_bytes())
+                if not batch:
+                    break
+                done = array('I')
+                for index in range(0, len(batch), 2):
+                    slot, length = batch[index], batch[index + 1]
+                    start = slot * slotSize
+                    status = _DECODED
+                    with inputView[start:start + length] as packet:
+                        try:
+                            if trajectoriesAsArray:
+                                result = decodeTrajectoriesArray(packet, packet[9]).tobytes()
+                            else:
+                                result = pickle.dumps(decodeTrajectoriesDict(packet, packet[9]),
+                                                      pickle.HIGHEST_PROTOCOL)
+                            if len(result) > resultSlotSize:
+                                raise ValueError(f'Result of {len(result)} bytes does not fit into result slot')
+                        except Exception as e:
+                            result = repr(e).encode('utf-8')[:resultSlotSize]
+                            status = _FAILED
+                    start = slot * resultSlotSize
+                    outputView[start:start + len(result)] = result
+                    done.extend((slot, len(result), status))
+                results.send_bytes(done)
+    finally:
+        inputMemory.close()
+        outputMemory.close()
+
+
+class DecoderChannel:
+    """
+    Канал одного подключения: нумерует отправленные пакеты и передаёт результаты в callback строго по порядку
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.submitted = 0  # номер следующего отправленного пакета
+        self.__delivered = 0  # номер следующего результата, который нужно передать в callback
+        self.__pending = {}  # результаты, полученные раньше результатов предыдущих пакетов
+
+    def deliver(self, number, result, failed=False):
+        """
+        Метод получения результата пакета с номером number. Выполняется только в потоке сбора результатов
+        :return:
+        """
+        self.__pending[number] = (result, failed)
+        while self.__delivered in self.__pending:
+            result, failed = self.__pending.pop(self.__delivered)
+            self.__delivered += 1
+            if failed:
+                logging.error(f'Failed to decode trajectories packet in worker process: {result}')
+                continue
+            try:
+                self.callback(result)
+            except Exception:
+                logging.exception('Failed to handle decoded trajectories')
+
+
+class ParallelDecoder:
+    """
+    Пул процессов декодирования пакетов траекторий 0x0A, общий для нескольких BinProtocol. Результаты передаются в
+    callback каналов из одного потока сбора результатов
+    """
+    def __init__(self, workers=None, slots=1024, batchSize=16, trajectoriesAsArray=False, resultSlotSize=8192,
+                 context=None):
+        """
+        :param workers: кол-во процессов декодирования. По умолчанию - кол-во ядер
+        :param slots: кол-во частей кольцевого буфера, т.е. максимальное кол-во пакетов в обработке
+        :param batchSize: кол-во пакетов, номера которых передаются процессу одним сообщением
+        :param trajectoriesAsArray: декодировать траектории в массив numpy (см. BinProtocol)
+        :param resultSlotSize: размер части выходного буфера для результата одного пакета в байтах
+        :param context: контекст multiprocessing, например multiprocessing.get_context('spawn')
+        """
+        self.workers = workers or multiprocessing.cpu_count()
+        self.slots = slots
+        self.batchSize = batchSize
+        if trajectoriesAsArray and np is None:
+            raise ImportError('numpy is required for trajectoriesAsArray mode')
+        self.trajectoriesAsArray = trajectoriesAsArray
+        self.slotSize = codec.MAX_PACKET_LENGTH
+        self.resultSlotSize = resultSlotSize
+        self.__context = context or multiprocessing.get_context()
+        self.__input = None
+        self.__output = None
+        self.__processes = []
+        self.__tasks = []  # каналы передачи пачек процессам
+        self.__results = []  # каналы получения результатов от процессов
+        self.__collector = None
+        self.__startLock = threading.Lock()
+        # простая блокировка вместо RLock по умолчанию: submit вызывается на каждый пакет
+        self.__ready = threading.Condition(threading.Lock())
+        self.__freeSlots = list(range(slots - 1, -1, -1))
+        self.__slotOwners = [None] * slots  # часть буфера -> (канал, номер пакета в канале)
+        self.__slotWorkers = [None] * slots  # часть буфера -> номер процесса, которому она передана
+        self.__batch = array('I')
+        self.__alive = []  # номера работающих процессов
+        self.__nextWorker = 0
+        self.__closing = False
+        self.__inputView = None
+        self.__outputView = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        """
+        Метод создания разделяемой памяти и запуска процессов декодирования
+        :return:
+        """
+        with self.__startLock:
+            if not self.__processes:
+                self.__start()
+
+    def __start(self):
+        self.__closing = False
+        self.__input = shared_memory.SharedMemory(create=True, size=self.slots * self.slotSize)
+        self.__output = shared_memory.SharedMemory(create=True, size=self.slots * self.resultSlotSize)
+        self.__inputView = memoryview(self.__input.buf)
+        self.__outputView = memoryview(self.__output.buf)
+        for index in range(self.workers):
+            tasksReader, tasksWriter = self.__context.Pipe(duplex=False)
+            resultsReader, resultsWriter = self.__context.Pipe(duplex=False)
+            process = self.__context.Process(
+                target=_decodeWorker, name=f'UmirsDecoder-{index}', daemon=True,
+                args=(self.__input.name, self.__output.name, self.slotSize, self.resultSlotSize,
+                      self.trajectoriesAsArray, tasksReader, resultsWriter))
+            process.start()
+            # концы каналов процесса закрываются в основном процессе, чтобы после завершения процесса поток сбора
+            # результатов получил EOFError
+            tasksReader.close()
+            resultsWriter.close()
+            self.__tasks.append(tasksWriter)
+            self.__results.append(resultsReader)
+            self.__processes.append(process)
+        self.__alive = list(range(self.workers))
+        self.__nextWorker = 0
+        self.__collector = threading.Thread(target=self.__collectResults, name='UmirsDecoderResults', daemon=True)
+        self.__collector.start()
+        logging.info(f'Parallel decoder is started with {self.workers} worker processes')
+
+    def openChannel(self, callback):
+        """
+        Метод создания канала для одного подключения. Запускает процессы декодирования, если они ещё не запущены
+        :param callback: функция, которая получает результат декодирования каждого пакета канала по порядку
+        :return: channel | DecoderChannel
+        """
+        self.start()
+        return DecoderChannel(callback)
+
+    def submit(self, channel, packet):
+        """
+        Метод передачи пакета траекторий на декодирование. Пакет копируется в разделяемую память, поэтому после
+        возврата из метода буфер пакета можно использовать повторно. Если все части буфера заняты, метод ждёт
+        освобождения части. Если все процессы декодирования завершились аварийно, вызывает RuntimeError
+        :param channel: канал подключения
+        :param packet: целый пакет 0x0A
+        :return:
+        """
+        if self.__inputView is None:
+            self.start()
+        length = len(packet)
+        with self.__ready:
+            if not self.__freeSlots:
+                # процессы не получат пакеты, пока накопленная пачка не отправлена
+                self.__flushBatch()
+                # части буфера освобождаются и при аварийном завершении процесса, которому они переданы
+                self.__ready.wait_for(lambda: self.__freeSlots or not self.__alive)
+            if not self.__alive:
+                raise RuntimeError('All decoder worker processes have exited')
+            slot = self.__freeSlots.pop()
+            start = slot * self.slotSize
+            self.__inputView[start:start + length] = packet
+            self.__slotOwners[slot] = (channel, channel.submitted)
+            channel.submitted += 1
+            self.__batch.append(slot)
+            self.__batch.append(length)
+            if len(self.__batch) >= 2 * self.batchSize:
+                self.__flushBatch()
+
+    def flush(self):
+        """
+        Метод отправки процессам накопленной пачки пакетов, не дожидаясь её заполнения. BinProtocol вызывает его
+        после декодирования каждой части данных из сокета
+        :return:
+        """
+        if not self.__batch:
+            return
+        with self.__ready:
+            self.__flushBatch()
+
+    def __flushBatch(self):
+        if not self.__batch:
+            return
+        while self.__alive:
+            self.__nextWorker %= len(self.__alive)
+            worker = self.__alive[self.__nextWorker]
+            try:
+                self.__tasks[worker].send_bytes(self.__batch)
+            except OSError:
+                # процесс завершился, но поток сбора результатов ещё не получил EOFError
+                logging.error(f'Decoder worker process {worker} is not available')
+                self.__alive.remove(worker)
+                continue
+            for slot in self.__batch[::2]:
+                self.__slotWorkers[slot] = worker
+            self.__nextWorker += 1
+            self.__batch = array('I')
+            return
+        raise RuntimeError('All decoder worker processes have exited')
+
+    def __collectResults(self):
+        """
+        Метод потока сбора результатов процессов декодирования. Завершается, когда все процессы закрыли свои каналы
+        :return:
+        """
+        results = list(self.__results)
+        while results:
+            for reader in wait(results):
+                try:
+                    done = array('I', reader.recv_bytes())
+                except EOFError:
+                    results.remove(reader)
+                    self.__workerExited(self.__results.index(reader))
+                    continue
+                for index in range(0, len(done), 3):
+                    slot, length, status = done[index], done[index + 1], done[index + 2]
+                    start = slot * self.resultSlotSize
+                    with self.__outputView[start:start + length] as data:
+                        failed = status == _FAILED
+                        result = bytes(data).decode('utf-8', 'replace') if failed else self.__loadResult(data)
+                    with self.__ready:
+                        channel, number = self.__slotOwners[slot]
+                        self.__slotOwners[slot] = None
+                        self.__slotWorkers[slot] = None
+                        self.__freeSlots.append(slot)
+                        self.__ready.notify()
+                    channel.deliver(number, result, failed)
+
+    def __workerExited(self, worker):
+        """
+        Метод обработки завершения процесса декодирования. Если процесс завершился не по команде close, части буфера
+        с пакетами, переданными процессу, освобождаются, а каналы получают ошибку декодирования этих пакетов, чтобы
+        результаты следующих пакетов канала не ждали их бесконечно
+        :param worker: номер процесса
+        :return:
+        """
+        lost = []
+        with self.__ready:
+            if worker in self.__alive:
+                self.__alive.remove(worker)
+            # у пакетов ещё не отправленной пачки процесс не назначен, они будут отправлены другому процессу
+            for slot, owner in enumerate(self.__slotOwners):
+                if owner is not None and self.__slotWorkers[slot] == worker:
+                    lost.append(owner)
+                    self.__slotOwners[slot] = None
+                    self.__slotWorkers[slot] = None
+                    self.__freeSlots.append(slot)
+            self.__ready.notify_all()
+            closing = self.__closing
+        if closing and not lost:
+            return
+        # EOFError приходит при закрытии канала, процесс может завершиться немного позже
+        self.__processes[worker].join(1.0)
+        exitcode = self.__processes[worker].exitcode
+        logging.error(f'Decoder worker process {worker} has exited with code {exitcode}, '
+                      f'{len(lost)} packets are lost')
+        for channel, number in lost:
+            channel.deliver(number, f'worker process {worker} has exited with code {exitcode}', failed=True)
+
+    def __loadResult(self, data):
+        """
+        Метод восстановления результата процесса. Массив восстанавливается копированием байт без разбора, поэтому в
+        режиме массива основной процесс почти не тратит время на результат. Словари траекторий создаются заново при
+        распаковке pickle, что ограничивает выигрыш от числа процессов в режиме словарей
+        :param data:
+        :return: trajectories | dict | np.ndarray
+        """
+        if self.trajectoriesAsArray:
+            return np.frombuffer(data, dtype=TRAJECTORY_DTYPE).copy()
+        return pickle.loads(data)
+
+    def close(self):
+        """
+        Метод остановки процессов декодирования. Пакеты, уже переданные на декодирование, обрабатываются до конца
+        :return:
+        """
+        if not self.__processes:
+            return
+        self.__closing = True
+        if self.__alive:
+            self.flush()
+        for tasks in self.__tasks:
+            try:
+                tasks.send_bytes(b'')
+            except OSError:
+                pass
+            tasks.close()
+        for process in self.__processes:
+            process.join()
+        self.__collector.join()
+        for results in self.__results:
+            results.close()
+        self.__inputView.release()
+        self.__outputView.release()
+        for memory in (self.__input, self.__output):
+            memory.close()
+            memory.unlink()
+        self.__inputView = None
+        self.__outputView = None
+        self.__processes = []
+        self.__tasks = []
+        self.__results = []
+        self.__alive = []
+        logging.info('Parallel decoder is stopped')
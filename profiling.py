@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Модуль точек профилирования клиента API Umirs. К каждому этапу обработки пакета можно подключить функции, которые
+получают время начала и окончания этапа по time.perf_counter_ns и номер пакета (байт [3] заголовка):
+- RECV - приём данных из сокета (номер пакета не известен, передаётся None);
+- EXTRACT - извлечение пакета из буфера неполных пакетов: от начала декодирования части данных (или окончания
+предыдущего пакета этой части) до получения целого пакета;
+- PARSE - парсинг пакета по номеру команды, включая вызов события;
+- DISPATCH - вызов метода менеджера событий;
+- ENCODE - формирование пакета команды;
+- SEND - отправка пакетов в сокет.
+Функции вызываются для каждого sampleEvery-го пакета. Объект StageHooks передаётся в BinProtocol, Client и
+AsyncClient параметром hooks. Если параметр не задан, этапы не измеряются
+"""
+import time
+import logging
+import threading
+
+
+logging.getLogger()
+
+RECV = 'recv'
+EXTRACT = 'extract'
+PARSE = 'parse'
+DISPATCH = 'dispatch'
+ENCODE = 'encode'
+SEND = 'send'
+STAGES = (RECV, EXTRACT, PARSE, DISPATCH, ENCODE, SEND)
+
+
+class StageHooks:
+    """
+    Набор функций профилирования по этапам. Функция вызывается как callback(stage, seq, command, startNs, endNs),
+    где command - номер команды пакета (None для RECV). Функции вызываются в потоке, выполняющем этап, поэтому должны
+    быть быстрыми: например, добавлять значения в список или гистограмму
+    """
+    def __init__(self, sampleEvery=1):
+        """
+        :param sampleEvery: измеряется каждый sampleEvery-й пакет (для RECV и SEND - каждый sampleEvery-й вызов)
+        """
+        if sampleEvery < 1:
+            raise ValueError('sampleEvery must be positive')
+        self.sampleEvery = sampleEvery
+        self.__callbacks = {stage: () for stage in STAGES}
+        self.__counters = dict.fromkeys(STAGES, 0)
+        self.__local = threading.local()  # номер и команда пакета, который сейчас парсится в текущем потоке
+
+    def register(self, stage, callback):
+        """
+        Метод подключения функции к этапу
+        :param stage: этап, один из STAGES
+        :param callback: функция callback(stage, seq, command, startNs, endNs)
+        :return:
+        """
+        if stage not in self.__callbacks:
+            raise ValueError(f'Unknown stage {stage}')
+        # кортеж заменяется целиком, чтобы потоки, которые сейчас вызывают функции, не видели изменений
+        self.__callbacks[stage] = self.__callbacks[stage] + (callback,)
+
+    def unregister(self, stage, callback):
+        self.__callbacks[stage] = tuple(registered for registered in self.__callbacks[stage]
+                                        if registered is not callback)
+
+    def sample(self, stage):
+        """
+        Метод проверки, нужно ли измерять очередной пакет этапа
+        :param stage:
+        :return: bool
+        """
+        if not self.__callbacks[stage]:
+            return False
+        counter = self.__counters[stage] + 1
+        if counter >= self.sampleEvery:
+            self.__counters[stage] = 0
+            return True
+        self.__counters[stage] = counter
+        return False
+
+    def emit(self, stage, seq, command, startNs, endNs):
+        for callback in self.__callbacks[stage]:
+            try:
+                callback(stage, seq, command, startNs, endNs)
+            except Exception:
+                logging.exception(f'Profiling hook of {stage} stage failed')
+
+    def setCurrentPacket(self, seq, command):
+        """
+        Метод для запоминания пакета, который парсится в текущем потоке, чтобы события этого пакета были измерены
+        как этап DISPATCH. None - пакет не измеряется
+        :return:
+        """
+        self.__local.packet = (seq, command) if seq is not None else None
+
+    def getCurrentPacket(self):
+        return getattr(self.__local, 'packet', None)
+
+
+class HookedEventsManager:
+    """
+    Обёртка над менеджером событий, которая измеряет вызовы событий измеряемых пакетов как этап DISPATCH.
+    BinProtocol оборачивает менеджер событий сам, если задан параметр hooks
+    """
+    def __init__(self, eventsManager, hooks):
+        self.eventsManager = eventsManager
+        self.hooks = hooks
+
+    def __getattr__(self, name):
+        # служебные атрибуты не проксируются, иначе до завершения __init__ возможна бесконечная рекурсия
+        if name.startswith('_') or name in ('eventsManager', 'hooks'):
+            raise AttributeError(name)
+        handler = getattr(self.eventsManager, name)
+        if not callable(handler):
+            return handler
+        hooks = self.hooks
+
+        def dispatch(*args, **kwargs):
+            packet = hooks.getCurrentPacket()
+            if packet is None:
+                return handler(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                hooks.emit(DISPATCH, packet[0], packet[1], start, time.perf_counter_ns())
+        # запомним метод, чтобы следующие вызовы не проходили через __getattr__
+        setattr(self, name, dispatch)
+        return dispatch
+
+
+def emitSent(hooks, packets, startNs, endNs):
+    """
+    Функция вызова функций этапа SEND для каждого пакета, отправленного одним вызовом. Для пачки команд, записанных
+    в один буфер, передаётся номер первого пакета буфера
+    :return:
+    """
+    for packet in packets:
+        if len(packet) > 6:
+            hooks.emit(SEND, packet[3], packet[6], startNs, endNs)
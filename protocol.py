@@ -1,41 +1,207 @@
 import time
 import logging
 
-from threading import Thread
+import codec
+
+from threading import Thread, RLock
 from client import Connection
+# FOR_SERVER, FOR_CLIENT и CLIENT_ID раньше объявлялись в этом модуле и импортируются отсюда внешним кодом
+from codec import FOR_SERVER, FOR_CLIENT, PROTOCOL_VERSION, CLIENT_ID  # noqa: F401
+from profiling import EXTRACT, PARSE, ENCODE, HookedEventsManager
+from replies import PendingReplies
+from timers import getTimerWheel
+from utils import LogSummary, LogUtil
+
+try:
+    import numpy as np
+except ImportError:  # numpy нужен только для режима выдачи траекторий в виде массива
+    np = None
 
 
 logging.getLogger()
 
-FOR_SERVER = 0x00
-FOR_CLIENT = 0x01
-PROTOCOL_VERSION = 0x01  # версия протокола
-CLIENT_ID = 0x01  # согласно протоколу пока все 0x01
+# раскладка одной траектории в пакете 0x0A (13 байт): номер трека, признак захвата, целая и дробная части ЭПР,
+# дальность, азимут (знаковый), радиальная и тангенциальная скорости (знаковые), сектор
+TRACK_STRUCT = codec.TRAJECTORIES.recordLayout
+TRACK_OFFSET = codec.TRAJECTORIES.size  # с 10го байта пакета начинается кодирование траекторий
+# делители дробной части ЭПР: 10 для однозначных, 100 для двузначных и 1000 для трёхзначных значений
+EPR_DIVIDERS = tuple(10 ** len(str(fractionalPart)) for fractionalPart in range(256))
+
+if np is not None:
+    # раскладка траектории в пакете 0x0A для np.frombuffer (big-endian, знаковые поля в доп-м коде)
+    TRACK_DTYPE = np.dtype([('trackId', '>u2'), ('status', 'u1'), ('squareInt', 'u1'), ('squareFractional', 'u1'),
+                            ('range', '>u2'), ('azimuth', 'i1'), ('radSpeed', '>i2'), ('tanSpeed', '>i2'),
+                            ('sector', 'u1')])
+    # структура массива траекторий, который передаётся в eventsManager.discoveredTrajectories в режиме массива
+    TRAJECTORY_DTYPE = np.dtype([('trackId', np.uint16), ('status', np.uint8), ('square', np.float64),
+                                 ('range', np.uint16), ('azimuth', np.float64), ('radSpeed', np.int16),
+                                 ('tanSpeed', np.int16), ('sector', np.uint8)])
+    EPR_DIVIDERS_ARRAY = np.array(EPR_DIVIDERS, dtype=np.float64)
+
+
+# результат парсера для пакета, который отброшен как повреждённый
+_REJECTED = object()
+
+
+def isTrajectoriesLengthValid(packet, trajectoriesCount):
+    """
+    Функция проверки, что в пакете 0x0A помещается указанное в нём кол-во траекторий. Байты после последней
+    траектории допускаются и не декодируются
+    :return: bool
+    """
+    return len(packet) >= TRACK_OFFSET + TRACK_STRUCT.size * trajectoriesCount
+
+
+def checkTrajectoriesLength(packet, trajectoriesCount):
+    """
+    Функция проверки длины пакета 0x0A. Вызывает ValueError, если траектории не помещаются в пакет
+    :return:
+    """
+    if not isTrajectoriesLengthValid(packet, trajectoriesCount):
+        raise ValueError(f'Trajectories packet of {len(packet)} bytes is too short '
+                         f'for {trajectoriesCount} trajectories')
+
+
+def decodeTrajectoriesDict(packet, trajectoriesCount):
+    """
+    Функция декодирования траекторий пакета 0x0A в словарь событий discoveredTrajectories
+    :param packet:
+    :param trajectoriesCount: кол-во траекторий в пакете
+    :return: trajectories | dict - {'track<номер трека>': траектория}
+    """
+    checkTrajectoriesLength(packet, trajectoriesCount)
+    trajectoriesData = {}
+    # каждая траектория закодирована 13ю байтами, начиная с 10го байта пакета
+    tracks = packet[TRACK_OFFSET:TRACK_OFFSET + TRACK_STRUCT.size * trajectoriesCount]
+    for (trackId, status, intPart, fractionalPart, range_, azimuth, radSpeed, tanSpeed,
+         sector) in TRACK_STRUCT.iter_unpack(tracks):
+        # ЭПР (эффективная площадь рассеивания) закодирована двумя байтами: целой и дробной частями. Дробная часть
+        # записывается цифрами после точки, т.е. 2 и 5 -> 2.5, а 2 и 15 -> 2.15
+        divider = EPR_DIVIDERS[fractionalPart]
+        # Азимут. Точность 0.5 градуса. Знаковое целое, кодирование в доп-м коде
+        # TODO: из протокола: Возможны значения от -90 до +90. (макс. отрицательный угол: -45 градусов кодируется
+        # 0xA6, макс. положительный угол: 45 градусов кодируется 0x5A, НУЖНО ДЕЛИТЬ ПО ПОЛАМ ПОЛУЧЕННЫЙ УГОЛ
+        # радиальная и тангенциальная скорости - знаковые 2х байтовые числа в доп-м коде
+        track = {
+            'trackId': trackId,
+            'status': status,  # признак захвата цели
+            'square': (intPart * divider + fractionalPart) / divider,
+            'range': range_,  # дальность до цели
+            'azimuth': azimuth / 2,
+            'radSpeed': radSpeed,
+            'tanSpeed': tanSpeed,
+            'sector': sector,
+        }
+        trajectoriesData[f'track{trackId}'] = track
+    return trajectoriesData
+
+
+def decodeTrajectoriesArray(packet, trajectoriesCount):
+    """
+    Функция декодирования всех траекторий пакета 0x0A в структурированный массив numpy
+    :param packet:
+    :param trajectoriesCount: кол-во траекторий в пакете
+    :return: trajectories | np.ndarray
+    """
+    checkTrajectoriesLength(packet, trajectoriesCount)
+    # массив поверх буфера пакета используется только внутри функции, результат - всегда отдельный массив
+    tracks = np.frombuffer(packet, dtype=TRACK_DTYPE, count=trajectoriesCount, offset=TRACK_OFFSET)
+    trajectories = np.empty(trajectoriesCount, dtype=TRAJECTORY_DTYPE)
+    for field in ('trackId', 'status', 'range', 'radSpeed', 'tanSpeed', 'sector'):
+        trajectories[field] = tracks[field]
+    divider = EPR_DIVIDERS_ARRAY[tracks['squareFractional']]
+    trajectories['square'] = (tracks['squareInt'] * divider + tracks['squareFractional']) / divider
+    trajectories['azimuth'] = tracks['azimuth'] / 2
+    return trajectories
 
 
 class BinProtocol:
     """
-    Класс реализующий бинарный протол Umirs
+    Класс реализующий бинарный протол Umirs.
+    Методы команд принимают необязательные параметры buffer и offset: если они переданы, пакет записывается в буфер
+    вызывающего кода без выделения памяти, и метод возвращает memoryview на записанную часть буфера. Параметр
+    enqueue=False позволяет только сформировать пакет, не добавляя его в очередь исходящих пакетов
     """
-    def __init__(self, packetsManager=None, eventsManager=None, serverId=1):
+    def __init__(self, packetsManager=None, eventsManager=None, serverId=1, trajectoriesAsArray=False,
+                 connection=Connection, tracksTable=None, tracksHistory=None, metrics=None, hooks=None,
+                 parallelDecoder=None, timers=None, pingInterval=3.0, helloEvery=6, replyTimeout=5.0):
         """
         :param packetsManager: ссылка на менеджер пакетов
         :type packetsManager: PacketsManager
+        :param connection: объект состояния соединения с сервером API. По умолчанию общий для процесса класс
+        Connection, для нескольких соединений в одном процессе передаётся отдельный экземпляр ConnectionState
+        :type connection: Connection | ConnectionState
+        :param trajectoriesAsArray: режим, в котором траектории пакета 0x0A передаются в событие одним структурированным
+        массивом numpy (dtype TRAJECTORY_DTYPE) вместо словаря словарей. Требует установленного numpy
+        :type trajectoriesAsArray: bool
+        :param tracksTable: таблица траекторий. Если задана, то вместо события discoveredTrajectories с каждым пакетом
+        0x0A отправляется событие changedTrajectories только с изменениями траекторий
+        :type tracksTable: TracksTable
+        :param tracksHistory: история траекторий, в которую добавляются траектории каждого пакета 0x0A
+        :type tracksHistory: TracksHistory
+        :param metrics: метрики, в которые записываются кол-во полученных пакетов и байт по командам, ошибки
+        декодирования, сбросы буфера неполных пакетов и время парсинга пакетов
+        :type metrics: UmirsMetrics
+        :param hooks: функции профилирования этапов извлечения, парсинга, вызова событий и формирования пакетов
+        :type hooks: profiling.StageHooks
+        :param parallelDecoder: пул процессов, в котором декодируются пакеты траекторий 0x0A. События траекторий
+        отправляются из потока сбора результатов пула в порядке получения пакетов 0x0A. Режим trajectoriesAsArray
+        задаётся пулом
+        :type parallelDecoder: parallel.ParallelDecoder
+        :param timers: колесо таймеров, в котором выполняется пинг сервера. По умолчанию - общее для процесса колесо
+        (см. timers.getTimerWheel), поэтому пинг всех подключений выполняется в одном потоке
+        :type timers: timers.TimerWheel
+        :param pingInterval: таймаут между пингами сервера API в секундах
+        :param helloEvery: пакет приветствия обновляется на каждые helloEvery пакетов пинга
+        :param replyTimeout: таймаут ответа сервера на команду, отправленную методом request, в секундах
         :param self.__countPacket: счётчик исходящих пакетов
         :type self.__countPacket: int
-        :param self.__ping: метод для пинга сервера в отдельном потоке
-        :type self.__ping: Thread
+        :param self.__ping: таймер пинга сервера
+        :type self.__ping: timers.Timer
         """
         self.__countPacket = 0
+        self.__countLock = RLock()  # блокировка счётчика исходящих пакетов
         self.packetsManager = packetsManager
-        self.eventsManager = eventsManager
+        self.hooks = hooks
+        # вызовы событий измеряются обёрткой, поэтому без hooks менеджер событий вызывается напрямую
+        self.eventsManager = HookedEventsManager(eventsManager, hooks) if hooks is not None else eventsManager
         self.serverId = serverId
-        self.__ping = None  # атрибут для потока, который будет отправлять пинговые сообщения
+        if parallelDecoder is not None:
+            trajectoriesAsArray = parallelDecoder.trajectoriesAsArray
+        if trajectoriesAsArray and np is None:
+            raise ImportError('numpy is required for trajectoriesAsArray mode')
+        self.trajectoriesAsArray = trajectoriesAsArray
+        self.connection = connection
+        self.tracksTable = tracksTable
+        self.tracksHistory = tracksHistory
+        self.parallelDecoder = parallelDecoder
+        # канал пула процессов, результаты которого передаются в события по порядку
+        self.__trajectoriesChannel = None
+        if parallelDecoder is not None:
+            self.__trajectoriesChannel = parallelDecoder.openChannel(
+                self.__sendTrajectoriesArray if trajectoriesAsArray else self.__sendTrajectoriesDict)
+        self.timers = timers
+        self.pingInterval = pingInterval
+        self.helloEvery = helloEvery
+        self.replies = PendingReplies(timers, replyTimeout)  # команды, ожидающие ответа сервера
+        self.__ping = None  # таймер, который отправляет пинговые сообщения
+        self.__pingCount = 0  # кол-во пакетов пинга после последнего обновления пакета приветствия
         self.__parsePacket = None  # атрибут для потока, который будет декодировать полученные сообщения от Umirs
         self.__live = True  # флаг, чтобы обеспечить выход из бесконечных циклов. Нужен для корректности вып-я тестов
-        self.pingLive = True
-
-    def sayHello(self, ping=False):
+        self.metrics = metrics
+        self.__logSummary = LogSummary('Umirs protocol')  # сводка повторяющихся событий декодирования
+        # буфер для сборки пакетов из полученных частей данных
+        self.__framesBuffer = FramesBuffer(onResync=metrics.resync if metrics is not None else None)
+        # таблица парсеров входящих пакетов по номеру команды
+        self.__parsers = {
+            codec.HELLO_CLIENT.code: self.__parseHelloClientPacket,  # 0x01 - команда приветствия сервера
+            codec.TRAJECTORIES.code: self.__parseTrajectoriesDiscoveredDisplayPacket,  # 0x0A - передача траекторий
+            codec.CAPTURE_STATE.code: self.__parseTargetCaptureStateDisplayPacket,  # 0x0D - статус захвата трека
+            codec.SERVER_STATE.code: self.__parseServerStatePacket,  # 0x14 - статус сервера
+            codec.SERVER_EXTENDED_STATE.code: self.__parseServerExtentedStatePacket,  # 0x15 - расширенный статус
+        }
+
+    def sayHello(self, ping=False, buffer=None, offset=0):
         """
         Команда отправки пакета приветствия сервера
         длина пакета: 0x0A
@@ -46,13 +212,18 @@ class BinProtocol:
         Это необходимо сделать для корректного подключения к серверу API
         :return: packet | bytearray
         """
-        packet = self.__makePacket(lengthPacket=0x0A, command=0x00, lengthCommand=0x01)
-        packet.append(PROTOCOL_VERSION)
-        if ping:
-            self.packetsManager.addOutcomingPacket(packet)
-            return packet
+        if not ping:
+            self.__encodeCommand(codec.HELLO, {}, buffer, offset)
+            return
+        # сервер отвечает на каждое приветствие, поэтому приветствие пинга регистрируется в таблице ожидания ответов,
+        # хотя его ответ никто не ожидает: иначе этот ответ завершил бы отправленный позже запрос request('sayHello')
+        with self.__countLock:
+            packet = self.__encodeCommand(codec.HELLO, {}, buffer, offset)
+            future = self.replies.expect(codec.HELLO, {}, packet[3])
+            self.__addAwaitedPacket(codec.HELLO, {}, packet, future, coalesce=True)
+        return packet
 
-    def getServerStatus(self, params):
+    def getServerStatus(self, params, buffer=None, offset=0, enqueue=False):
         """
         Команда отправки пакета для получения статуса сервера
         длина пакета: 0x0A
@@ -60,30 +231,28 @@ class BinProtocol:
         длина команды: 0x01
         :return:
         """
-        packet = self.__makePacket(lengthPacket=0x0A, command=0x09, lengthCommand=0x01)
-        packet.append(params.get('formatStatus', 0))
+        packet = self.__encodeCommand(codec.SERVER_STATUS_REQUEST, params, buffer, offset)
+        if packet is not None and enqueue:
+            self.packetsManager.addOutcomingPacket(packet)
         return packet
 
-    def captureAndFollowTarget(self, params):
+    def captureAndFollowTarget(self, params, buffer=None, offset=0, enqueue=True):
         """
-        Команда отправки пакета для принудительного захвата и сопровождения на сервере траектории с определенным ID
+        Команда отправки пакета для принудительного захвата и сопровождения на сервере траектории с определенным ID.
+        Ответ сервера 0x0D на команду, отправленную этим методом, не отличается от ответа на запрос
+        request('captureAndFollowTarget') и завершит ожидающий запрос с тем же номером трека. Если нужен ответ на
+        команду, её следует отправлять через request
         длина пакета: 0x0C
         команда: 0x0B
         длина команды: 0x03
         :return:
         """
-        if params.get('trackId') is None or params.get('captureTarget') is None:
-            return None
-        packet = self.__makePacket(lengthPacket=0x0C, command=0x0B, lengthCommand=0x03)
-        trackId = params['trackId']
-        # если ID трека больше, чем байт, то необходимо это число разбить на старший и младший байты
-        packet.append(trackId >> 8)
-        packet.append(trackId & 0b0000000011111111)
-        packet.append(params['captureTarget'])
-        self.packetsManager.addOutcomingPacket(packet)
+        packet = self.__encodeCommand(codec.CAPTURE_TARGET, params, buffer, offset)
+        if packet is not None and enqueue:
+            self.packetsManager.addOutcomingPacket(packet)
         return packet
 
-    def setAutoCaptureTarget(self, params):
+    def setAutoCaptureTarget(self, params, buffer=None, offset=0, enqueue=True):
         """
         Команда отправки пакета для переключения режима автозахвата траектории на сервере
         длина пакета: 0x0A
@@ -91,14 +260,12 @@ class BinProtocol:
         длина команды: 0x01
         :return:
         """
-        if params.get('setAutoCapture') is None:
-            return None
-        packet = self.__makePacket(lengthPacket=0x0A, command=0x0C, lengthCommand=0x01)
-        packet.append(params['setAutoCapture'])
-        self.packetsManager.addOutcomingPacket(packet)
+        packet = self.__encodeCommand(codec.AUTO_CAPTURE, params, buffer, offset)
+        if packet is not None and enqueue:
+            self.packetsManager.addOutcomingPacket(packet)
         return packet
 
-    def setArmRLS(self, params):
+    def setArmRLS(self, params, buffer=None, offset=0, enqueue=True):
         """
         Команда отправки пакета для постановки/снятия на охрану РЛС. При этом включается/выключается излучение
         передатчика РЛС
@@ -107,14 +274,12 @@ class BinProtocol:
         длина команды: 0x01
         :return:
         """
-        if params.get('setArmRLS') is None:
-            return None
-        packet = self.__makePacket(lengthPacket=0x0A, command=0x0E, lengthCommand=0x01)
-        packet.append(params['setArmRLS'])
-        self.packetsManager.addOutcomingPacket(packet)
+        packet = self.__encodeCommand(codec.ARM_RLS, params, buffer, offset)
+        if packet is not None and enqueue:
+            self.packetsManager.addOutcomingPacket(packet)
         return packet
 
-    def setFiltersOfTargets(self, params):
+    def setFiltersOfTargets(self, params, buffer=None, offset=0, enqueue=True):
         """
         Команда отправки пакета для управления фильтрами траекторий на сервере
         длина пакета: 0x0A
@@ -122,14 +287,12 @@ class BinProtocol:
         длина команды: 0x01
         :return:
         """
-        if params.get('setFilters') is None:
-            return None
-        packet = self.__makePacket(lengthPacket=0x0A, command=0x0F, lengthCommand=0x01)
-        packet.append(params['setFilters'])
-        self.packetsManager.addOutcomingPacket(packet)
+        packet = self.__encodeCommand(codec.FILTERS, params, buffer, offset)
+        if packet is not None and enqueue:
+            self.packetsManager.addOutcomingPacket(packet)
         return packet
 
-    def setMasksOfTargets(self, params):
+    def setMasksOfTargets(self, params, buffer=None, offset=0, enqueue=True):
         """
         Команда отправки пакета для управления масками траекторий на сервере
         длина пакета: 0x0A
@@ -137,14 +300,12 @@ class BinProtocol:
         длина команды: 0x01
         :return:
         """
-        if params.get('setMasks') is None:
-            return None
-        packet = self.__makePacket(lengthPacket=0x0A, command=0x10, lengthCommand=0x01)
-        packet.append(params['setMasks'])
-        self.packetsManager.addOutcomingPacket(packet)
+        packet = self.__encodeCommand(codec.MASKS, params, buffer, offset)
+        if packet is not None and enqueue:
+            self.packetsManager.addOutcomingPacket(packet)
         return packet
 
-    def setPTZ(self, params):
+    def setPTZ(self, params, buffer=None, offset=0, enqueue=True):
         """
         Команда отправки пакета для управления положением PTZ поворотного устр-ва. Для выполнения данной команды,
         автозахват траекторий на сервере должен быть выключен, иначе команда игнорируется сервером
@@ -152,15 +313,12 @@ class BinProtocol:
         команда : 0x11
         длина команды: 0x02
         """
-        if params.get('setPTZCommand') is None or params.get('setPTZSpeed') is None:
-            return None
-        packet = self.__makePacket(lengthPacket=0x0B, command=0x11, lengthCommand=0x02)
-        packet.append(params['setPTZCommand'])
-        packet.append(params['setPTZSpeed'])
-        self.packetsManager.addOutcomingPacket(packet)
+        packet = self.__encodeCommand(codec.PTZ, params, buffer, offset)
+        if packet is not None and enqueue:
+            self.packetsManager.addOutcomingPacket(packet)
         return packet
 
-    def setPTZPreset(self, params):
+    def setPTZPreset(self, params, buffer=None, offset=0, enqueue=True):
         """
         Команда отправки пакета для вызова или установки пресета PTZ поворотного устройства Umirs.
         !!!
@@ -171,12 +329,9 @@ class BinProtocol:
         длина команды: 0x02
         :return:
         """
-        if params.get('presetId') is None or params.get('setPTZPreset') is None:
-            return None
-        packet = self.__makePacket(lengthPacket=0x0B, command=0x12, lengthCommand=0x02)
-        packet.append(params['presetId'])  # номер предустановки от 1 до 25
-        packet.append(params['setPTZPreset'])
-        self.packetsManager.addOutcomingPacket(packet)
+        packet = self.__encodeCommand(codec.PTZ_PRESET, params, buffer, offset)
+        if packet is not None and enqueue:
+            self.packetsManager.addOutcomingPacket(packet)
         return packet
 
     def setServerId(self, serverId):
@@ -194,71 +349,155 @@ class BinProtocol:
         метод для присвоения порядкового номера пакету перед отправкой. Может генерировать значения от 0 до 255
         :return:
         """
-        self.__countPacket = (self.__countPacket % 256) + 1
-        if self.__countPacket == 256:
-            self.__countPacket = 0
-        return self.__countPacket
+        with self.__countLock:
+            self.__countPacket = (self.__countPacket % 256) + 1
+            if self.__countPacket == 256:
+                self.__countPacket = 0
+            return self.__countPacket
+
+    def encodeCommands(self, commands):
+        """
+        Метод для формирования нескольких команд одним пакетом данных. Команды записываются подряд в один буфер с
+        последовательными порядковыми номерами, и буфер добавляется в очередь исходящих пакетов целиком.
+        Команды с некорректными параметрами пропускаются, так же как при вызове отдельного метода команды.
+        Пример: encodeCommands([('setMasksOfTargets', {'setMasks': 1}), ('setArmRLS', {'setArmRLS': 1})])
+        :param commands: список пар (имя метода команды, параметры команды). Допустимые имена - методы команд,
+        объявленных в codec с признаком batch
+        :return: packets | bytearray | None, если ни одна команда не была сформирована
+        """
+        specs = []
+        for name, params in commands:
+            spec = codec.COMMANDS_BY_METHOD.get(name)
+            if spec is None or not spec.batch:
+                raise ValueError(f'Command {name} can not be encoded in batch')
+            specs.append((spec, params))
+        buffer = bytearray(sum(spec.size for spec, _ in specs))
+        offset = 0
+        # блокировка счётчика нужна, чтобы пакеты пинга из другого потока не получили номера между командами пачки
+        with self.__countLock:
+            for spec, params in specs:
+                if self.__encodeCommand(spec, params, buffer, offset) is not None:
+                    offset += spec.size
+        del buffer[offset:]
+        if not buffer:
+            return None
+        self.packetsManager.addOutcomingPacket(buffer)
+        return buffer
+
+    def request(self, name, params, timeout=None):
+        """
+        Метод отправки команды, на которую сервер отвечает пакетом (описания команд с признаком reply в codec:
+        sayHello, getServerStatus, captureAndFollowTarget). Возвращает future, которая завершается результатом парсинга
+        ответа - тем же словарём, что передаётся в событие ответа. Можно отправить несколько команд, не дожидаясь
+        ответов: ответы сопоставляются с командами по ключу ответа и порядку отправки (см. replies.PendingReplies).
+        Ответ на пинг тоже завершает ожидающий запрос статуса, так как содержит текущий статус сервера. Статус захвата,
+        который сервер отправляет без команды (например при потере трека), неотличим от ответа и тоже завершит запрос
+        захвата этого трека.
+        Пример: state = protocol.request('captureAndFollowTarget', {'trackId': 5, 'captureTarget': 1}).result(3.0)
+        :param name: имя метода команды
+        :param params: параметры команды
+        :param timeout: таймаут ответа в секундах. По умолчанию - replyTimeout. По истечении future завершается
+        исключением TimeoutError, при потере соединения или если пакет команды удалён из очереди без отправки -
+        ConnectionError
+        :return: future | concurrent.futures.Future - в asyncio ожидается через asyncio.wrap_future
+        """
+        spec = codec.COMMANDS_BY_METHOD.get(name)
+        if spec is None or spec.reply is None:
+            raise ValueError(f'Command {name} has no reply')
+        values = spec.getValues(params)
+        if values is None:
+            raise ValueError(f'Required parameters of command {name} are not set')
+        # команда регистрируется и добавляется в очередь под блокировкой счётчика, чтобы порядок ожидания ответов
+        # совпадал с порядком отправки команд из разных потоков
+        with self.__countLock:
+            packet = self.__encodeCommand(spec, params)
+            values = dict(zip(spec.fieldNames, values))
+            future = self.replies.expect(spec, values, packet[3], timeout)
+            # каждая команда ожидает собственного ответа, поэтому её нельзя заменять в очереди более новой командой
+            self.__addAwaitedPacket(spec, values, packet, future, coalesce=False)
+        return future
+
+    def __addAwaitedPacket(self, spec, values, packet, future, coalesce):
+        """
+        Метод добавления в очередь пакета команды, ожидающей ответа. Если менеджер пакетов удалит пакет без отправки,
+        ожидание ответа завершается исключением ConnectionError
+        :return:
+        """
+        kwargs = {}
+        if getattr(self.packetsManager, 'coalescing', False):
+            kwargs['coalesce'] = coalesce
+        if getattr(self.packetsManager, 'dropCallbacks', False):
+            seq = packet[3]
+            kwargs['onDrop'] = lambda: self.replies.fail(
+                spec, values, future, ConnectionError(f'Packet {seq} of command {spec.name} was dropped unsent'))
+        self.packetsManager.addOutcomingPacket(packet, **kwargs)
 
-    def __pingServerAPI(self, **params):
+    def failPendingReplies(self):
         """
-        Метод для пинга сервера API Umirs. Каждые 3 секунды на сервер API будет отправляться сообщение с запросом о
-        статусе сервера. Тем самым, согласно протоколу, сервер будет понимать, что клиент все еще на связи и не будет
-        обрывать соединение.
-        :param params:
+        Метод завершения исключением ConnectionError всех команд, ожидающих ответа. Вызывается при потере соединения
         :return:
         """
-        logging.info("START PING PACKET thread")
-        # перед запуском цикла пинга зададим сообщение приветствия
-        self.packetsManager.setHelloPacket(self.sayHello(ping=True))
-        # счётчик отосланных пакетов
-        countDownToHelloPacket = 0
-        while self.__live and self.pingLive:
-            packet = self.getServerStatus(params)
-            self.packetsManager.addOutcomingPacket(packet)
-            logging.info('added PING packet into manager')
-            time.sleep(3.0)
-            countDownToHelloPacket += 1
-            # на каждые 5 пакетов пинга вставляем один пакет приветствия
-            if countDownToHelloPacket > 5:
-                countDownToHelloPacket = 0
-                self.packetsManager.setHelloPacket(self.sayHello(ping=True))
-                logging.info('added HELLO packet into manager')
-        logging.info('FINISHED PING PACKET thread')
+        self.replies.failAll(ConnectionError('Connection to Server API Umirs is lost'))
+
+    def __pingServerAPI(self):
+        """
+        Метод пинга сервера API Umirs, который вызывается таймером каждые pingInterval секунд. На сервер API
+        отправляется сообщение с запросом о статусе сервера. Тем самым, согласно протоколу, сервер будет понимать, что
+        клиент все еще на связи и не будет обрывать соединение.
+        :return:
+        """
+        self.packetsManager.addOutcomingPacket(self.getServerStatus({}))
+        logging.debug('added PING packet into manager')
+        self.__pingCount += 1
+        # на каждые helloEvery пакетов пинга обновляем пакет приветствия
+        if self.__pingCount >= self.helloEvery:
+            self.__pingCount = 0
+            self.packetsManager.setHelloPacket(self.sayHello(ping=True))
+            logging.debug('added HELLO packet into manager')
+
+    def startPing(self, hello=True):
+        """
+        Метод запуска пинга сервера API Umirs. Первый пакет пинга отправляется сразу. Если пинг уже запущен, он
+        перезапускается
+        :param hello: перед запуском пинга отправить и задать пакет приветствия
+        :return:
+        """
+        self.stopPing()
+        if hello:
+            self.packetsManager.setHelloPacket(self.sayHello(ping=True))
+        self.__pingCount = 0
+        timers = self.timers if self.timers is not None else getTimerWheel()
+        self.__ping = timers.callEvery(self.pingInterval, self.__pingServerAPI, firstDelay=0)
+        logging.info('START PING PACKET timer')
+
+    def stopPing(self):
+        """
+        Метод остановки пинга сервера API Umirs
+        :return:
+        """
+        if self.__ping is not None:
+            self.__ping.cancel()
+            self.__ping = None
+            logging.info('FINISHED PING PACKET timer')
 
     def startNewPingPacketThread(self):
         """
-        Метод для запуска нового потока отправки пинг пакетов в сервер API Umirs
+        Метод перезапуска пинга сервера API Umirs. Оставлен для совместимости: пинг выполняется таймером в общем потоке
+        колеса таймеров (см. startPing)
         :return:
         """
-        # если драйвер запускается впервые сделаем проверку атрибута на None
-        if self.__ping is None:
-            self.__parsePacket = Thread(target=self.__pingServerAPI, args=({}))
-            self.__parsePacket.start()
-            return
-        # если предыдущий поток еще жив, уст. значение флага pingLive=False, таким образом метод отправки пинга выйдет
-        # из бесконечного цикла
-        # этот сценарий с флагом pingLive нужен для того, если поток отправки пинга аварийно завершился, и нам нужно
-        # его перезапустить
-        if self.__ping.is_alive():
-            self.pingLive = False
-            self.__ping.join(3.0)
-            logging.info("Previously PING PACKET Thread is stopped")
-            self.pingLive = True
-        self.__ping = Thread(target=self.__pingServerAPI, args=({}))
-        self.__ping.start()
+        self.startPing()
 
     def turnOffFlagForThreads(self):
         """
-        Метод для сброса флага, который используется в бесконечных циклах методов: отправки пинговых сообщений, декодиро
-        вания полученных сообщений из Umirs
+        Метод для сброса флага, который используется в бесконечном цикле декодирования полученных сообщений из Umirs
         :return:
         """
         self.__live = False
 
     def turnOnFlagForThreads(self):
         """
-        Метод для установки флага, который используется в бесконечных циклах методов: отправки пинговых сообщений,
-         декодирования полученных сообщений из Umirs
+        Метод для установки флага, который используется в бесконечном цикле декодирования полученных сообщений из Umirs
         :return:
         """
         self.__live = True
@@ -278,22 +517,28 @@ class BinProtocol:
         self.__parsePacket = Thread(target=self.decodeIncomingPackets)
         self.__parsePacket.start()
 
-    def __makePacket(self, lengthPacket, command, lengthCommand):
+    def __encodeCommand(self, spec, params, buffer=None, offset=0):
         """
-        Метод создает пакет для отправки и заполняет некоторые поля
-        :return: packet | bytearray
+        Метод создает пакет команды для отправки. Значения полей берутся из params по именам полей описания команды,
+        а заголовок, порядковый номер и данные команды записываются одним вызовом pack_into
+        :param spec: описание команды
+        :type spec: codec.CommandSpec
+        :param params: параметры команды
+        :param buffer: буфер, в который нужно записать пакет. Если не передан, то создаётся новый bytearray. Буфер
+        нельзя изменять, пока пакет не отправлен в сокет
+        :param offset: смещение в буфере, с которого записывается пакет
+        :return: packet | bytearray | memoryview | None, если не задан обязательный параметр команды
         """
-        packet = bytearray()
-        packet.append(FOR_SERVER)
-        packet.append(0x00)  # под длину пакета зарезервировано протоколом 2 байта
-        packet.append(lengthPacket)  # общая длина пакета
-        packet.append(self._setCountPacket())
-        packet.append(CLIENT_ID)
-        packet.append(self.serverId)
-        packet.append(command)  # номер команды, которую необходимо выполнить
-        packet.append(0x00)  # под длину команды зарезервировано 2 байта
-        packet.append(lengthCommand)  # длина команды 2 байта
-
+        values = spec.getValues(params)
+        if values is None:
+            return None
+        hooks = self.hooks
+        if hooks is None or not hooks.sample(ENCODE):
+            return spec.pack(self._setCountPacket(), self.serverId, values, buffer=buffer, offset=offset)
+        start = time.perf_counter_ns()
+        countPacket = self._setCountPacket()
+        packet = spec.pack(countPacket, self.serverId, values, buffer=buffer, offset=offset)
+        hooks.emit(ENCODE, countPacket, spec.code, start, time.perf_counter_ns())
         return packet
 
     def decodeIncomingPackets(self):
@@ -302,86 +547,128 @@ class BinProtocol:
         :return:
         """
         logging.info('START DECODE Packets Thread')
-        buffer = bytearray()  # буфер для хранения неполных пакетов
+        self.resetFramesBuffer()
+        blockingGet = getattr(self.packetsManager, 'blockingGet', False)
         while self.__live:
-            if not Connection.isAlive():
+            if not self.connection.isAlive():
                 # если нет текущего соединения, то отправляем None в метод для парсинга пакетов сост-й сервера API
                 self.__parseServerStatePacket(None)
 
-            incomPacket = self.packetsManager.getIncomingPacket()
+            # если менеджер пакетов умеет ждать появления пакета, то поток проснётся сразу после получения данных,
+            # иначе опрашиваем очередь с паузой
+            if blockingGet:
+                incomPacket = self.packetsManager.getIncomingPacket(timeout=0.5)
+            else:
+                incomPacket = self.packetsManager.getIncomingPacket()
 
             if incomPacket:
-                # дебаговый принт, можно потом убрать
-                logging.info(f'Decode packet length={len(incomPacket)}')
-                # для удобства обработки сформируем массив байтов из байтового пакета
-                incomPacket = bytearray(incomPacket)
-                if buffer:
-                    buffer.extend(incomPacket)
-                    incomPacket = buffer
-                    # затем обнулим буфер
-                    buffer = bytearray()
-                # чтобы корректно извлечь данные о длине пакета, длина данных должны быть больше 2х элементов, т.к.
-                # в индексах [1] и [2] хранится общая длина пакета.
-                while len(incomPacket) > 2:
-                    lengthPacket = (incomPacket[1] << 8) + incomPacket[2]
-                    # если длина пакета больше 416 байт (это максимальная длина пакета согласно протоколу), или равна
-                    # нулю то обнулим буфер и обнулим данные входящего пакета, затем выйдем из цикла обработки сообщений
-                    if lengthPacket > 416 or lengthPacket == 0:
-                        buffer = bytearray()
-                        incomPacket = None
-                        logging.info('Length packet is more than 416 bytes!' if lengthPacket > 0 else
-                                     'Received wrong packet')
-                        break
-                    # если пакет пришел целиком, то извлекаем его
-                    if lengthPacket <= len(incomPacket):
-                        packet = bytearray([incomPacket.pop(0) for _ in range(lengthPacket)])
-                        # передадим извлеченный пакет в метод, который проведет дальнейший его парсинг
-                        if packet:
-                            self.__parseIncomingPackets(packet)
-                    else:
-                        # если во входящих данных пакет пришел не целиком или после извлечения пакета из данных остались
-                        # данные представлюящие не полный пакет, то запоминаем эту часть, чтобы потом добавить к
-                        # следующей части полученных данных
-                        for _ in range(len(incomPacket)):
-                            buffer.append(incomPacket.pop(0))
-                        break
-                # для корректной отработки ситуаций, когда данные приходят меньше 3х байт, или же после извлечения
-                # целого пакета из данных остаётся меньше 2х байт, нужно сохранять всё в буфере, чтобы в итоге составить
-                # корректный пакет
-                if incomPacket and len(incomPacket):
-                    for _ in range(len(incomPacket)):
-                        buffer.append(incomPacket.pop(0))
+                if LogUtil.isHotPathDebugEnabled():
+                    logging.debug('Decode packet length=%d', len(incomPacket))
+                self.decodeChunk(incomPacket)
             else:
-                # дебаговый принт, можно потом убрать
-                logging.info(f'Decode packet empty')
-                time.sleep(0.5)
+                self.__logSummary.count('empty decode polls')
+                if not blockingGet:
+                    time.sleep(0.5)
+        self.__logSummary.flush()
         logging.info('FINISHED DECODE Packets Thread')
 
+    def decodeChunk(self, chunk):
+        """
+        Метод для декодирования очередной части данных, полученной из сокета. Все целые пакеты сразу парсятся, а
+        неполный остаток сохраняется в буфере до получения следующей части данных
+        :param chunk: данные из сокета
+        :return:
+        """
+        if self.hooks is not None:
+            self.__decodeChunkWithHooks(chunk, self.hooks)
+        else:
+            # извлечённые пакеты передаются в парсинг как memoryview поверх буфера, без копирования
+            packets = self.__framesBuffer.extractPackets(chunk)
+            try:
+                for packet in packets:
+                    self.__parseIncomingPackets(packet)
+            finally:
+                # при ошибке парсинга генератор нужно закрыть сразу, чтобы освободить memoryview буфера
+                packets.close()
+        # пакеты траекторий этой части данных передаются процессам, не дожидаясь заполнения пачки
+        if self.__trajectoriesChannel is not None:
+            self.parallelDecoder.flush()
+
+    def __decodeChunkWithHooks(self, chunk, hooks):
+        """
+        Метод декодирования части данных с измерением этапов извлечения, парсинга и вызова событий для каждого
+        hooks.sampleEvery-го пакета
+        :param chunk: данные из сокета
+        :param hooks: функции профилирования
+        :type hooks: profiling.StageHooks
+        :return:
+        """
+        start = time.perf_counter_ns()
+        packets = self.__framesBuffer.extractPackets(chunk)
+        try:
+            for packet in packets:
+                if not hooks.sample(EXTRACT):
+                    self.__parseIncomingPackets(packet)
+                    start = time.perf_counter_ns()
+                    continue
+                seq, command = packet[3], packet[6]
+                extracted = time.perf_counter_ns()
+                hooks.emit(EXTRACT, seq, command, start, extracted)
+                hooks.setCurrentPacket(seq, command)
+                try:
+                    self.__parseIncomingPackets(packet)
+                finally:
+                    hooks.setCurrentPacket(None, None)
+                    start = time.perf_counter_ns()
+                    hooks.emit(PARSE, seq, command, extracted, start)
+        finally:
+            packets.close()
+
+    def resetFramesBuffer(self):
+        """
+        Метод для очистки буфера неполных пакетов. Необходимо вызывать при новом подключении к серверу API
+        :return:
+        """
+        self.__framesBuffer.clear()
+
+    def notifyConnectionLost(self):
+        """
+        Метод для оповещения о потере соединения с сервером API Umirs, когда данные декодируются не в потоке
+        decodeIncomingPackets
+        :return:
+        """
+        self.failPendingReplies()
+        self.__parseServerStatePacket(None)
+
     def __parseIncomingPackets(self, packet):
         """
         Метод для парсинга входящего пакета
         :param packet:
         :return:
         """
-        # 0x01 - команда приветствия сервера
-        # 0x0A - команда передачи траекторий
-        # 0x0D - команда статуса захвата трека
-        # 0x14 - команда статуса сервера
-        # 0x15 - команда расширенного статуса сервера
-
-        if packet[6] == 0x01:
-            return self.__parseHelloClientPacket(packet)
-        elif packet[6] == 0x0A:
-            return self.__parseTrajectoriesDiscoveredDisplayPacket(packet)
-        elif packet[6] == 0x0D:
-            return self.__parseTargetCaptureStateDisplayPacket(packet)
-        elif packet[6] == 0x14:
-            return self.__parseServerStatePacket(packet)
-        elif packet[6] == 0x15:
-            return self.__parseServerExtentedStatePacket(packet)
-
-        logging.info('Can not decode packet with command {}'.format(packet[6]))
-        return
+        parser = self.__parsers.get(packet[6])
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.frameReceived(packet[6], len(packet))
+        if parser is None:
+            self.__logSummary.count(f'frames with unknown command {packet[6]}')
+            if metrics is not None:
+                metrics.decodeErrors.inc()
+            return
+        if metrics is None:
+            result = parser(packet)
+        else:
+            start = time.perf_counter()
+            try:
+                result = parser(packet)
+            except Exception:
+                metrics.decodeErrors.inc()
+                raise
+            finally:
+                metrics.decodeTime.observe(time.perf_counter() - start)
+        # любой успешно разобранный пакет подтверждает, что сервер на связи (см. Client.livenessTimeout)
+        if result is not _REJECTED:
+            self.connection.touch()
 
     def __parseHelloClientPacket(self, packet):
         """
@@ -393,12 +680,15 @@ class BinProtocol:
         # пакет 3.3, 0x01 - команда приветствия сервера
         logging.info('Received Hello packet from Server API Radescan')
         if packet[9] == 0x00:
-            raise Exception(f'Radescans Server API protocol version is not compatible with Ports protocol version.'
+            exc = Exception(f'Radescans Server API protocol version is not compatible with Ports protocol version.'
                             f' Ports version={PROTOCOL_VERSION}')
+            self.replies.reject(codec.HELLO_CLIENT.code, exc)
+            raise exc
         elif packet[9] > 0:
             # если в 9м байте значение больше нуля, то всё ок, протоколы совместимы. Установим состояние соединения в
             # True
-            Connection.startConnection()
+            self.connection.startConnection()
+            self.replies.resolve(codec.HELLO_CLIENT.code, {'compatible': packet[9]})
             self.eventsManager.connectToServerRadescan()
 
     def __parseTrajectoriesDiscoveredDisplayPacket(self, packet):
@@ -409,37 +699,62 @@ class BinProtocol:
         """
         # пакет 3.5, 0x0A - команда передачи траекторий
         # print('0x0A - команда передачи траекторий')
-        logging.debug('Received packet 3.5 {} length of packet = {}'.format(packet, len(packet)))
-
-        trajectoriesCount = packet[9]
-        index = self.__byteIndex()  # получим генератор индексов для перемещения по байтовому массиву
-        trajectoriesData = {}
-        for trajectoryId, _ in enumerate(range(trajectoriesCount), 1):
-            track = {}
-            # вычислим номер трека
-            trackId = (packet[next(index)] << 8) + packet[next(index)]
-            track['trackId'] = trackId
-            # признак захвата цели
-            track['status'] = packet[next(index)]
-            # вычислим ЭПР (эффективная площадь рассеивания). Она закодированна двумя байтами: целой и дробной частями
-            intPart = packet[next(index)]
-            fractionalPart = packet[next(index)]
-            track['square'] = float(f'{intPart}.{fractionalPart}')
-            # вычислим дальность до цели
-            track['range'] = (packet[next(index)] << 8) + packet[next(index)]
-            # Вычислим азимут. Точность 0.5 градуса. Знаковое целое, кодирование в доп-м коде
-            # TODO: из протокола: Возможны значения от -90 до +90. (макс. отрицательный угол: -45 градусов кодируется
-            # 0xA6, макс. положительный угол: 45 градусов кодируется 0x5A, НУЖНО ДЕЛИТЬ ПО ПОЛАМ ПОЛУЧЕННЫЙ УГОЛ
-            track['azimuth'] = round(self.__convert(packet[next(index)], 1) / 2, 1)
-            # Вычислим радиальную скорость. Она представлена 2мя байтами. 1й - старшая часть, 2й - младшая часть
-            track['radSpeed'] = self.__convert(((packet[next(index)] << 8) + packet[next(index)]), 2)
-            # Вычислим тангенциальную скорость. Она представлена 2мя байтами. 1й - старшая часть, 2й - младшая часть
-            track['tanSpeed'] = self.__convert(((packet[next(index)] << 8) + packet[next(index)]), 2)
-            track['sector'] = packet[next(index)]
-            trackName = f'track{trackId}'
-            trajectoriesData[trackName] = track
-        # отправим событие с полученными данными об обнаруженных траекториях
-        self.eventsManager.discoveredTrajectories(trajectoriesData)
+        if LogUtil.isHotPathDebugEnabled():
+            logging.debug('Received packet 3.5 %s length of packet = %d', bytearray(packet), len(packet))
+
+        trajectoriesCount = packet[9] if len(packet) >= TRACK_OFFSET else 0
+        if not isTrajectoriesLengthValid(packet, trajectoriesCount):
+            # траектории не помещаются в пакет: пакет повреждён, как и пакет с неизвестной командой
+            self.__logSummary.count('trajectories frames with invalid length')
+            if self.metrics is not None:
+                self.metrics.decodeErrors.inc()
+            return _REJECTED
+        if self.__trajectoriesChannel is not None:
+            self.parallelDecoder.submit(self.__trajectoriesChannel, packet)
+            return
+        if self.trajectoriesAsArray:
+            self.__sendTrajectoriesArray(decodeTrajectoriesArray(packet, trajectoriesCount))
+            return
+        self.__sendTrajectoriesDict(decodeTrajectoriesDict(packet, trajectoriesCount))
+
+    def __sendTrajectoriesDict(self, trajectoriesData):
+        """
+        Метод отправки события с траекториями пакета, декодированными в словарь
+        :param trajectoriesData: траектории пакета
+        :type trajectoriesData: dict
+        :return:
+        """
+        self.__sendTrajectories(trajectoriesData, trajectoriesData.values())
+
+    def __sendTrajectoriesArray(self, trajectoriesData):
+        """
+        Метод отправки события с траекториями пакета, декодированными в массив numpy
+        :param trajectoriesData: траектории пакета
+        :type trajectoriesData: np.ndarray
+        :return:
+        """
+        # словари траекторий нужны только таблице и истории траекторий
+        tracks = []
+        if self.tracksTable is not None or self.tracksHistory is not None:
+            tracks = [dict(zip(TRAJECTORY_DTYPE.names, row)) for row in trajectoriesData.tolist()]
+        self.__sendTrajectories(trajectoriesData, tracks)
+
+    def __sendTrajectories(self, trajectoriesData, tracks):
+        """
+        Метод отправки события с полученными данными об обнаруженных траекториях. Если ведётся таблица траекторий, то
+        вместо всех траекторий пакета в событие changedTrajectories отправляются только изменения
+        :param trajectoriesData: траектории пакета в формате события discoveredTrajectories
+        :param tracks: траектории пакета в виде словарей для таблицы и истории траекторий
+        :return:
+        """
+        if self.tracksHistory is not None:
+            self.tracksHistory.add(tracks)
+        if self.tracksTable is None:
+            self.eventsManager.discoveredTrajectories(trajectoriesData)
+            return
+        delta = self.tracksTable.update(tracks)
+        if delta['appeared'] or delta['updated'] or delta['disappeared']:
+            self.eventsManager.changedTrajectories(delta)
 
     def __parseTargetCaptureStateDisplayPacket(self, packet):
         """
@@ -450,9 +765,8 @@ class BinProtocol:
         # пакет 3.8, 0x0D - команда статуса захвата трека
         logging.info('Received Capture target packet')
         # print('0x0D - команда статуса захвата трека')
-        state = {}
-        state['trackId'] = (packet[9] << 8) + packet[10]
-        state['setCapture'] = packet[11]
+        state = codec.CAPTURE_STATE.unpack(packet)
+        self.replies.resolve(codec.CAPTURE_STATE.code, state, codec.CAPTURE_TARGET.replyKey)
         self.eventsManager.targetCaptureState(state)
 
     def __parseServerStatePacket(self, packet):
@@ -480,27 +794,17 @@ class BinProtocol:
             # обработки такой ситуации необходимо отравить пустой dict
             self.eventsManager.changeRadescanEquipmentState(state)
             return
-        state['connectionCORT'] = packet[9]
-        state['connectionRLS'] = packet[10]
-        state['connectionPTZ'] = packet[11]
-        state['activeInterference'] = packet[13]
-        state['eradiationRLS'] = packet[14]
-        state['filters'] = packet[15]
-        state['masks'] = packet[16]
-        state['panPTZ'] = (packet[17] << 8) + packet[18]
-        state['tiltPTZ'] = (packet[19] << 8) + packet[20]
-        state['controlInterceptedPTZ'] = packet[21]
-        state['trajectoryCaptured'] = packet[22]
-        state['autoCapture'] = packet[23]
+        state = codec.SERVER_STATE.unpack(packet)
+        eradiationFrequencyCode = state.pop('eradiationFrequencyCode')
         # в зависимости от типа РЛС получим частоту излучения
-        state['rlsType'] = self.__getRLSTypeByCode(packet[24])
-        state['eradiationFrequency'] = self.__getErFrequencyByTypeRLS(state['rlsType'], packet[12])
-        logging.info('Received Ping Packet')
-
+        state['rlsType'] = self.__getRLSTypeByCode(state.pop('rlsCode'))
+        state['eradiationFrequency'] = self.__getErFrequencyByTypeRLS(state['rlsType'], eradiationFrequencyCode)
         # в режиме debug принтуем полученный массив байт от Umirs и наш пропарсенный пакет пинга
-        logging.debug('Received byte packet{}'.format(packet))
-        logging.debug('Parsed packet: {}'.format(state))
+        if LogUtil.isHotPathDebugEnabled():
+            logging.debug('Received Ping Packet %s', bytearray(packet))
+            logging.debug('Parsed packet: %s', state)
 
+        self.replies.resolve(codec.SERVER_STATE.code, state)
         self.eventsManager.changeRadescanEquipmentState(state)
 
     def __getRLSTypeByCode(self, rlsCode):
@@ -509,14 +813,7 @@ class BinProtocol:
         :param rlsCode:
         :return:
         """
-        rlsType = None
-        if rlsCode == 0:
-            rlsType = 'RLS2.4'
-        elif rlsCode == 1:
-            rlsType = 'RLS2.4M'
-        elif rlsCode == 2:
-            rlsType = 'RLSX'
-        return rlsType
+        return codec.RLS_TYPES.get(rlsCode)
 
     def __getErFrequencyByTypeRLS(self, rlsType, eradiationFrequencyCode):
         """
@@ -525,43 +822,14 @@ class BinProtocol:
         :param eradiationFrequencyCode: код частоты
         :return: eradiationFrequency частота излучения РЛС в МГц
         """
-        eradiationFrequency = None
-        rlsFreqList = []
-        if rlsType == 'RLS2.4':
-            # РЛС RLS2.4 поддерживает частоты от 2325 до 2475 МГц с интервалом в 50 МГц
-            temp = 2275
-            while temp <= 2425:
-                temp += 50
-                rlsFreqList.append(temp)
-
-            try:
-                eradiationFrequency = rlsFreqList[eradiationFrequencyCode]
-            except IndexError:
-                return eradiationFrequency
-
-        elif rlsType == 'RLS2.4M':
-            # РЛС RLS2.4М поддерживает частоты от 2312.5 до 2487.5 МГц с интервалом в 12.5 МГц
-            temp = 2300
-            while temp <= 2475:
-                temp += 12.5
-                rlsFreqList.append(temp)
-            try:
-                eradiationFrequency = rlsFreqList[eradiationFrequencyCode]
-            except IndexError:
-                return eradiationFrequency
-
-        elif rlsType == 'RLSX':
-            # РЛС RLSX поддерживает частоты от 9235 до 9760 МГц с интервалом в 35 МГц
-            temp = 9200
-            while temp <= 9725:
-                temp += 35
-                rlsFreqList.append(temp)
-            try:
-                eradiationFrequency = rlsFreqList[eradiationFrequencyCode]
-            except IndexError:
-                return eradiationFrequency
-
-        return eradiationFrequency
+        # частоты всех типов РЛС вычислены заранее в codec.RLS_FREQUENCIES:
+        # RLS2.4 - от 2325 до 2475 МГц с интервалом в 50 МГц
+        # RLS2.4М - от 2312.5 до 2487.5 МГц с интервалом в 12.5 МГц
+        # RLSX - от 9235 до 9760 МГц с интервалом в 35 МГц
+        rlsFreqList = codec.RLS_FREQUENCIES.get(rlsType, ())
+        if eradiationFrequencyCode < len(rlsFreqList):
+            return rlsFreqList[eradiationFrequencyCode]
+        return None
 
     def __parseServerExtentedStatePacket(self, packet):
         """
@@ -570,51 +838,14 @@ class BinProtocol:
         :return:
         """
         # пакет 3.15, 0x15 - команда расширенного статуса сервера (пока нигде не используется)
-        state = {}
-        state['transmitterRLSState'] = packet[9]
-        state['digitalReceiverRLSState'] = packet[10]
-        state['analogReceiverRLSState'] = packet[11]
-        state['clientCount'] = packet[12]
-        state['firstZonePassiveInterference'] = packet[13]
-        state['secondZonePassiveInterference'] = packet[14]
-        state['thirdZonePassiveInterference'] = packet[15]
-        state['fourthZonePassiveInterference'] = packet[16]
-        state['sensivityReceiverRLS'] = packet[17]
-        state['txRDS1'] = packet[18]
-        state['rxRDS1'] = packet[19]
-        state['errorsRDS1'] = packet[20]
-
-    def __convert(self, num, len):
-        """
-        Метод для конвертирования чисел представленных в дополнительном коде
-        :param num: число, которое необходимо декодировать
-        :param len: сколько байт занимает представление числа num
-        :return:
-        """
-        sign = 0b10000000 if len == 1 else 0b1000000000000000
-        bitMask = 0b11111111 if len == 1 else 0b1111111111111111
-
-        # если в старшем разряде нет 1 (этот разряд представляет знак числа), то число положительное, и просто
-        # возвращаем это же число
-        if num & sign == 0:
-            return num
-        # иначе, инвертируем число и выравниваем по битовой маске
-        else:
-            num = ~num & bitMask
-            return -1 * (num + 1)
+        state = codec.SERVER_EXTENDED_STATE.unpack(packet)
+        return state
 
-    def __byteIndex(self):
+    def getCurrentPingThread(self):
         """
-        Метод генерации индексов для перемещения по байтовому массиву, чтобы извлекать данные закодированных траекторий
-        :return: index | int - следущий индекс по порядку, начиная с 9го
+        Метод для получения таймера пинга сервера API Umirs
+        :return: timer | timers.Timer | None
         """
-        index = 9  # с 9го индекса начинается кодирование траекторий
-        maxIndex = 417   # согласно протоколу макс. кол-во траекторий = 32, по 13 байтов на одну траекторию = 416 байт
-        while index < maxIndex:
-            index += 1
-            yield index
-
-    def getCurrentPingThread(self):
         return self.__ping
 
     def _stopThreads(self):
@@ -623,6 +854,80 @@ class BinProtocol:
          самым обеспечивая выход из методов, где используются бесконечные циклы
         :return:
         """
-        self.__ping.is_stopped = True
+        self.stopPing()
         self.__parsePacket.is_stopped = True
         self.__live = False
+
+
+class FramesBuffer:
+    """
+    Буфер для сборки пакетов Umirs из частей данных, полученных из сокета. Данные накапливаются в одном bytearray,
+    позиция чтения хранится смещением, поэтому извлечение пакета не сдвигает остаток данных. Уже прочитанная часть
+    буфера удаляется (компактируется) только изредка: когда весь буфер прочитан или смещение превысило порог.
+    """
+    MAX_PACKET_LENGTH = codec.MAX_PACKET_LENGTH  # максимальная длина пакета согласно протоколу
+
+    def __init__(self, compactThreshold=4096, onResync=None):
+        """
+        :param compactThreshold: размер прочитанной части буфера в байтах, после которого она удаляется из буфера
+        :type compactThreshold: int
+        :param onResync: функция, которая вызывается с кол-вом отброшенных байт, когда из-за некорректной длины
+        пакета отбрасываются все накопленные данные
+        """
+        self.__data = bytearray()
+        self.__offset = 0  # позиция начала первого неразобранного пакета
+        self.compactThreshold = compactThreshold
+        self.onResync = onResync
+
+    def __len__(self):
+        """
+        Кол-во байт, которые ещё не были извлечены в виде пакетов
+        :return:
+        """
+        return len(self.__data) - self.__offset
+
+    def clear(self):
+        """
+        Метод для очистки буфера
+        :return:
+        """
+        del self.__data[:]
+        self.__offset = 0
+
+    def extractPackets(self, chunk):
+        """
+        Генератор, который добавляет полученные данные в буфер и возвращает из него все целые пакеты.
+        Пакеты возвращаются как memoryview поверх буфера и действительны только до следующей итерации генератора,
+        поэтому сохранять ссылки на них нельзя (при необходимости нужно сделать копию).
+        :param chunk: очередная часть данных из сокета
+        :return: packet | memoryview
+        """
+        self.__data += chunk
+        wrongPacket = False
+        with memoryview(self.__data) as view:
+            # чтобы корректно извлечь данные о длине пакета, длина данных должны быть больше 2х элементов, т.к.
+            # в индексах [1] и [2] хранится общая длина пакета.
+            while len(view) - self.__offset > 2:
+                start = self.__offset
+                lengthPacket = (view[start + 1] << 8) + view[start + 2]
+                # если длина пакета больше 416 байт (это максимальная длина пакета согласно протоколу), или равна
+                # нулю то отбросим все накопленные данные и выйдем из цикла обработки сообщений
+                if lengthPacket > self.MAX_PACKET_LENGTH or lengthPacket == 0:
+                    logging.info('Length packet is more than 416 bytes!' if lengthPacket > 0 else
+                                 'Received wrong packet')
+                    wrongPacket = True
+                    break
+                # если пакет пришел не целиком, то оставляем его в буфере до получения следующей части данных
+                if lengthPacket > len(view) - start:
+                    break
+                self.__offset = start + lengthPacket
+                with view[start:self.__offset] as packet:
+                    yield packet
+        # изменять размер bytearray можно только после освобождения всех memoryview
+        if wrongPacket and self.onResync is not None:
+            self.onResync(len(self))
+        if wrongPacket or self.__offset == len(self.__data):
+            self.clear()
+        elif self.__offset >= self.compactThreshold:
+            del self.__data[:self.__offset]
+            self.__offset = 0
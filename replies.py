@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Модуль ожидания ответов сервера API Umirs на команды. Сервер не повторяет в ответе порядковый номер пакета команды,
+поэтому ответ сопоставляется с командой по номеру команды ответа (CommandSpec.reply) и значению ключевого поля
+(CommandSpec.replyKey, например номер трека для захвата 0x0B -> 0x0D). Команды с одинаковым ключом ожидают ответы в
+порядке отправки, поэтому несколько команд могут ожидать ответа одновременно. Ответ на команду, отправленную без
+ожидания ответа (например BinProtocol.captureAndFollowTarget), и пакет, который сервер отправляет по собственной
+инициативе (например статус захвата 0x0D при потере трека), не отличаются от ответа и завершат ожидающую команду с тем
+же ключом. Исключение - приветствия пинга BinProtocol: сервер отвечает на каждое приветствие, поэтому они
+регистрируются в таблице, хотя их ответ никто не ожидает.
+Пример: future = protocol.request('captureAndFollowTarget', {'trackId': 5, 'captureTarget': 1}); future.result(3.0)
+или в asyncio: await asyncio.wrap_future(future)
+"""
+import logging
+import threading
+
+from collections import deque
+from concurrent.futures import Future
+
+from timers import getTimerWheel
+
+
+logging.getLogger()
+
+
+class _PendingReply:
+    __slots__ = ('future', 'timer', 'key', 'seq')
+
+    def __init__(self, future, key, seq):
+        self.future = future
+        self.key = key
+        self.seq = seq
+        self.timer = None
+
+
+class PendingReplies:
+    """
+    Таблица команд, ожидающих ответа сервера. Futures завершаются результатом парсинга ответа, исключением
+    TimeoutError по истечении таймаута или ConnectionError при потере соединения. Если ответ на команду пришёл после
+    таймаута, он будет сопоставлен со следующей командой с тем же ключом, поэтому таймаут должен быть больше обычного
+    времени ответа сервера
+    """
+    def __init__(self, timers=None, timeout=5.0):
+        """
+        :param timers: колесо таймеров для таймаутов. По умолчанию - общее для процесса колесо
+        :type timers: timers.TimerWheel
+        :param timeout: таймаут ответа по умолчанию в секундах
+        """
+        self.timers = timers
+        self.timeout = timeout
+        self.__lock = threading.Lock()
+        self.__pending = {}  # номер команды ответа -> {значение ключа: deque ожидающих команд}
+
+    def expect(self, spec, values, seq, timeout=None):
+        """
+        Метод регистрации команды, ожидающей ответа. Вызывается до отправки пакета, чтобы быстрый ответ не был
+        пропущен
+        :param spec: описание команды с номером команды ответа
+        :type spec: codec.CommandSpec
+        :param values: параметры команды
+        :param seq: порядковый номер пакета команды (для сообщений об ошибках)
+        :param timeout: таймаут ответа в секундах. По умолчанию - таймаут таблицы
+        :return: future | concurrent.futures.Future
+        """
+        future = Future()
+        # future в состоянии выполнения нельзя отменить: ответ сервера всё равно придёт и должен быть сопоставлен
+        # именно с этой командой
+        future.set_running_or_notify_cancel()
+        key = values.get(spec.replyKey) if spec.replyKey is not None else None
+        pending = _PendingReply(future, key, seq)
+        with self.__lock:
+            self.__pending.setdefault(spec.reply, {}).setdefault(key, deque()).append(pending)
+        timers = self.timers if self.timers is not None else getTimerWheel()
+        pending.timer = timers.callLater(self.timeout if timeout is None else timeout, self.__expire, spec, pending)
+        return future
+
+    def fail(self, spec, values, future, exc):
+        """
+        Метод завершения исключением команды, ожидающей ответа, например если пакет команды не был отправлен
+        :param spec: описание команды
+        :param values: параметры команды
+        :param future: future, которую вернул метод expect
+        :param exc: исключение
+        :return: bool - ожидала ли команда ответа
+        """
+        key = values.get(spec.replyKey) if spec.replyKey is not None else None
+        with self.__lock:
+            byKey = self.__pending.get(spec.reply)
+            queue = byKey.get(key) if byKey is not None else None
+            pending = next((pending for pending in queue if pending.future is future), None) if queue else None
+            if pending is None:
+                return False
+            queue.remove(pending)
+            self.__discardEmpty(spec.reply, byKey, key, queue)
+        if pending.timer is not None:
+            pending.timer.cancel()
+        pending.future.set_exception(exc)
+        return True
+
+    def resolve(self, code, result, keyField=None):
+        """
+        Метод завершения первой по порядку команды, ожидающей ответа code с ключом из result
+        :param code: номер команды ответа
+        :param result: результат парсинга ответа
+        :param keyField: имя ключевого поля в result
+        :return: bool - был ли ответ сопоставлен с командой
+        """
+        pending = self.__pop(code, result.get(keyField) if keyField is not None else None)
+        if pending is None:
+            return False
+        pending.future.set_result(result)
+        return True
+
+    def reject(self, code, exc, key=None):
+        """
+        Метод завершения первой по порядку команды, ожидающей ответа code, исключением. Используется, когда ответ
+        получен, но означает ошибку
+        :return: bool - был ли ответ сопоставлен с командой
+        """
+        pending = self.__pop(code, key)
+        if pending is None:
+            return False
+        pending.future.set_exception(exc)
+        return True
+
+    def failAll(self, exc):
+        """
+        Метод завершения исключением всех команд, ожидающих ответа, например при потере соединения
+        :return:
+        """
+        with self.__lock:
+            pendingByCode, self.__pending = self.__pending, {}
+        for byKey in pendingByCode.values():
+            for queue in byKey.values():
+                for pending in queue:
+                    if pending.timer is not None:
+                        pending.timer.cancel()
+                    pending.future.set_exception(exc)
+
+    def __len__(self):
+        with self.__lock:
+            return sum(len(queue) for byKey in self.__pending.values() for queue in byKey.values())
+
+    def __pop(self, code, key):
+        with self.__lock:
+            byKey = self.__pending.get(code)
+            if byKey is None:
+                return None
+            queue = byKey.get(key)
+            if not queue:
+                return None
+            pending = queue.popleft()
+            self.__discardEmpty(code, byKey, key, queue)
+        # таймер мог быть ещё не создан, если ответ пришёл раньше возврата из expect
+        if pending.timer is not None:
+            pending.timer.cancel()
+        return pending
+
+    def __expire(self, spec, pending):
+        with self.__lock:
+            byKey = self.__pending.get(spec.reply)
+            queue = byKey.get(pending.key) if byKey is not None else None
+            if queue is None or pending not in queue:
+                return
+            queue.remove(pending)
+            self.__discardEmpty(spec.reply, byKey, pending.key, queue)
+        pending.future.set_exception(TimeoutError(f'No reply 0x{spec.reply:02X} to command {spec.name} '
+                                                  f'(packet {pending.seq})'))
+
+    def __discardEmpty(self, code, byKey, key, queue):
+        if not queue:
+            del byKey[key]
+            if not byKey:
+                del self.__pending[code]
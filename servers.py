@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import threading
+
+from aioclient import AsyncClient
+
+
+logging.getLogger()
+
+
+class ServersManager:
+    """
+    Менеджер подключений к нескольким серверам API Umirs в одном процессе. Все подключения обслуживаются одним циклом
+    событий asyncio в одном потоке, а пинг всех серверов - общим колесом таймеров, поэтому кол-во потоков не зависит от
+    кол-ва серверов. Каждое подключение - отдельный AsyncClient со своими Id сервера, счётчиком пакетов, пакетом
+    приветствия, пингом и состоянием соединения
+    """
+    def __init__(self, pingInterval=3.0, reconnectDelay=1.0, maxReconnectDelay=15.0):
+        """
+        :param pingInterval: таймаут между пингами по умолчанию для всех серверов в секундах
+        :param reconnectDelay: таймаут перед первой попыткой нового подключения по умолчанию для всех серверов в
+        секундах
+        :param maxReconnectDelay: максимальный таймаут перед новым подключением по умолчанию для всех серверов в
+        секундах
+        """
+        self.pingInterval = pingInterval
+        self.reconnectDelay = reconnectDelay
+        self.maxReconnectDelay = maxReconnectDelay
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = None
+        self.__servers = {}  # (host, port) -> (клиент, future задачи serve)
+        self.__lock = threading.Lock()
+
+    def start(self):
+        """
+        Метод запуска потока с общим циклом событий
+        :return:
+        """
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__thread = threading.Thread(target=self.__runLoop, name='UmirsServersManager', daemon=True)
+        self.__thread.start()
+
+    def stop(self, timeout=5.0):
+        """
+        Метод закрытия всех подключений и остановки потока с циклом событий
+        :param timeout: время ожидания закрытия подключений в секундах
+        :return:
+        """
+        with self.__lock:
+            servers = list(self.__servers)
+        for host, port in servers:
+            self.removeServer(host, port, timeout)
+        if self.__thread is not None:
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__thread.join(timeout)
+            self.__thread = None
+
+    def addServer(self, host, port, serverId=1, eventsManager=None, **clientParams):
+        """
+        Метод добавления сервера API Umirs. Подключение к серверу и переподключения выполняются в общем цикле событий
+        :param host:
+        :param port:
+        :param serverId: Id сервера API Umirs
+        :param eventsManager: менеджер событий для этого сервера
+        :param clientParams: дополнительные параметры для AsyncClient и BinProtocol
+        :return: client | AsyncClient
+        """
+        clientParams.setdefault('pingInterval', self.pingInterval)
+        clientParams.setdefault('reconnectDelay', self.reconnectDelay)
+        clientParams.setdefault('maxReconnectDelay', self.maxReconnectDelay)
+        with self.__lock:
+            if (host, port) in self.__servers:
+                raise ValueError(f'Server API Umirs {host}:{port} is already added')
+            client = AsyncClient(host, port, eventsManager=eventsManager, serverId=serverId, **clientParams)
+            self.start()
+            task = asyncio.run_coroutine_threadsafe(client.serve(), self.__loop)
+            self.__servers[(host, port)] = (client, task)
+        logging.info(f'Added Server API Umirs {host}:{port} serverId={serverId}')
+        return client
+
+    def removeServer(self, host, port, timeout=5.0):
+        """
+        Метод закрытия подключения к серверу API Umirs и удаления его из менеджера. Если метод вызван в потоке цикла
+        событий (например из обработчика события AsyncClient), то ожидание остановило бы цикл, поэтому закрытие
+        подключения только планируется в цикле и метод возвращает управление сразу
+        :param host:
+        :param port:
+        :param timeout: время ожидания закрытия подключения в секундах
+        :return:
+        """
+        with self.__lock:
+            client, task = self.__servers.pop((host, port), (None, None))
+        if client is None:
+            return
+        # если клиент ожидал переподключения, задача serve завершится только после отмены
+        if threading.current_thread() is self.__thread:
+            self.__loop.create_task(client.close()).add_done_callback(lambda _: task.cancel())
+        else:
+            asyncio.run_coroutine_threadsafe(client.close(), self.__loop).result(timeout)
+            task.cancel()
+        logging.info(f'Removed Server API Umirs {host}:{port}')
+
+    def getClient(self, host, port):
+        """
+        Метод для получения клиента сервера API Umirs
+        :param host:
+        :param port:
+        :return: client | AsyncClient | None
+        """
+        client, _ = self.__servers.get((host, port), (None, None))
+        return client
+
+    def getClients(self):
+        """
+        Метод для получения всех клиентов менеджера
+        :return: clients | list
+        """
+        return [client for client, _ in self.__servers.values()]
+
+    def __runLoop(self):
+        asyncio.set_event_loop(self.__loop)
+        self.__loop.run_forever()
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Модуль симулятора сервера API Umirs для нагрузочного тестирования Client и BinProtocol на localhost.
+Симулятор отвечает на приветствие (0x00 -> 0x01) и запрос статуса (0x09 -> 0x14, а при formatStatus != 0 ещё и
+0x15), подтверждает команду захвата пакетом 0x0D и после приветствия передаёт пакеты траекторий 0x0A с заданной
+частотой. Кол-во траекторий, частота пакетов, разбиение данных на части и внесение ошибок настраиваются.
+Запуск из командной строки: python simulator.py --servers 10 --port 20000 --tracks 31 --rate 50
+"""
+import time
+import socket
+import random
+import asyncio
+import logging
+import argparse
+
+import codec
+
+from protocol import FramesBuffer
+
+
+logging.getLogger()
+
+# максимальное кол-во траекторий, которое помещается в пакет максимальной длины
+MAX_TRACKS = (codec.MAX_PACKET_LENGTH - codec.TRAJECTORIES.size) // codec.TRAJECTORIES.recordLayout.size
+
+
+class _SimulatedTrack:
+    """
+    Траектория симулятора, равномерно меняющая дальность и азимут
+    """
+    def __init__(self, trackId, rnd):
+        self.trackId = trackId
+        self.range = rnd.randint(100, 5000)
+        self.azimuth = rnd.randint(-90, 90)  # в половинах градуса
+        self.radSpeed = rnd.randint(-30, 30)
+        self.tanSpeed = rnd.randint(-30, 30)
+        self.square = (rnd.randint(0, 20), rnd.randint(0, 99))
+        self.sector = rnd.randint(0, 7)
+
+    def move(self):
+        self.range = min(max(self.range + self.radSpeed, 0), 0xFFFF)
+        self.azimuth += 1 if self.tanSpeed > 0 else -1
+        if not -90 <= self.azimuth <= 90:
+            self.tanSpeed = -self.tanSpeed
+            self.azimuth = max(min(self.azimuth, 90), -90)
+
+    def record(self, status):
+        return (self.trackId, status, self.square[0], self.square[1], self.range, self.azimuth, self.radSpeed,
+                self.tanSpeed, self.sector)
+
+
+class UmirsSimulator:
+    """
+    Симулятор одного сервера API Umirs
+    """
+    def __init__(self, host='127.0.0.1', port=0, serverId=1, tracks=8, frameRate=10.0, fragmentation=None,
+                 corruption=0.0, rlsCode=0, seed=None, onFrameSent=None):
+        """
+        :param host: адрес для подключения клиентов. Для нагрузочного тестирования - только localhost
+        :param port: порт. 0 - выбрать свободный порт (см. атрибут port после start)
+        :param serverId: Id сервера API Umirs
+        :param tracks: кол-во траекторий в пакете 0x0A (не больше MAX_TRACKS)
+        :param frameRate: кол-во пакетов 0x0A в секунду. 0 - пакеты траекторий не передаются
+        :param fragmentation: разбиение передаваемых данных на части: None - пакет целиком, число - части
+        фиксированного размера, список чисел - размеры частей по кругу, 'random' - части случайного размера
+        :param corruption: вероятность внесения ошибки (замены случайного байта) в пакет траекторий
+        :param rlsCode: код типа РЛС в пакете статуса
+        :param seed: начальное значение генератора случайных чисел для воспроизводимости
+        :param onFrameSent: функция, которая вызывается перед отправкой каждого пакета траекторий со временем
+        time.perf_counter_ns (используется для измерения задержки доставки в benchmarks)
+        """
+        if tracks > MAX_TRACKS:
+            logging.info(f'Maximum {MAX_TRACKS} tracks fit into one packet. Tracks count is reduced')
+            tracks = MAX_TRACKS
+        self.host = host
+        self.port = port
+        self.serverId = serverId
+        self.tracks = tracks
+        self.frameRate = frameRate
+        self.fragmentation = fragmentation
+        self.corruption = corruption
+        self.rlsCode = rlsCode
+        self.random = random.Random(seed)
+        self.onFrameSent = onFrameSent
+        self.framesSent = 0  # кол-во отправленных пакетов траекторий по всем подключениям
+        self.__server = None
+        # состояние сервера, которое меняется командами клиента и передаётся в пакете статуса
+        self.state = {
+            'connectionCORT': 0, 'connectionRLS': 0, 'connectionPTZ': 0, 'eradiationFrequencyCode': 0,
+            'activeInterference': 0, 'eradiationRLS': 0, 'filters': 0, 'masks': 0, 'panPTZ': 0, 'tiltPTZ': 0,
+            'controlInterceptedPTZ': 0, 'trajectoryCaptured': 0, 'autoCapture': 0, 'rlsCode': rlsCode,
+        }
+        self.captured = {}  # trackId -> признак захвата
+
+    async def start(self):
+        self.__server = await asyncio.start_server(self.__handleClient, self.host, self.port)
+        self.port = self.__server.sockets[0].getsockname()[1]
+        logging.info(f'Umirs simulator serverId={self.serverId} is listening on {self.host}:{self.port}')
+
+    async def stop(self):
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+            self.__server = None
+
+    async def __handleClient(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            # без Nagle части пакетов уходят отдельными сегментами, что и нужно для проверки сборки пакетов
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = _SimulatedConnection(self, writer)
+        framesBuffer = FramesBuffer()
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                for packet in framesBuffer.extractPackets(data):
+                    await connection.handlePacket(bytes(packet))
+        except ConnectionError:
+            pass
+        finally:
+            connection.close()
+            writer.close()
+
+
+class _SimulatedConnection:
+    """
+    Подключение клиента к симулятору: свой счётчик пакетов и своя задача передачи траекторий
+    """
+    def __init__(self, simulator, writer):
+        self.simulator = simulator
+        self.writer = writer
+        self.countPacket = 0
+        self.fragmentIndex = 0
+        self.streamTask = None
+        self.tracks = [_SimulatedTrack(trackId, simulator.random) for trackId in range(1, simulator.tracks + 1)]
+
+    def close(self):
+        if self.streamTask is not None:
+            self.streamTask.cancel()
+
+    async def handlePacket(self, packet):
+        simulator = self.simulator
+        if len(packet) < codec.HEADER_LENGTH:
+            # длина в заголовке может быть меньше самого заголовка, номера команды в таком пакете нет
+            logging.warning(f'Umirs simulator skips packet of {len(packet)} bytes without command')
+            return
+        command = packet[6]
+        spec = codec.COMMANDS.get(command)
+        if spec is not None and len(packet) < spec.size:
+            # короткий пакет не должен завершать обработку подключения клиента
+            logging.warning(f'Umirs simulator skips command {command} of {len(packet)} bytes, '
+                            f'expected {spec.size} bytes')
+            return
+        values = spec.unpack(packet) if spec is not None else {}
+        if command == codec.HELLO.code:
+            await self.send(self.pack(codec.HELLO_CLIENT, [codec.PROTOCOL_VERSION]))
+            if self.streamTask is None and simulator.frameRate:
+                self.streamTask = asyncio.get_running_loop().create_task(self.streamTrajectories())
+        elif command == codec.SERVER_STATUS_REQUEST.code:
+            await self.send(self.pack(codec.SERVER_STATE, [simulator.state[name]
+                                                           for name in codec.SERVER_STATE.fieldNames]))
+            if values['formatStatus']:
+                await self.send(self.pack(codec.SERVER_EXTENDED_STATE, [0] * len(codec.SERVER_EXTENDED_STATE.fields)))
+        elif command == codec.CAPTURE_TARGET.code:
+            simulator.captured[values['trackId']] = values['captureTarget']
+            simulator.state['trajectoryCaptured'] = int(any(simulator.captured.values()))
+            await self.send(self.pack(codec.CAPTURE_STATE, [values['trackId'], values['captureTarget']]))
+        elif command == codec.AUTO_CAPTURE.code:
+            simulator.state['autoCapture'] = values['setAutoCapture']
+        elif command == codec.ARM_RLS.code:
+            simulator.state['eradiationRLS'] = values['setArmRLS']
+        elif command == codec.FILTERS.code:
+            simulator.state['filters'] = values['setFilters']
+        elif command == codec.MASKS.code:
+            simulator.state['masks'] = values['setMasks']
+        elif command == codec.PTZ.code:
+            simulator.state['panPTZ'] = (simulator.state['panPTZ'] + values['setPTZSpeed']) & 0xFFFF
+        else:
+            logging.debug(f'Umirs simulator ignores command {command}')
+
+    async def streamTrajectories(self):
+        simulator = self.simulator
+        interval = 1.0 / simulator.frameRate
+        loop = asyncio.get_running_loop()
+        nextTime = loop.time()
+        while True:
+            for track in self.tracks:
+                track.move()
+            records = [track.record(simulator.captured.get(track.trackId, 0)) for track in self.tracks]
+            packet = self.pack(codec.TRAJECTORIES, [len(records)], records)
+            if simulator.corruption and simulator.random.random() < simulator.corruption:
+                packet[simulator.random.randrange(len(packet))] = simulator.random.randrange(256)
+            if simulator.onFrameSent is not None:
+                simulator.onFrameSent(time.perf_counter_ns())
+            await self.send(packet)
+            simulator.framesSent += 1
+            nextTime += interval
+            await asyncio.sleep(max(nextTime - loop.time(), 0))
+
+    def pack(self, spec, values, records=()):
+        self.countPacket = (self.countPacket % 255) + 1
+        return spec.pack(self.countPacket, self.simulator.serverId, values, records)
+
+    async def send(self, packet):
+        for fragment in self.fragments(packet):
+            self.writer.write(fragment)
+            await self.writer.drain()
+
+    def fragments(self, packet):
+        fragmentation = self.simulator.fragmentation
+        if not fragmentation:
+            return [packet]
+        fragments = []
+        offset = 0
+        while offset < len(packet):
+            if fragmentation == 'random':
+                size = self.simulator.random.randint(1, len(packet))
+            elif isinstance(fragmentation, int):
+                size = fragmentation
+            else:
+                size = fragmentation[self.fragmentIndex % len(fragmentation)]
+                self.fragmentIndex += 1
+            fragments.append(packet[offset:offset + size])
+            offset += size
+        return fragments
+
+
+async def runSimulators(count=1, host='127.0.0.1', port=0, **params):
+    """
+    Функция запуска нескольких симуляторов на последовательных портах, начиная с port (или на свободных портах,
+    если port=0). serverId симуляторов - от 1 до count
+    :return: simulators | list
+    """
+    simulators = []
+    for index in range(count):
+        simulator = UmirsSimulator(host, port + index if port else 0, serverId=index + 1, **params)
+        await simulator.start()
+        simulators.append(simulator)
+    return simulators
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Umirs API server simulator')
+    parser.add_argument('--servers', type=int, default=1, help='count of simulated servers')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=20000, help='port of the first server')
+    parser.add_argument('--tracks', type=int, default=8, help=f'tracks per 0x0A packet, max {MAX_TRACKS}')
+    parser.add_argument('--rate', type=float, default=10.0, help='0x0A packets per second')
+    parser.add_argument('--fragment', default=None, help="fragment size, comma separated sizes or 'random'")
+    parser.add_argument('--corruption', type=float, default=0.0, help='probability of corrupted 0x0A packet')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    fragmentation = args.fragment
+    if fragmentation and fragmentation != 'random':
+        sizes = [int(size) for size in fragmentation.split(',')]
+        fragmentation = sizes[0] if len(sizes) == 1 else sizes
+
+    logging.basicConfig(level=logging.INFO)
+
+    async def serve():
+        await runSimulators(args.servers, args.host, args.port, tracks=args.tracks, frameRate=args.rate,
+                            fragmentation=fragmentation, corruption=args.corruption, seed=args.seed)
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Модуль таймеров клиента API Umirs. Иерархическое колесо таймеров TimerWheel выполняет периодическую работу всех
+подключений процесса (пинг сервера, обновление пакета приветствия) в одном потоке, поэтому кол-во потоков не зависит
+от кол-ва подключений. Backoff вычисляет задержки переподключения с экспоненциальным ростом и случайным разбросом.
+Пример: timer = getTimerWheel().callEvery(3.0, ping); ...; timer.cancel()
+"""
+import time
+import random
+import logging
+import threading
+
+
+logging.getLogger()
+
+
+class Timer:
+    """
+    Таймер колеса. Возвращается методами callLater и callEvery, отменяется методом cancel
+    """
+    __slots__ = ('expires', 'interval', 'callback', 'args', 'cancelled')
+
+    def __init__(self, expires, interval, callback, args):
+        self.expires = expires  # номер тика колеса, на котором таймер срабатывает
+        self.interval = interval  # период в тиках для периодического таймера, иначе None
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Метод отмены таймера. Отменённый таймер удаляется из колеса при обходе его ячейки
+        :return:
+        """
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Иерархическое колесо таймеров. Время разбито на тики длительностью tick секунд. Колесо состоит из levels уровней
+    по wheelSize ячеек: ячейка уровня 0 соответствует одному тику, ячейка уровня L - wheelSize ** L тикам. Таймер
+    помещается на самый нижний уровень, в пределах которого находится его срок, и при повороте верхнего уровня
+    переносится на нижние уровни. Поэтому добавление и отмена таймера выполняются за O(1) независимо от кол-ва
+    таймеров. Функции таймеров вызываются в потоке колеса и должны быть быстрыми
+    """
+    def __init__(self, tick=0.01, wheelSize=256, levels=4, clock=time.monotonic):
+        """
+        :param tick: длительность тика в секундах, т.е. точность срабатывания таймеров
+        :param wheelSize: кол-во ячеек одного уровня, степень двойки
+        :param levels: кол-во уровней. Максимальный срок таймера - tick * wheelSize ** levels секунд, таймеры с
+        большим сроком переносятся на нижние уровни по мере приближения срока
+        :param clock: функция текущего монотонного времени в секундах
+        """
+        if wheelSize & (wheelSize - 1):
+            raise ValueError('wheelSize must be a power of two')
+        self.tick = tick
+        self.wheelSize = wheelSize
+        self.levels = levels
+        self.__bits = wheelSize.bit_length() - 1
+        self.__mask = wheelSize - 1
+        self.__clock = clock
+        self.__start = clock()
+        self.__wheels = [[[] for _ in range(wheelSize)] for _ in range(levels)]
+        self.__nextTick = 1  # номер следующего необработанного тика
+        self.__count = 0  # кол-во таймеров в колесе, включая отменённые, но ещё не удалённые
+        self.__wakeup = threading.Condition(threading.Lock())
+        self.__thread = None
+        self.__running = False
+
+    def start(self):
+        """
+        Метод запуска потока колеса
+        :return:
+        """
+        with self.__wakeup:
+            if self.__running:
+                return
+            self.__running = True
+        self.__thread = threading.Thread(target=self.__run, name='UmirsTimers', daemon=True)
+        self.__thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Метод остановки потока колеса. Таймеры остаются в колесе и сработают после повторного запуска
+        :return:
+        """
+        with self.__wakeup:
+            self.__running = False
+            self.__wakeup.notify()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+            self.__thread = None
+
+    def callLater(self, delay, callback, *args):
+        """
+        Метод вызова функции через delay секунд
+        :return: timer | Timer
+        """
+        return self.__schedule(delay, None, callback, args)
+
+    def callEvery(self, interval, callback, *args, firstDelay=None):
+        """
+        Метод периодического вызова функции каждые interval секунд. Сроки вычисляются от первого срока, поэтому
+        задержки вызова функций не накапливаются
+        :param firstDelay: задержка первого вызова в секундах. По умолчанию - interval
+        :return: timer | Timer
+        """
+        ticks = max(1, round(interval / self.tick))
+        return self.__schedule(interval if firstDelay is None else firstDelay, ticks, callback, args)
+
+    def advance(self):
+        """
+        Метод обработки всех наступивших тиков и вызова функций сработавших таймеров. Вызывается потоком колеса, но
+        может вызываться и напрямую, если колесо не запущено
+        :return: timeout | float | None - время в секундах до ближайшего тика, на котором срабатывают или переносятся
+        таймеры, или None, если таймеров нет
+        """
+        with self.__wakeup:
+            expired = self.__collectExpired(self.__currentTick())
+        for timer in expired:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logging.exception(f'Timer callback {timer.callback} failed')
+        with self.__wakeup:
+            # периодические таймеры возвращаются в колесо после вызова, поэтому функция не вызывается параллельно
+            for timer in expired:
+                if timer.interval is not None and not timer.cancelled:
+                    timer.expires = max(timer.expires + timer.interval, self.__nextTick)
+                    self.__insert(timer)
+            if not self.__count:
+                return None
+            return max(0.0, self.__start + self.__nextEventTick() * self.tick - self.__clock())
+
+    def __len__(self):
+        return self.__count
+
+    def __schedule(self, delay, interval, callback, args):
+        with self.__wakeup:
+            timer = Timer(max(self.__currentTick() + 1, self.__tickAt(delay)), interval, callback, args)
+            self.__insert(timer)
+            self.__wakeup.notify()
+        return timer
+
+    def __currentTick(self):
+        return int((self.__clock() - self.__start) / self.tick)
+
+    def __tickAt(self, delay):
+        # срок округляется вверх, чтобы таймер не сработал раньше задержки
+        return -int(-(self.__clock() - self.__start + delay) // self.tick)
+
+    def __insert(self, timer):
+        """
+        Метод добавления таймера в ячейку. Таймер помещается на нижний уровень L, на котором его срок совпадает со
+        следующим тиком во всех разрядах выше уровня L; ячейка - разряд уровня L срока
+        :return:
+        """
+        expires = max(timer.expires, self.__nextTick)
+        timer.expires = expires
+        bits = self.__bits
+        top = self.levels - 1
+        for level in range(top):
+            if expires >> (bits * (level + 1)) == self.__nextTick >> (bits * (level + 1)):
+                self.__wheels[level][(expires >> (bits * level)) & self.__mask].append(timer)
+                break
+        else:
+            if (expires >> (bits * top)) - (self.__nextTick >> (bits * top)) < self.wheelSize:
+                index = expires >> (bits * top)
+            else:
+                # срок за пределами колеса: таймер ждёт почти полного оборота верхнего уровня и переносится заново
+                index = (self.__nextTick >> (bits * top)) - 1
+            self.__wheels[top][index & self.__mask].append(timer)
+        self.__count += 1
+
+    def __collectExpired(self, currentTick):
+        """
+        Метод обработки тиков до currentTick включительно
+        :return: timers | list - сработавшие таймеры
+        """
+        expired = []
+        if not self.__count:
+            # пустое колесо не нужно поворачивать по одному тику
+            self.__nextTick = max(self.__nextTick, currentTick + 1)
+            return expired
+        bits = self.__bits
+        mask = self.__mask
+        while self.__nextTick <= currentTick and self.__count:
+            tick = self.__nextTick
+            # перенос таймеров с верхних уровней, разряд которых сменился на этом тике. Верхние уровни переносятся
+            # первыми, так как их таймеры могут попасть в переносимую ячейку нижнего уровня
+            for level in range(self.levels - 1, 0, -1):
+                if tick & ((1 << (bits * level)) - 1) == 0:
+                    self.__cascade(self.__wheels[level], (tick >> (bits * level)) & mask)
+            slot = self.__wheels[0][tick & mask]
+            if slot:
+                self.__wheels[0][tick & mask] = []
+                self.__count -= len(slot)
+                expired.extend(timer for timer in slot if not timer.cancelled)
+            self.__nextTick = tick + 1
+        self.__nextTick = max(self.__nextTick, currentTick + 1)
+        return expired
+
+    def __nextEventTick(self):
+        """
+        Метод поиска ближайшего тика, на котором срабатывают таймеры нижнего уровня или переносятся таймеры верхнего
+        уровня. Раньше этого тика колесу нечего делать, поэтому поток колеса спит до него, а не просыпается на каждом
+        тике
+        :return: tick | int
+        """
+        bits = self.__bits
+        mask = self.__mask
+        nextTick = self.__nextTick
+        top = self.levels - 1
+        for level in range(self.levels):
+            shift = bits * level
+            wheel = self.__wheels[level]
+            # первая ячейка уровня, которая ещё не обработана: на уровнях выше нулевого ячейка обрабатывается на тике,
+            # младшие разряды которого равны нулю
+            first = -(-nextTick >> shift)
+            # ячейки нижних уровней находятся в пределах текущего оборота уровня, верхний уровень ограничен только
+            # кол-вом ячеек
+            last = first + self.wheelSize if level == top else ((nextTick >> (shift + bits)) + 1) << bits
+            for index in range(first, last):
+                if wheel[index & mask]:
+                    # ячейки верхних уровней обрабатываются не раньше найденной ячейки нижнего уровня
+                    return index << shift
+        return nextTick
+
+    def __cascade(self, wheel, index):
+        slot = wheel[index]
+        if not slot:
+            return
+        wheel[index] = []
+        self.__count -= len(slot)
+        for timer in slot:
+            if not timer.cancelled:
+                self.__insert(timer)
+
+    def __run(self):
+        while True:
+            timeout = self.advance()
+            with self.__wakeup:
+                if not self.__running:
+                    break
+                # колесо без таймеров спит до добавления таймера
+                self.__wakeup.wait(timeout)
+                if not self.__running:
+                    break
+
+
+class Backoff:
+    """
+    Задержки повторных попыток с экспоненциальным ростом и случайным разбросом: n-я задержка выбирается из интервала
+    [(1 - jitter) * d, d], где d = min(maximum, initial * factor ** n). Разброс нужен, чтобы клиенты многих
+    подключений не переподключались к перезапущенному серверу одновременно
+    """
+    def __init__(self, initial=1.0, maximum=15.0, factor=2.0, jitter=0.5, rand=None):
+        """
+        :param initial: первая задержка в секундах
+        :param maximum: максимальная задержка в секундах
+        :param factor: множитель задержки после каждой попытки
+        :param jitter: доля задержки, на которую она может быть случайно уменьшена, от 0 до 1
+        :param rand: генератор случайных чисел random.Random
+        """
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+        self.__random = rand or random.Random()
+
+    def next(self):
+        """
+        Метод получения задержки перед следующей попыткой
+        :return: delay | float
+        """
+        delay = min(self.maximum, self.initial * self.factor ** min(self.attempts, 64))
+        self.attempts += 1
+        return delay * (1.0 - self.jitter * self.__random.random())
+
+    def reset(self):
+        """
+        Метод сброса задержки к начальной после успешной попытки
+        :return:
+        """
+        self.attempts = 0
+
+
+_timerWheel = None
+_timerWheelLock = threading.Lock()
+
+
+def getTimerWheel():
+    """
+    Функция получения общего для процесса колеса таймеров. Колесо создаётся и запускается при первом вызове
+    :return: timers | TimerWheel
+    """
+    global _timerWheel
+    with _timerWheelLock:
+        if _timerWheel is None:
+            _timerWheel = TimerWheel()
+            _timerWheel.start()
+        return _timerWheel
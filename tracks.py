@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Модуль таблицы обнаруженных траекторий
+"""
+
+
+class TracksTable:
+    """
+    Таблица траекторий, обнаруженных сервером API Umirs. Таблица обновляется каждым пакетом 0x0A и возвращает только
+    изменения относительно предыдущих пакетов: появившиеся, изменившиеся и пропавшие траектории.
+    Траектория считается изменившейся, если её дальность, азимут или одна из скоростей отличается от последнего
+    отправленного в событии значения больше, чем на заданный порог, либо изменился признак захвата или сектор.
+    Траектория считается пропавшей, если её нет в expireFrames пакетах подряд
+    """
+    def __init__(self, rangeThreshold=0, azimuthThreshold=0.0, speedThreshold=0, expireFrames=1):
+        """
+        :param rangeThreshold: порог изменения дальности
+        :param azimuthThreshold: порог изменения азимута в градусах
+        :param speedThreshold: порог изменения радиальной и тангенциальной скоростей
+        :param expireFrames: кол-во пакетов подряд без траектории, после которого она считается пропавшей
+        """
+        self.rangeThreshold = rangeThreshold
+        self.azimuthThreshold = azimuthThreshold
+        self.speedThreshold = speedThreshold
+        self.expireFrames = expireFrames
+        self.__tracks = {}  # trackId -> последнее полученное состояние траектории
+        self.__reported = {}  # trackId -> состояние траектории, последним отправленное в событии
+        self.__missed = {}  # trackId -> кол-во пакетов подряд, в которых не было траектории
+
+    def update(self, tracks):
+        """
+        Метод обновления таблицы траекториями очередного пакета 0x0A
+        :param tracks: траектории пакета - словари с ключами как у BinProtocol (trackId, status, range, ...)
+        :return: delta | dict - {'appeared': {trackId: track}, 'updated': {trackId: track},
+        'disappeared': {trackId: последнее состояние track}}
+        """
+        appeared = {}
+        updated = {}
+        disappeared = {}
+        received = set()
+        for track in tracks:
+            trackId = track['trackId']
+            received.add(trackId)
+            self.__tracks[trackId] = track
+            self.__missed[trackId] = 0
+            reported = self.__reported.get(trackId)
+            if reported is None:
+                appeared[trackId] = self.__reported[trackId] = track
+            elif self.__isChanged(reported, track):
+                updated[trackId] = self.__reported[trackId] = track
+
+        for trackId in list(self.__missed):
+            if trackId in received:
+                continue
+            self.__missed[trackId] += 1
+            if self.__missed[trackId] >= self.expireFrames:
+                disappeared[trackId] = self.__tracks.pop(trackId)
+                del self.__reported[trackId]
+                del self.__missed[trackId]
+
+        return {'appeared': appeared, 'updated': updated, 'disappeared': disappeared}
+
+    def getTracks(self):
+        """
+        Метод для получения последних состояний всех траекторий таблицы
+        :return: tracks | dict - {trackId: track}
+        """
+        return dict(self.__tracks)
+
+    def clear(self):
+        """
+        Метод очистки таблицы, например при потере соединения с сервером API Umirs
+        :return:
+        """
+        self.__tracks.clear()
+        self.__reported.clear()
+        self.__missed.clear()
+
+    def __isChanged(self, reported, track):
+        return (track['status'] != reported['status'] or
+                track['sector'] != reported['sector'] or
+                abs(track['range'] - reported['range']) > self.rangeThreshold or
+                abs(track['azimuth'] - reported['azimuth']) > self.azimuthThreshold or
+                abs(track['radSpeed'] - reported['radSpeed']) > self.speedThreshold or
+                abs(track['tanSpeed'] - reported['tanSpeed']) > self.speedThreshold)
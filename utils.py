@@ -2,6 +2,8 @@
 Модуль общих утилит
 """
 import time
+import logging
+import threading
 
 from datetime import datetime
 
@@ -54,3 +56,82 @@ class TimeUtil:
         :return:
         """
         return int(datetime.utcnow().timestamp())
+
+
+class LogUtil:
+    """
+    Настройки логирования горячих участков кода (приём, отправка и декодирование пакетов)
+    """
+    quiet = False  # режим высокой нагрузки: подробные логи горячих участков не пишутся даже на уровне DEBUG
+
+    @staticmethod
+    def setQuietMode(enabled=True):
+        """
+        Метод включения режима высокой нагрузки. Сводки LogSummary и логи подключения пишутся и в этом режиме
+        :param enabled:
+        :return:
+        """
+        LogUtil.quiet = enabled
+
+    @staticmethod
+    def isHotPathDebugEnabled():
+        """
+        Метод проверяет, нужно ли писать подробный лог горячего участка. Аргументы такого лога (например, содержимое
+        пакета) стоит вычислять только после этой проверки
+        :return:
+        """
+        return not LogUtil.quiet and logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+class LogSummary:
+    """
+    Сводка повторяющихся событий: вместо строки лога на каждое событие не чаще раза в interval секунд пишется одна
+    строка на тип события, например 'Umirs client: 120 recv would-block in last 10 s'. Сводка пишется при очередном
+    событии после истечения интервала или при вызове flush
+    """
+    def __init__(self, name, interval=10.0, level=logging.INFO):
+        """
+        :param name: имя источника событий в строке сводки
+        :param interval: минимальный интервал между сводками в секундах
+        :param level: уровень логирования сводки
+        """
+        self.name = name
+        self.interval = interval
+        self.level = level
+        self.__counts = {}
+        self.__since = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def count(self, event, amount=1):
+        """
+        Метод учёта события
+        :param event: тип события, например 'recv would-block'
+        :param amount: кол-во событий
+        :return:
+        """
+        with self.__lock:
+            self.__counts[event] = self.__counts.get(event, 0) + amount
+            if time.monotonic() - self.__since < self.interval:
+                return
+            counts, elapsed = self.__reset()
+        self.__write(counts, elapsed)
+
+    def flush(self):
+        """
+        Метод записи сводки накопленных событий, не дожидаясь окончания интервала
+        :return:
+        """
+        with self.__lock:
+            counts, elapsed = self.__reset()
+        self.__write(counts, elapsed)
+
+    def __reset(self):
+        now = time.monotonic()
+        counts, elapsed = self.__counts, now - self.__since
+        self.__counts = {}
+        self.__since = now
+        return counts, elapsed
+
+    def __write(self, counts, elapsed):
+        for event, count in counts.items():
+            logging.log(self.level, '%s: %d %s in last %.0f s', self.name, count, event, elapsed)